@@ -0,0 +1,260 @@
+# coding: utf-8
+"""
+Parser of the anuncio pages of CompraNet.
+
+parse_anuncio extracts the fields of a ContratoWeb from the HTML of an
+anuncio page. It is used by CompraNetSpider, and can be run on saved pages
+without Scrapy. Each page is parsed once with lxml, and the XPath
+expressions are compiled once when the module is imported rather than for
+every page.
+
+The pages come in two layouts, with the details of the procedure either in
+a conditionalPrefixFor_92 table or in a conditionalPrefixFor_155 table that
+also lists the annexes of the procedure. The labels of every field are
+checked, and a ParseError is raised when the layout of a page is not one of
+those, so that a change of the site is noticed instead of storing wrong
+values.
+"""
+import re
+
+from lxml import etree, html
+
+
+CNT_DETAIL = etree.XPath('/html/body/div[@id="main"]/div[@id="cnt"]/'
+                         'div[@id="cntDetail"]')
+ALERT = etree.XPath('div[@class="alert"]')
+EXPEDIENTE_ITEMS = etree.XPath('h3[text()="Detalles del Expediente"]'
+                               '/following-sibling::div[@class='
+                               '"form_container"][1]/ul/li')
+ANUNCIO_ITEMS = etree.XPath('h3[text()="Detalles del Anuncio"]'
+                            '/following-sibling::div[@class='
+                            '"form_container"][1]/ul/li')
+PREFIX_92_ROWS = etree.XPath('table[@id="conditionalPrefixFor_92"]/tr')
+PREFIX_155_ROWS = etree.XPath('table[@id="conditionalPrefixFor_155"]/tr')
+SECTION_TITLE = etree.XPath('th/h4')
+ANEXO_LINKS = etree.XPath('span/a')
+OPP_DETAIL = etree.XPath('form[@name="opportunityDetailForm"]/div')
+PROCEDIMIENTO_ROWS = etree.XPath('h3[normalize-space(text())="Procedimiento"]'
+                                 '/following-sibling::table[1]/tr')
+RESPONSABLE_ITEMS = etree.XPath('h3[contains(text(),"Responsable")]'
+                                '/following-sibling::div[1]/ul/li')
+ANEXOS_ROWS = etree.XPath('h3[contains(text(),"Anexos")]'
+                          '/following-sibling::table[1]/tr')
+SIZE_CP_RE = re.compile(r'.+\(([0-9,]+\s.B)\)')
+SIZE_OD_RE = re.compile(r'.+\(([0-9,]+ .B)\)')
+
+NOT_FOUND_ALERT = ('El anuncio de este procedimiento de contratación no se '
+                   'encuentra visible, favor de ponerse en contacto con '
+                   'personal de la Unidad Compradora.')
+DOWNLOAD_PREFIX = 'Descargar archivo adjunto: '
+
+# (column, label) of the fields of each section
+EXPEDIENTE_SPEC = [
+    ('CODIGO_EXPEDIENTE', 'Código del Expediente'),
+    ('TITULO_EXPEDIENTE', 'Descripción del Expediente'),
+]
+ANUNCIO_SPEC = [
+    ('_DESC_ANUNCIO', 'Descripción del Anuncio'),
+    ('_NOTAS', 'Notas'),
+    ('TIPO_CONTRATACION', 'Tipo de Contratación'),
+    ('_ENTIDAD_FEDERATIVA', 'Entidad Federativa'),
+    ('FECHA_APERTURA_PROPOSICIONES',
+     'Plazo de participación o vigencia del anuncio'),
+]
+PREFIX_92_TITLE = 'Detalles del Procedimiento'
+PREFIX_92_SPEC = [(col, '\n' + label) for (col, label) in [
+    ('NUMERO_PROCEDIMIENTO', 'Número del Procedimiento (Anuncio)'),
+    ('CARACTER', 'Carácter del procedimiento'),
+    ('_CREDITO_EXTERNO', 'Crédito externo'),
+    ('FORMA_PROCEDIMIENTO', 'Medio o forma del procedimiento'),
+    ('_EXCLUSIVO_MIPYMES', 'Procedimiento exclusivo para MIPYMES'),
+    ('PROC_F_PUBLICACION', 'Fecha de publicación del anuncio (Convocatoria / '
+     'Invitación / Adjudicación / Proyecto de Convocatoria)'),
+]]
+PREFIX_155_TITLE = 'DATOS GENERALES DEL PROCEDIMIENTO DE CONTRATACIÓN'
+PREFIX_155_SPEC = [(col, '\n' + label) for (col, label) in [
+    ('NUMERO_PROCEDIMIENTO', 'Número del Procedimiento (Expediente)'),
+    ('CARACTER', 'Carácter del procedimiento'),
+    ('FORMA_PROCEDIMIENTO', 'Medio o forma del procedimiento'),
+    ('_EXCLUSIVO_MIPYMES', 'Procedimiento exclusivo para MIPYMES'),
+]]
+PREFIX_155_ANEXOS_TITLE = 'ANEXOS DEL PROCEDIMIENTO DE CONTRATACIÓN'
+PROCEDIMIENTO_HEADER = ['Código', 'Título',
+                        'FECHA Y HORA LÍMITE PARA PRESENTAR PROPOSICIONES']
+RESPONSABLE_SPEC = [
+    ('NOMBRE_DE_LA_UC', 'Nombre de la Unidad Compradora (UC)'),
+    ('_NOMBRE_DEL_OPERADOR', 'Nombre del Operador en la UC'),
+    ('_CORREO_DEL_OPERADOR', 'Correo Electrónico del Operador en la UC'),
+]
+ANEXOS_HEADER = ['Nombre del archivo', 'Descripción del archivo',
+                 'Comentarios sobre Anexos', 'Ultima fecha de modificación']
+
+
+class ParseError(ValueError):
+    """Raised when an anuncio page does not have the expected layout"""
+
+
+def check(condition, message):
+    if not condition:
+        raise ParseError(message)
+
+def extract_table(items, spec, label_idx=0, value_idx=1):
+    """
+    Reads the values of a list of labelled fields.
+
+    Parameters
+    ----------
+    items : list of lxml.html.HtmlElement
+        The elements of the fields, e.g. li or tr elements
+    spec : list of tuple
+        The (column, label) of each field
+    label_idx, value_idx : int
+        The index of the children of each element with the label and the
+        value
+
+    Returns
+    -------
+    dict
+        The value of each column
+    """
+    check(len(items) == len(spec), "Expected {} fields, found {}".format(
+          len(spec), len(items)))
+    output = {}
+    for item, (col, label) in zip(items, spec):
+        found = item[label_idx].text
+        check(found == label, "Expected label {!r}, found {!r}".format(
+              label, found))
+        output[col] = item[value_idx].text
+    return(output)
+
+def parse_anexos_cp(rows):
+    """Reads the annexes of a conditionalPrefixFor_155 table"""
+    archives = []
+    for row in rows:
+        links = ANEXO_LINKS(row[3])
+        if len(links) == 0:
+            continue
+        check(len(links) == 1, "Expected one link per annex")
+        link = links[0]
+        archives.append({
+            'href': link.attrib['href'],
+            'nombre': link.attrib['title'].replace(DOWNLOAD_PREFIX, ''),
+            'tamano': SIZE_CP_RE.match(row[3][0].text_content()).group(1),
+            'descripcion': row[1].text,
+            'comentarios': row[2][0].text,
+        })
+    return(archives)
+
+def parse_anexos_od(rows):
+    """Reads the annexes of the Anexos section of the opportunity detail"""
+    header = [cell.text for cell in rows[0][1:5]]
+    check(header == ANEXOS_HEADER, "Unexpected Anexos header {!r}".format(
+          header))
+    archives = []
+    for row in rows[1:]:
+        link = row[1][1]
+        archives.append({
+            'href': link.attrib['href'],
+            'nombre': link.attrib['title'].replace(DOWNLOAD_PREFIX, ''),
+            'tamano': SIZE_OD_RE.match(row[1].text_content()).group(1),
+            'descripcion': row[2].text,
+            'comentarios': row[3].text,
+            'fecha_de_modificacion': row[4].text,
+        })
+    return(archives)
+
+def parse_anuncio(body, anuncio=None, updated=None):
+    """
+    Parses an anuncio page.
+
+    Parameters
+    ----------
+    body : bytes or str
+        The HTML of the page
+    anuncio : str, optional
+        The URL of the anuncio, stored in the ANUNCIO field
+    updated : datetime, optional
+        The time the page was fetched, stored in the _UPDATED field
+
+    Returns
+    -------
+    dict
+        The fields of a ContratoWeb. Only ANUNCIO and _UPDATED are set if
+        the anuncio is not visible.
+
+    Raises
+    ------
+    ParseError
+        Raised if the layout of the page is not the expected one
+    """
+    output = {'_UPDATED': updated, 'ANUNCIO': anuncio}
+    tree = html.fromstring(body)
+
+    main = CNT_DETAIL(tree)
+    check(len(main) > 0, "The page has no cntDetail div")
+    cnt_detail = main[0]
+
+    # check if procedimiento is not found
+    alert = ALERT(cnt_detail)
+    if len(alert) == 1 and alert[0].text_content().strip() == NOT_FOUND_ALERT:
+        return(output)
+
+    output.update(extract_table(EXPEDIENTE_ITEMS(cnt_detail), EXPEDIENTE_SPEC))
+    output.update(extract_table(ANUNCIO_ITEMS(cnt_detail), ANUNCIO_SPEC))
+
+    # conditionalPrefix table
+    # variation 1, contains only Detalles del Procedimiento section
+    rows = PREFIX_92_ROWS(cnt_detail)
+    if len(rows) > 0:
+        check(SECTION_TITLE(rows[0])[0].text == PREFIX_92_TITLE,
+              "Unexpected title of conditionalPrefixFor_92")
+        check(rows[1].attrib.get('class') == 'accessHidden',
+              "Missing accessHidden row in conditionalPrefixFor_92")
+        output.update(extract_table(rows[2:], PREFIX_92_SPEC,
+                                    label_idx=1, value_idx=3))
+    # variation 2, contains Detalles del Procedimiento and Anexos sections
+    rows = PREFIX_155_ROWS(cnt_detail)
+    if len(rows) > 0:
+        check('NUMERO_PROCEDIMIENTO' not in output,
+              "The page has both conditionalPrefix tables")
+        check(SECTION_TITLE(rows[0])[0].text == PREFIX_155_TITLE,
+              "Unexpected title of conditionalPrefixFor_155")
+        check(rows[1].attrib.get('class') == 'accessHidden',
+              "Missing accessHidden row in conditionalPrefixFor_155")
+        output.update(extract_table(rows[2:6], PREFIX_155_SPEC,
+                                    label_idx=1, value_idx=3))
+        check(SECTION_TITLE(rows[6])[0].text == PREFIX_155_ANEXOS_TITLE,
+              "Unexpected title of the annexes of conditionalPrefixFor_155")
+        check(rows[7].attrib.get('class') == 'accessHidden',
+              "Missing accessHidden row of the annexes")
+        output['_ANEXOS_CP'] = parse_anexos_cp(rows[8:])
+
+    # Opportunity detail -- includes Procedimiento, Responsable, and
+    # possibly the Anexos sections
+    opp_detail = OPP_DETAIL(cnt_detail)
+    check(len(opp_detail) > 0, "The page has no opportunityDetailForm")
+    opp_detail = opp_detail[0]
+
+    # Procedimiento section, not always present
+    rows = PROCEDIMIENTO_ROWS(opp_detail)
+    if len(rows) > 0:
+        header = [cell.text for cell in rows[0][2:5]]
+        check(header == PROCEDIMIENTO_HEADER,
+              "Unexpected Procedimiento header {!r}".format(header))
+        # the spider used to store the deadline of the first procedure for
+        # all of them, stored anuncios keep it until they are scraped again
+        output['_PROCEDIMIENTOS'] = [
+            {'codigo_procedimiento': row[2].text,
+             'titulo_procedimiento': row[3].text,
+             'fecha_limite_procedimiento': row[4].text}
+            for row in rows[1:]]
+
+    output.update(extract_table(RESPONSABLE_ITEMS(opp_detail),
+                                RESPONSABLE_SPEC))
+
+    # Anexos section, not always present
+    rows = ANEXOS_ROWS(opp_detail)
+    if len(rows) > 0:
+        output['_ANEXOS_OD'] = parse_anexos_od(rows)
+
+    return(output)
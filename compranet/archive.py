@@ -0,0 +1,189 @@
+"""
+Archive of the fetched anuncio pages.
+
+Every anuncio page fetched by the crawler is stored gzipped in ARCHIVE_DIR,
+see ArchiveMiddleware. The files are content addressed, named by the SHA256
+of the HTML, so a page that has not changed since it was last fetched is
+stored once. The anuncio_pages table indexes the archive, with the anuncio,
+the fetch time and the hash of each fetched page.
+
+When the layout of the site changes and the parser is fixed, reparse_archive
+runs the parser again over the latest page of every anuncio on all cores,
+without requesting the pages again.
+"""
+from concurrent.futures import ProcessPoolExecutor
+import gzip
+import hashlib
+import logging
+import os
+import tempfile
+
+from sqlalchemy import and_, func, select
+
+from . import settings
+from .anuncio import parse_anuncio, ParseError
+from .database import engine, get_session, AnuncioPage
+from .web import upsert_records
+
+
+logger = logging.getLogger('compranet.archive')
+
+ARCHIVE_DIR = settings.ARCHIVE_DIR
+ARCHIVE_EXT = '.html.gz'
+# number of pages parsed by each job of reparse_archive
+REPARSE_BATCH_SIZE = 200
+
+
+def page_path(sha256, archive_dir=ARCHIVE_DIR):
+    """Returns the path of a page in the archive"""
+    return(os.path.join(archive_dir, sha256[:2], sha256 + ARCHIVE_EXT))
+
+def write_page(body, archive_dir=ARCHIVE_DIR):
+    """
+    Stores the HTML of a page in the archive, unless it is already there.
+
+    The file is written to a temporary file first and then renamed, so that
+    a crawl interrupted while writing does not leave a truncated page.
+
+    Returns
+    -------
+    str
+        The hexadecimal SHA256 hash of the HTML
+    """
+    sha256 = hashlib.sha256(body).hexdigest()
+    path = page_path(sha256, archive_dir)
+    if os.path.exists(path):
+        return(sha256)
+    dirname = os.path.dirname(path)
+    os.makedirs(dirname, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=dirname, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as tmp_file:
+            with gzip.GzipFile(fileobj=tmp_file, mode='wb') as gz_file:
+                gz_file.write(body)
+        os.replace(tmp_path, path)
+    except:
+        os.remove(tmp_path)
+        raise
+    return(sha256)
+
+def read_page(sha256, archive_dir=ARCHIVE_DIR):
+    """Returns the HTML of a page in the archive"""
+    with gzip.open(page_path(sha256, archive_dir), 'rb') as gz_file:
+        return(gz_file.read())
+
+def index_pages(records, engine=engine):
+    """Adds the anuncio, _FETCHED, SHA256 and URL of pages to anuncio_pages"""
+    if len(records) == 0:
+        return
+    with engine.begin() as conn:
+        conn.execute(AnuncioPage.__table__.insert(), records)
+
+def latest_pages_query(since=None):
+    """
+    Returns the query of the latest page of each anuncio in the archive.
+
+    Parameters
+    ----------
+    since : datetime, optional
+        Only the anuncios fetched since then are selected
+    """
+    pages = AnuncioPage.__table__
+    latest = select([pages.c.ANUNCIO,
+                     func.max(pages.c._FETCHED).label('_FETCHED')])
+    if since is not None:
+        latest = latest.where(pages.c._FETCHED >= since)
+    latest = latest.group_by(pages.c.ANUNCIO).alias('latest')
+    return(select([pages.c.ANUNCIO, pages.c._FETCHED, pages.c.SHA256])
+           .select_from(pages.join(latest, and_(
+               pages.c.ANUNCIO == latest.c.ANUNCIO,
+               pages.c._FETCHED == latest.c._FETCHED))))
+
+def reparse_job(pages, archive_dir=ARCHIVE_DIR):
+    """
+    Parses pages of the archive, in a worker process of reparse_archive.
+
+    Parameters
+    ----------
+    pages : list of tuple
+        The (anuncio, fetched, sha256) of each page
+
+    Returns
+    -------
+    tuple
+        The list of parsed records, and the list of (anuncio, error message)
+        of the pages that could not be parsed
+    """
+    records = []
+    errors = []
+    for anuncio, fetched, sha256 in pages:
+        try:
+            body = read_page(sha256, archive_dir)
+            records.append(parse_anuncio(body, anuncio, fetched))
+        except (ParseError, IndexError, KeyError, AttributeError,
+                OSError) as e:
+            errors.append((anuncio, '{}: {}'.format(type(e).__name__, e)))
+    return((records, errors))
+
+def reparse_archive(jobs=None, since=None, dry_run=False,
+                    archive_dir=ARCHIVE_DIR, session=None):
+    """
+    Parses the latest archived page of each anuncio again and upserts the
+    results in contratos_web.
+
+    The pages are parsed in batches of REPARSE_BATCH_SIZE by a pool of jobs
+    processes, and each batch is written in one transaction as it is
+    parsed. The _UPDATED of each record is the time its page was fetched.
+    The rows are overwritten without copying them to contratos_web_hist,
+    since the pages were already recorded when they were scraped and a
+    change of the parser is not a change of the anuncios.
+
+    Parameters
+    ----------
+    jobs : int, optional
+        The number of worker processes, by default the number of CPUs
+    since : datetime, optional
+        Only the anuncios fetched since then are parsed
+    dry_run : bool
+        Whether to only parse the pages, without writing the results
+    archive_dir : str
+        The path of the archive directory
+    session : sqlalchemy.orm.session.Session, optional
+        An SQLAlchemy session to connect to the database
+
+    Returns
+    -------
+    dict
+        The number of pages parsed, of records written and of errors
+    """
+    if session is None:
+        session = get_session()
+    if jobs is None:
+        jobs = os.cpu_count() or 1
+    pages = [tuple(row) for row in
+             session.execute(latest_pages_query(since)).fetchall()]
+    # do not share an open database connection with the worker processes
+    session.close()
+    logger.info("Parsing {} archived pages with {} jobs...".format(
+                len(pages), jobs))
+
+    counts = {'pages': len(pages), 'written': 0, 'errors': 0}
+    batches = [pages[idx:idx + REPARSE_BATCH_SIZE]
+               for idx in range(0, len(pages), REPARSE_BATCH_SIZE)]
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        futures = [executor.submit(reparse_job, batch, archive_dir)
+                   for batch in batches]
+        for future in futures:
+            records, errors = future.result()
+            for anuncio, message in errors:
+                logger.warning("Could not parse {}: {}".format(anuncio,
+                                                               message))
+            counts['errors'] += len(errors)
+            if dry_run or len(records) == 0:
+                continue
+            upsert_records(session, records, history=False)
+            session.commit()
+            counts['written'] += len(records)
+    logger.info("Parsed {pages} pages, wrote {written} records, {errors} "
+                "errors".format(**counts))
+    return(counts)
@@ -0,0 +1,670 @@
+"""
+Benchmarks of the import of the contracts Excel files.
+
+The exports published by CompraNet are several hundred MB, so the benchmarks
+run on synthetic exports instead. generate_df builds a DataFrame with the
+columns of the ContratosXls table and values shaped like those of the real
+exports, mutate_df derives a later export from it with a given fraction of
+inserted, modified and deleted contracts, and write_xlsx writes either of
+them as an xlsx file that can be read by both engines of xlsx.parse_xlsx.
+
+run_benchmark times each stage of the import of a first export into an empty
+database and of a later export on top of it, for each number of rows. Each
+number of rows is run in a separate process so that the peak memory of the
+stages is not inflated by the previous runs, and the results are appended to
+a JSON Lines file with one record per stage, so that runs can be compared
+over time.
+
+run_parser_benchmark times the parser of the anuncio pages scraped from the
+CompraNet site, in pages per second, either on saved pages or on pages of
+both layouts generated by generate_anuncio.
+"""
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from itertools import chain
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from xml.sax.saxutils import escape
+import zipfile
+
+import numpy as np
+import pandas as pd
+from sqlalchemy import create_engine, event
+from sqlalchemy import Boolean, Date, Float, Integer
+from sqlalchemy.orm import Session
+
+from . import anuncio
+from . import cache
+from . import database
+from . import settings
+from . import xlsx
+from .database import Base, ContratoXls
+
+
+logger = logging.getLogger('compranet.benchmark')
+
+SIZES = [10000, 100000, 1000000]
+RESULTS_PATH = os.path.join(settings.INTERIM_DIR, 'benchmarks.jsonl')
+SOURCE = '2016'
+# fractions of the contracts changed by a later export
+INSERT_FRAC = 0.02
+MODIFY_FRAC = 0.05
+DELETE_FRAC = 0.01
+
+# number of distinct values of the string columns, the columns not listed
+# here are nearly unique for each contract
+CARDINALITY = {
+    'GOBIERNO': 3, 'SIGLAS': 300, 'DEPENDENCIA': 300, 'CLAVEUC': 3000,
+    'NOMBRE_DE_LA_UC': 3000, 'RESPONSABLE': 5000, 'PLANTILLA_EXPEDIENTE': 20,
+    'CARACTER': 3, 'TIPO_CONTRATACION': 5, 'TIPO_PROCEDIMIENTO': 8,
+    'FORMA_PROCEDIMIENTO': 3, 'MONEDA': 4, 'ESTATUS_CONTRATO': 4,
+    'ARCHIVADO': 2, 'CLAVE_PROGRAMA': 500, 'ESTRATIFICACION_MUC': 4,
+    'ESTRATIFICACION_MPC': 4, 'SIGLAS_PAIS': 30, 'ESTATUS_EMPRESA': 3,
+    'CUENTA_ADMINISTRADA_POR': 2, 'ORGANISMO': 50,
+}
+# fraction of empty cells of the columns that are often empty
+NULL_FRAC = {
+    'IDENTIFICADOR_CM': 0.95, 'CLAVE_CARTERA_SHCP': 0.9,
+    'APORTACION_FEDERAL': 0.8, 'RAMO': 0.3, 'CLAVE_PROGRAMA': 0.3,
+    'FOLIO_RUPC': 0.2, 'EXP_F_FALLO': 0.1, 'ORGANISMO': 0.8,
+}
+ANUNCIO_FORMAT = ('https://compranet.funcionpublica.gob.mx/esop/guest/go/'
+                  'opportunity/detail?opportunityId={}')
+FIRST_CODIGO_CONTRATO = 700000
+# number of generated anuncio pages of each layout parsed by the parser
+# benchmark
+PARSER_PAGES = 1000
+
+
+def gen_column(col, n, rs, start=0):
+    """
+    Generates the values of a column of the ContratosXls table.
+
+    Parameters
+    ----------
+    col : str
+        The name of the column
+    n : int
+        The number of values
+    rs : numpy.random.RandomState
+        The random number generator
+    start : int
+        The offset of the nearly unique values, so that the values of a later
+        export do not collide with those of an earlier one
+
+    Returns
+    -------
+    numpy.ndarray
+    """
+    col_type = ContratoXls.__table__.columns[col].type
+    if col == 'CODIGO_CONTRATO':
+        values = np.arange(start, start + n) + FIRST_CODIGO_CONTRATO
+    elif col == 'ANUNCIO':
+        ids = rs.randint(0, 1000000, n)
+        values = np.array([ANUNCIO_FORMAT.format(i) for i in ids], dtype=object)
+    elif col == 'RAMO':
+        # read as str by parse_xlsx, but stored as a number in the exports
+        values = rs.randint(1, 54, n)
+    elif col in xlsx.DATE_FORMATS:
+        days = rs.randint(0, 365 * 6, n)
+        minutes = rs.randint(0, 24 * 60, n)
+        if isinstance(col_type, Date):
+            # exported with a time of 00:00:00, if any
+            minutes[:] = 0
+        base = datetime(2010, 1, 1)
+        fmt = xlsx.DATE_FORMATS[col]
+        values = np.array([(base + timedelta(days=int(d), minutes=int(m)))
+                           .strftime(fmt) for d, m in zip(days, minutes)],
+                          dtype=object)
+    elif isinstance(col_type, Boolean):
+        values = (rs.random_sample(n) < 0.1).astype(np.int64)
+    elif isinstance(col_type, Integer):
+        values = rs.randint(100000, 2000000, n)
+    elif isinstance(col_type, Float):
+        values = np.round(rs.lognormal(12, 2, n), 2)
+    elif col in CARDINALITY:
+        pool = np.array(['{} {}'.format(col, i)
+                         for i in range(CARDINALITY[col])], dtype=object)
+        values = pool[rs.randint(0, len(pool), n)]
+    else:
+        values = np.array(['{} {}'.format(col, i)
+                           for i in range(start, start + n)], dtype=object)
+    if col in NULL_FRAC:
+        values = values.astype(object)
+        values[rs.random_sample(n) < NULL_FRAC[col]] = None
+    return(values)
+
+def gen_changed_column(col, current, rs, start=0):
+    """
+    Generates values of a column of the ContratosXls table that differ from
+    its current values.
+
+    Parameters
+    ----------
+    col : str
+        The name of the column
+    current : numpy.ndarray
+        The current values of the column
+    rs : numpy.random.RandomState
+        The random number generator
+    start : int
+        The offset of the nearly unique values, see gen_column
+
+    Returns
+    -------
+    numpy.ndarray
+    """
+    current = np.asarray(current, dtype=object)
+    if isinstance(ContratoXls.__table__.columns[col].type, Boolean):
+        return(np.array([0 if value else 1 for value in current]))
+    values = gen_column(col, len(current), rs, start)
+    same = np.flatnonzero(values.astype(object) == current)
+    # draw again the values that happen to be the current ones, which for
+    # the columns with few distinct values is a large fraction of them
+    while len(same) > 0:
+        values[same] = gen_column(col, len(same), rs, start)
+        same = same[values[same].astype(object) == current[same]]
+    return(values)
+
+def generate_df(n, seed=0, start=0):
+    """
+    Generates a synthetic contracts DataFrame.
+
+    Parameters
+    ----------
+    n : int
+        The number of contracts
+    seed : int
+        The seed of the random number generator
+    start : int
+        The offset of the CODIGO_CONTRATO values
+
+    Returns
+    -------
+    pandas.DataFrame
+        A DataFrame with the columns of a contracts Excel file, in the order
+        of the ContratosXls table
+    """
+    rs = np.random.RandomState(seed)
+    cols = xlsx.fingerprint_cols()
+    return(pd.DataFrame({col: gen_column(col, n, rs, start) for col in cols},
+                        columns=cols))
+
+def mutate_df(df, insert_frac=INSERT_FRAC, modify_frac=MODIFY_FRAC,
+              delete_frac=DELETE_FRAC, seed=1):
+    """
+    Derives a later export from a synthetic contracts DataFrame.
+
+    Parameters
+    ----------
+    df : pandas.DataFrame
+        A DataFrame built with generate_df
+    insert_frac, modify_frac, delete_frac : float
+        The number of inserted, modified and deleted contracts, as a fraction
+        of the contracts in df
+    seed : int
+        The seed of the random number generator
+
+    Returns
+    -------
+    pandas.DataFrame
+    """
+    rs = np.random.RandomState(seed)
+    n = len(df)
+    order = rs.permutation(n)
+    n_delete = int(n * delete_frac)
+    n_modify = int(n * modify_frac)
+    n_insert = int(n * insert_frac)
+    deleted = order[:n_delete]
+    modified = order[n_delete:n_delete + n_modify]
+    df = df.copy()
+    # change one column of each modified contract, cycling through mod_cols
+    mod_cols = ['ESTATUS_CONTRATO', 'IMPORTE_CONTRATO', 'FECHA_FIN',
+                'TITULO_CONTRATO', 'CONVENIO_MODIFICATORIO']
+    for idx, col in enumerate(mod_cols):
+        rows = modified[idx::len(mod_cols)]
+        col_idx = df.columns.get_loc(col)
+        new_values = gen_changed_column(col, df.iloc[rows, col_idx].values, rs,
+                                        start=2 * n)
+        df.iloc[rows, col_idx] = new_values
+    df = df.drop(df.index[deleted])
+    new_start = int(df['CODIGO_CONTRATO'].max()) - FIRST_CODIGO_CONTRATO + 1
+    inserted = generate_df(n_insert, seed=seed + 1, start=new_start)
+    return(pd.concat([df, inserted], ignore_index=True))
+
+def col_letter(idx):
+    """Converts a 0-based column index to a column letter such as 'AB'"""
+    letters = ''
+    idx += 1
+    while idx > 0:
+        idx, rem = divmod(idx - 1, 26)
+        letters = chr(ord('A') + rem) + letters
+    return(letters)
+
+CONTENT_TYPES_XML = """<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">
+<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>
+<Default Extension="xml" ContentType="application/xml"/>
+<Override PartName="/xl/workbook.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>
+<Override PartName="/xl/worksheets/sheet1.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>
+<Override PartName="/xl/sharedStrings.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sharedStrings+xml"/>
+</Types>"""
+RELS_XML = """<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">
+<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" Target="xl/workbook.xml"/>
+</Relationships>"""
+WORKBOOK_XML = """<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships">
+<sheets><sheet name="Sheet1" sheetId="1" r:id="rId1"/></sheets>
+</workbook>"""
+WORKBOOK_RELS_XML = """<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">
+<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet" Target="worksheets/sheet1.xml"/>
+<Relationship Id="rId2" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/sharedStrings" Target="sharedStrings.xml"/>
+</Relationships>"""
+SHEET_HEAD = ('<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+              '<worksheet xmlns="http://schemas.openxmlformats.org/'
+              'spreadsheetml/2006/main"><sheetData>')
+SHEET_TAIL = '</sheetData></worksheet>'
+STRINGS_HEAD = ('<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+                '<sst xmlns="http://schemas.openxmlformats.org/spreadsheetml/'
+                '2006/main" count="{count}" uniqueCount="{unique}">')
+STRINGS_TAIL = '</sst>'
+
+def write_xlsx(df, pathname):
+    """
+    Writes a contracts DataFrame as an xlsx file with shared strings.
+
+    The worksheet and the shared strings table are written row by row to
+    temporary files, which are then added to the xlsx archive, so that the
+    XML of the whole worksheet is never held in memory.
+
+    Parameters
+    ----------
+    df : pandas.DataFrame
+        A DataFrame built with generate_df or mutate_df
+    pathname : str
+        The path of the xlsx file
+    """
+    letters = [col_letter(idx) for idx in range(len(df.columns))]
+    strings = {}
+    n_strings = 0
+    tmp_dir = tempfile.mkdtemp(dir=os.path.dirname(os.path.abspath(pathname)))
+    try:
+        sheet_path = os.path.join(tmp_dir, 'sheet1.xml')
+        strings_path = os.path.join(tmp_dir, 'sharedStrings.xml')
+        with open(sheet_path, 'w', encoding='utf-8') as sheet:
+            sheet.write(SHEET_HEAD)
+            rows = chain([df.columns], df.itertuples(index=False))
+            for row_num, values in enumerate(rows, 1):
+                cells = []
+                for letter, value in zip(letters, values):
+                    if value is None or (isinstance(value, float) and
+                                         np.isnan(value)):
+                        continue
+                    ref = '{}{}'.format(letter, row_num)
+                    if isinstance(value, str):
+                        idx = strings.setdefault(value, len(strings))
+                        n_strings += 1
+                        cells.append('<c r="{}" t="s"><v>{}</v></c>'.format(
+                                     ref, idx))
+                    else:
+                        cells.append('<c r="{}"><v>{!r}</v></c>'.format(
+                                     ref, value.item() if hasattr(value, 'item')
+                                     else value))
+                sheet.write('<row r="{}">{}</row>'.format(row_num,
+                                                          ''.join(cells)))
+            sheet.write(SHEET_TAIL)
+        with open(strings_path, 'w', encoding='utf-8') as sst:
+            sst.write(STRINGS_HEAD.format(count=n_strings, unique=len(strings)))
+            for value in strings:
+                sst.write('<si><t>{}</t></si>'.format(escape(value)))
+            sst.write(STRINGS_TAIL)
+        del strings
+        with zipfile.ZipFile(pathname, 'w', zipfile.ZIP_DEFLATED) as zf:
+            zf.writestr('[Content_Types].xml', CONTENT_TYPES_XML)
+            zf.writestr('_rels/.rels', RELS_XML)
+            zf.writestr('xl/workbook.xml', WORKBOOK_XML)
+            zf.writestr('xl/_rels/workbook.xml.rels', WORKBOOK_RELS_XML)
+            zf.write(sheet_path, 'xl/worksheets/sheet1.xml')
+            zf.write(strings_path, 'xl/sharedStrings.xml')
+    finally:
+        shutil.rmtree(tmp_dir)
+
+def export_pathname(out_dir, updated, source=SOURCE):
+    """Returns the path of a synthetic export, named as CompraNet names them"""
+    filename = 'Contratos{}_{:%y%m%d%H%M%S}.xlsx'.format(source, updated)
+    return(os.path.join(out_dir, filename))
+
+ANUNCIO_PAGE_HTML = """<!DOCTYPE html>
+<html><head><meta http-equiv="Content-Type" content="text/html; charset=utf-8">
+<title>CompraNet</title></head>
+<body><div id="header"><ul class="menu">{menu}</ul></div>
+<div id="main"><div id="cnt"><div id="cntDetail">
+<h3>Detalles del Expediente</h3>
+<div class="form_container"><ul>{expediente}</ul></div>
+<h3>Detalles del Anuncio</h3>
+<div class="form_container"><ul>{anuncio}</ul></div>
+{prefix}
+<form name="opportunityDetailForm" method="post"><div>
+<h3> Procedimiento </h3>
+<table class="list-table">
+<tr><th></th><th></th><th>Código</th><th>Título</th><th>FECHA Y HORA LÍMITE PARA PRESENTAR PROPOSICIONES</th></tr>
+{procedimientos}
+</table>
+<h3>Responsable de la Unidad Compradora</h3>
+<div class="form_container"><ul>{responsable}</ul></div>
+<h3>Anexos</h3>
+<table class="list-table">
+<tr><th></th><td>Nombre del archivo</td><td>Descripción del archivo</td><td>Comentarios sobre Anexos</td><td>Ultima fecha de modificación</td></tr>
+{anexos_od}
+</table>
+</div></form>
+</div></div></div>
+<div id="footer">{footer}</div></body></html>
+"""
+LI_HTML = '<li><label>{}</label><div class="field">{}</div></li>'
+PREFIX_ROW_HTML = ('<tr><td class="icon"></td><td>\n{}</td><td>:</td>'
+                   '<td>{}</td></tr>')
+
+def generate_anuncio(layout, rs, idx=0):
+    """
+    Generates an anuncio page with the structure of the CompraNet pages.
+
+    Parameters
+    ----------
+    layout : int
+        92 or 155, the id of the conditionalPrefixFor table of the page
+    rs : numpy.random.RandomState
+        The random number generator
+    idx : int
+        The number of the page, used to build unique values
+
+    Returns
+    -------
+    bytes
+        The HTML of the page, which anuncio.parse_anuncio can parse
+    """
+    def text(prefix, words=8):
+        return(escape('{} {} '.format(prefix, idx) + ' '.join(
+            'palabra{}'.format(w) for w in rs.randint(0, 5000, words))))
+
+    def items(spec):
+        return(''.join(LI_HTML.format(escape(label), text(col))
+                       for col, label in spec))
+
+    def prefix_rows(spec):
+        return(''.join(PREFIX_ROW_HTML.format(escape(label.lstrip('\n')),
+                                              text(col, 2))
+                       for col, label in spec))
+
+    def size():
+        return('{:,} KB'.format(rs.randint(1, 20000)))
+
+    if layout == 92:
+        prefix = ('<table id="conditionalPrefixFor_92">'
+                  '<tr><th colspan="4"><h4>{}</h4></th></tr>'
+                  '<tr class="accessHidden"><th>Campo</th><th>Valor</th></tr>'
+                  '{}</table>'.format(escape(anuncio.PREFIX_92_TITLE),
+                                      prefix_rows(anuncio.PREFIX_92_SPEC)))
+    elif layout == 155:
+        anexos = ''.join(
+            '<tr><td></td><td>{desc}</td><td><span>{com}</span></td>'
+            '<td><span>archivo{n}.pdf <a href="/esop/file/{idx}/{n}" '
+            'title="{prefix}archivo{n}.pdf">descargar</a> ({size})</span>'
+            '</td></tr>'.format(desc=text('Anexo'), com=text('Comentario', 3),
+                                n=n, idx=idx, size=size(),
+                                prefix=anuncio.DOWNLOAD_PREFIX)
+            for n in range(rs.randint(1, 6)))
+        prefix = ('<table id="conditionalPrefixFor_155">'
+                  '<tr><th colspan="4"><h4>{}</h4></th></tr>'
+                  '<tr class="accessHidden"><th>Campo</th><th>Valor</th></tr>'
+                  '{}'
+                  '<tr><th colspan="4"><h4>{}</h4></th></tr>'
+                  '<tr class="accessHidden"><th>Anexo</th><th>Archivo</th></tr>'
+                  '{}</table>'.format(escape(anuncio.PREFIX_155_TITLE),
+                                      prefix_rows(anuncio.PREFIX_155_SPEC),
+                                      escape(anuncio.PREFIX_155_ANEXOS_TITLE),
+                                      anexos))
+    else:
+        raise ValueError("Unknown layout {}".format(layout))
+    procedimientos = ''.join(
+        '<tr><td></td><td></td><td>{}</td><td>{}</td><td>{}</td></tr>'.format(
+            'PC-{}-{}'.format(idx, n), text('Procedimiento', 4),
+            '{:%d/%m/%Y %H:%M}'.format(datetime(2016, 1, 1) +
+                                       timedelta(hours=int(rs.randint(10000)))))
+        for n in range(rs.randint(1, 3)))
+    anexos_od = ''.join(
+        '<tr><td></td><td><img src="/img/file.gif"/><a href="/esop/od/{idx}/{n}" '
+        'title="{prefix}doc{n}.pdf">doc{n}.pdf</a> ({size})</td>'
+        '<td>{desc}</td><td>{com}</td><td>01/02/2016 10:00</td></tr>'.format(
+            idx=idx, n=n, size=size(), prefix=anuncio.DOWNLOAD_PREFIX,
+            desc=text('Documento'), com=text('Comentario', 3))
+        for n in range(rs.randint(0, 6)))
+    page = ANUNCIO_PAGE_HTML.format(
+        menu=''.join('<li><a href="/m{0}">Menu {0}</a></li>'.format(n)
+                     for n in range(30)),
+        expediente=items(anuncio.EXPEDIENTE_SPEC),
+        anuncio=items(anuncio.ANUNCIO_SPEC),
+        prefix=prefix,
+        procedimientos=procedimientos,
+        responsable=items(anuncio.RESPONSABLE_SPEC),
+        anexos_od=anexos_od,
+        footer=text('Pie', 200))
+    return(page.encode('utf-8'))
+
+def read_pages(pages_dir):
+    """Reads the saved .html pages in a directory, grouped by layout"""
+    pages = {}
+    for filename in sorted(os.listdir(pages_dir)):
+        if not filename.endswith('.html'):
+            continue
+        with open(os.path.join(pages_dir, filename), 'rb') as infile:
+            body = infile.read()
+        if b'conditionalPrefixFor_155' in body:
+            layout = '155'
+        elif b'conditionalPrefixFor_92' in body:
+            layout = '92'
+        else:
+            layout = 'other'
+        pages.setdefault(layout, []).append(body)
+    return(pages)
+
+def peak_rss_mb():
+    """Returns the peak resident memory of the process in MB"""
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kB elsewhere
+    if sys.platform == 'darwin':
+        return(maxrss / 1024**2)
+    return(maxrss / 1024)
+
+@contextmanager
+def timed(results, stage, rows):
+    """Appends the elapsed time and peak memory of a stage to results"""
+    start = time.perf_counter()
+    yield
+    seconds = time.perf_counter() - start
+    results.append({'stage': stage,
+                    'rows': rows,
+                    'seconds': round(seconds, 4),
+                    'rows_per_sec': round(rows / seconds, 1) if seconds else None,
+                    'peak_rss_mb': round(peak_rss_mb(), 1)})
+    logger.info("{} rows, {}: {:.2f} s".format(rows, stage, seconds))
+
+def run_size(n, work_dir, seed=0, xlrd=False):
+    """
+    Times the stages of the import of synthetic exports of n contracts.
+
+    A first export is imported into an empty SQLite database, then a later
+    export derived from it with mutate_df is imported on top of it.
+
+    Returns
+    -------
+    list of dict
+        The stage, number of rows, elapsed seconds, rows per second and peak
+        memory in MB of each stage
+    """
+    results = []
+    out_dir = tempfile.mkdtemp(dir=work_dir)
+    try:
+        first_path = export_pathname(out_dir, datetime(2016, 10, 1, 6))
+        later_path = export_pathname(out_dir, datetime(2016, 10, 2, 6))
+        with timed(results, 'generate', n):
+            df = generate_df(n, seed)
+            df_later = mutate_df(df, seed=seed + 1)
+            write_xlsx(df, first_path)
+            write_xlsx(df_later, later_path)
+        del df, df_later
+
+        with timed(results, 'hash', n):
+            sha256 = xlsx.hashfile(first_path)
+        with timed(results, 'parse', n):
+            df_new = xlsx.xlsx2df(first_path, sha256=sha256, use_cache=False)
+        if xlrd:
+            with timed(results, 'parse_xlrd', n):
+                xlsx.parse_xlsx(first_path, 'xlrd')
+        with timed(results, 'drop_dup', n):
+            xlsx.drop_dup(df_new)
+        with timed(results, 'fingerprint', n):
+            xlsx.fingerprint(df_new)
+        cache_dir = os.path.join(out_dir, 'cache')
+        with timed(results, 'cache_write', n):
+            cache.write_cache(df_new, sha256, cache_dir)
+        with timed(results, 'cache_read', n):
+            cache.read_cache(sha256, cache_dir)
+
+        db_engine = create_engine('sqlite:///' +
+                                  os.path.join(out_dir, 'benchmark.db'))
+        event.listen(db_engine, 'connect', database.set_pragmas)
+        Base.metadata.create_all(db_engine)
+        session = Session(bind=db_engine)
+        with database.profile('bulk-load', [session]):
+            with timed(results, 'load_initial', n):
+                xlsx.load_source_df(df_new, sha256, session)
+            del df_new
+            sha256 = xlsx.hashfile(later_path)
+            with timed(results, 'parse_later', n):
+                df_new = xlsx.xlsx2df(later_path, sha256=sha256,
+                                      use_cache=False)
+            with timed(results, 'load_later', n):
+                xlsx.load_source_df(df_new, sha256, session)
+        session.close()
+        db_engine.dispose()
+    finally:
+        shutil.rmtree(out_dir)
+    return(results)
+
+def git_revision():
+    """Returns the current git commit of the repository, if any"""
+    try:
+        out = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                      cwd=os.path.dirname(__file__),
+                                      stderr=subprocess.DEVNULL)
+        return(out.decode().strip())
+    except (OSError, subprocess.CalledProcessError):
+        return(None)
+
+def run_benchmark(sizes=SIZES, results_path=RESULTS_PATH, work_dir=None,
+                  seed=0, xlrd=False):
+    """
+    Runs the import benchmarks and appends the results to a JSON Lines file.
+
+    Parameters
+    ----------
+    sizes : list of int
+        The numbers of contracts of the synthetic exports
+    results_path : str
+        The path of the JSON Lines file where the results are appended
+    work_dir : str, optional
+        The directory where the synthetic exports and database are written,
+        by default the system temporary directory
+    seed : int
+        The seed of the random number generator
+    xlrd : bool
+        Whether to also time the xlrd engine, which is much slower
+
+    Returns
+    -------
+    list of dict
+        The records appended to results_path
+    """
+    run = {'run': datetime.now().strftime('%Y-%m-%dT%H:%M:%S'),
+           'revision': git_revision(),
+           'python': platform.python_version(),
+           'pandas': pd.__version__,
+           'seed': seed}
+    records = []
+    for n in sizes:
+        # a new process for each size, so that peak memory is per size
+        with multiprocessing.Pool(1, maxtasksperchild=1) as pool:
+            results = pool.apply(run_size, (n, work_dir, seed, xlrd))
+        records.extend(dict(run, **res) for res in results)
+    os.makedirs(os.path.dirname(os.path.abspath(results_path)), exist_ok=True)
+    with open(results_path, 'a') as outfile:
+        for rec in records:
+            outfile.write(json.dumps(rec) + '\n')
+    return(records)
+
+def run_parser_benchmark(pages_dir=None, count=PARSER_PAGES, repeat=3,
+                         results_path=RESULTS_PATH, seed=0):
+    """
+    Times anuncio.parse_anuncio and appends the results to a JSON Lines
+    file.
+
+    Parameters
+    ----------
+    pages_dir : str, optional
+        A directory of anuncio pages saved as .html files. By default count
+        pages of each layout are generated with generate_anuncio.
+    count : int
+        The number of generated pages of each layout
+    repeat : int
+        The number of times each page is parsed, the fastest pass is kept
+
+    Returns
+    -------
+    list of dict
+        The records appended to results_path, with the pages per second of
+        each layout in rows_per_sec
+    """
+    if pages_dir is None:
+        rs = np.random.RandomState(seed)
+        pages = {str(layout): [generate_anuncio(layout, rs, idx)
+                               for idx in range(count)]
+                 for layout in (92, 155)}
+    else:
+        pages = read_pages(pages_dir)
+    run = {'run': datetime.now().strftime('%Y-%m-%dT%H:%M:%S'),
+           'revision': git_revision(),
+           'python': platform.python_version(),
+           'pages_dir': pages_dir}
+    records = []
+    for layout, bodies in sorted(pages.items()):
+        passes = []
+        for _ in range(repeat):
+            results = []
+            with timed(results, 'parse_anuncio ({})'.format(layout),
+                       len(bodies)):
+                for body in bodies:
+                    try:
+                        anuncio.parse_anuncio(body)
+                    except anuncio.ParseError:
+                        logger.exception("Error parsing a {} page".format(
+                                         layout))
+            passes.extend(results)
+        best = min(passes, key=lambda res: res['seconds'])
+        records.append(dict(run, **best))
+    os.makedirs(os.path.dirname(os.path.abspath(results_path)), exist_ok=True)
+    with open(results_path, 'a') as outfile:
+        for rec in records:
+            outfile.write(json.dumps(rec) + '\n')
+    return(records)
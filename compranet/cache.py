@@ -0,0 +1,145 @@
+"""
+Cache of parsed contracts Excel files.
+
+Parsing the contracts Excel files is by far the slowest step of an import,
+so the parsed and deduplicated DataFrames are cached in CACHE_DIR. Each entry
+is an uncompressed .npz file holding one array per column, keyed by the
+SHA256 of the Excel file and by CACHE_VERSION, which must be incremented
+whenever the parsing changes the contents of the DataFrame. The least
+recently used entries are evicted once the cache is larger than
+CACHE_MAX_SIZE.
+"""
+from collections import OrderedDict
+from datetime import datetime
+import logging
+import os
+
+import numpy as np
+import pandas as pd
+
+from . import settings
+
+
+logger = logging.getLogger('compranet.cache')
+
+CACHE_DIR = settings.CACHE_DIR
+CACHE_MAX_SIZE = settings.CACHE_MAX_SIZE
+CACHE_VERSION = 3
+CACHE_EXT = '.npz'
+
+
+def cache_path(sha256, cache_dir=CACHE_DIR, version=CACHE_VERSION):
+    """Returns the path of the cache entry for a file hash"""
+    filename = '{}-v{}{}'.format(sha256, version, CACHE_EXT)
+    return(os.path.join(cache_dir, filename))
+
+def read_cache(sha256, cache_dir=CACHE_DIR):
+    """
+    Reads a parsed DataFrame from the cache.
+
+    Parameters
+    ----------
+    sha256 : str
+        The hexadecimal SHA256 hash of the Excel file
+    cache_dir : str
+        The path of the cache directory
+
+    Returns
+    -------
+    pandas.DataFrame or None
+        The cached DataFrame, or None if it is not in the cache
+    """
+    path = cache_path(sha256, cache_dir)
+    if not os.path.exists(path):
+        return(None)
+    try:
+        with np.load(path, allow_pickle=True) as data:
+            columns = data['__columns__'].tolist()
+            df = pd.DataFrame(OrderedDict(
+                (col, data['c{}'.format(idx)])
+                for idx, col in enumerate(columns)))
+    except:
+        logger.exception("Error reading cache entry {}".format(path))
+        return(None)
+    # update the modification time, which is used for the eviction order
+    os.utime(path)
+    logger.info("Read {} rows from the cache".format(len(df)))
+    return(df)
+
+def write_cache(df, sha256, cache_dir=CACHE_DIR, max_size=CACHE_MAX_SIZE):
+    """
+    Writes a parsed DataFrame to the cache and evicts old entries.
+
+    Parameters
+    ----------
+    df : pandas.DataFrame
+        A DataFrame parsed from a contracts Excel file
+    sha256 : str
+        The hexadecimal SHA256 hash of the Excel file
+    cache_dir : str
+        The path of the cache directory
+    max_size : int
+        The maximum size of the cache in bytes
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    path = cache_path(sha256, cache_dir)
+    tmp_path = path + '.tmp'
+    arrays = {'c{}'.format(idx): df[col].values
+              for idx, col in enumerate(df.columns)}
+    arrays['__columns__'] = np.array([str(col) for col in df.columns])
+    with open(tmp_path, 'wb') as outfile:
+        np.savez(outfile, **arrays)
+    os.replace(tmp_path, path)
+    evict(cache_dir, max_size)
+
+def list_cache(cache_dir=CACHE_DIR):
+    """
+    Lists the entries in the cache, most recently used first.
+
+    Returns
+    -------
+    list of dict
+        The sha256, version, size in bytes, last use time and path of each
+        cache entry
+    """
+    if not os.path.isdir(cache_dir):
+        return([])
+    entries = []
+    for filename in os.listdir(cache_dir):
+        if not filename.endswith(CACHE_EXT):
+            continue
+        path = os.path.join(cache_dir, filename)
+        sha256, _, version = filename[:-len(CACHE_EXT)].rpartition('-v')
+        stat = os.stat(path)
+        entries.append({'sha256': sha256,
+                        'version': int(version),
+                        'size': stat.st_size,
+                        'used': datetime.fromtimestamp(stat.st_mtime),
+                        'path': path})
+    entries.sort(key=lambda e: e['used'], reverse=True)
+    return(entries)
+
+def evict(cache_dir=CACHE_DIR, max_size=CACHE_MAX_SIZE):
+    """
+    Deletes stale and least recently used entries from the cache.
+
+    Entries written with an older CACHE_VERSION are always deleted. The
+    remaining entries are deleted, least recently used first, until the
+    cache is no larger than max_size.
+    """
+    total_size = 0
+    for entry in list_cache(cache_dir):
+        total_size += entry['size']
+        if entry['version'] != CACHE_VERSION or total_size > max_size:
+            logger.info("Evicting {} from the cache".format(entry['sha256']))
+            try:
+                os.remove(entry['path'])
+            except FileNotFoundError:
+                # already evicted by another process
+                pass
+            total_size -= entry['size']
+
+def clear_cache(cache_dir=CACHE_DIR):
+    """Deletes all the entries in the cache"""
+    for entry in list_cache(cache_dir):
+        os.remove(entry['path'])
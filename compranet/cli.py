@@ -1,12 +1,22 @@
+from datetime import datetime, timedelta
 import logging
 import os
 
 import click
 from crontab import CronTab, CronSlices
 
+from . import archive
+from . import benchmark
+from . import cache
 from . import database
+from . import frontier
+from . import history
+from . import queryplan
 from . import settings
-from .xlsx import fetch_xlsx, load_xlsx, pull_xlsx
+from . import storage
+from . import utils
+from . import web
+from .xlsx import fetch_xlsx, load_xlsx_many, pull_xlsx, update_fingerprints
 
 
 @click.group()
@@ -19,30 +29,316 @@ def cli(email_log):
 
 @click.command('fetch_xlsx',
                short_help="Check for updated xlsx files and download them.")
-def fetch_xlsx_cmd():
+@click.option('--extract', is_flag=True,
+              help="Extract the XLSX file instead of keeping the zip file.")
+def fetch_xlsx_cmd(extract):
     """Check the timestamps of the Excel archive URLs to see if they have been
-    updated. When there is a newer version, download the zip file and extract
-    the XLSX file."""
-    fetch_xlsx()
+    updated. When there is a newer version, download the zip file. The XLSX
+    file is read directly from the zip file unless --extract is given."""
+    fetch_xlsx(extract=extract)
 
 @click.command('load_xlsx',
                short_help="Process and load updates from Excel file.")
 @click.argument('paths', metavar='[FILE]...', nargs=-1,
                 type=click.Path(exists=True, dir_okay=False))
-def load_xlsx_cmd(paths):
+@click.option('--engine', type=click.Choice(['stream', 'xlrd']),
+              default='stream', show_default=True,
+              help="Reader used to parse the Excel files.")
+@click.option('--force', is_flag=True,
+              help="Load files even if they have already been loaded.")
+@click.option('--jobs', '-j', type=click.IntRange(min=1), default=1,
+              show_default=True,
+              help="Number of processes parsing the Excel files.")
+def load_xlsx_cmd(paths, engine, force, jobs):
     """Read the data from the Excel file located at FILE, calculate the
-    changes, and import these to the database."""
-    for path in paths:
-        load_xlsx(path)
+    changes, and import these to the database. FILE may also be the zip
+    file downloaded from CompraNet. Files that have already been loaded are
+    skipped unless --force is given. With --jobs, the files are parsed in
+    parallel and imported in order of source year and export time."""
+    load_xlsx_many(paths, engine=engine, force=force, jobs=jobs)
 
 @click.command('pull_xlsx',
                short_help="Download, process, and load updated Excel files.")
-def pull_xlsx_cmd():
+@click.option('--engine', type=click.Choice(['stream', 'xlrd']),
+              default='stream', show_default=True,
+              help="Reader used to parse the Excel files.")
+@click.option('--force', is_flag=True,
+              help="Load files even if they have already been loaded.")
+@click.option('--jobs', '-j', type=click.IntRange(min=1), default=1,
+              show_default=True,
+              help="Number of processes parsing the Excel files.")
+def pull_xlsx_cmd(engine, force, jobs):
     """Check the timestamps of the Excel archive URLs to see if they have been
-    updated. When there is a newer version, download the zip file and extract
-    the XLSX file. Read the extracted Excel files, calculate the changes for
+    updated. When there is a newer version, download the zip file. Read the
+    Excel files from the downloaded zip files, calculate the changes for
     each file, and import them to the database."""
-    pull_xlsx()
+    pull_xlsx(engine=engine, force=force, jobs=jobs)
+
+@click.command('cache', short_help="Inspect or clear the parsed Excel cache.")
+@click.option('--clear', is_flag=True,
+              help="Delete all the entries in the cache.")
+def cache_cmd(clear):
+    """List the entries of the cache of parsed Excel files, most recently
+    used first, or delete them with --clear."""
+    if clear:
+        cache.clear_cache()
+        return
+    entries = cache.list_cache()
+    total_size = 0
+    for entry in entries:
+        total_size += entry['size']
+        print("{}  v{}  {:>9.1f} MB  {:%Y-%m-%d %H:%M}".format(
+              entry['sha256'], entry['version'], entry['size'] / 1024**2,
+              entry['used']))
+    print("{} entries, {:.1f} MB of {:.1f} MB".format(
+          len(entries), total_size / 1024**2, cache.CACHE_MAX_SIZE / 1024**2))
+
+@click.command('update_fingerprints',
+               short_help="Compute the fingerprints of the stored contracts.")
+@click.option('--source', help="Source year to update, e.g. 2016. Defaults "
+                               "to all of them.")
+def update_fingerprints_cmd(source):
+    """Compute the fingerprint of every contract in the database again, for
+    example after a change of the columns or of their normalization.
+    Otherwise the next import of each source year compares the contracts
+    whose fingerprint differs in full and stores their fingerprints."""
+    update_fingerprints(source=source)
+
+@click.command('check_query_plans',
+               short_help="Check that no query scans a full table.")
+@click.option('--models', is_flag=True,
+              help="Check an empty database created from the models instead "
+                   "of the configured database.")
+@click.option('--verbose', '-v', is_flag=True,
+              help="Print the plan of every query.")
+def check_query_plans_cmd(models, verbose):
+    """Run EXPLAIN QUERY PLAN on the queries of the xlsx loader and the web
+    scraper, and fail if any of them scans a contract table without a
+    covering index."""
+    if models:
+        results = queryplan.check_models()
+    else:
+        results = queryplan.check_query_plans()
+    failed = [res for res in results if res['scans']]
+    for res in results:
+        if verbose or res['scans']:
+            status = 'FULL SCAN' if res['scans'] else 'ok'
+            print("{}: {}".format(res['name'], status))
+            for line in res['plan']:
+                print("    {}".format(line))
+    if failed:
+        raise click.ClickException("{} of {} queries scan a full table".format(
+                                   len(failed), len(results)))
+    print("{} queries checked, no full table scans".format(len(results)))
+
+@click.command('benchmark',
+               short_help="Time the import of synthetic Excel exports.")
+@click.option('--rows', '-n', type=click.IntRange(min=1), multiple=True,
+              help="Number of contracts of the synthetic exports, may be "
+                   "repeated. Defaults to 10000, 100000 and 1000000.")
+@click.option('--output', '-o', type=click.Path(dir_okay=False),
+              default=benchmark.RESULTS_PATH, show_default=True,
+              help="JSON Lines file where the results are appended.")
+@click.option('--work-dir', type=click.Path(file_okay=False, exists=True),
+              help="Directory for the synthetic exports and database.")
+@click.option('--seed', type=int, default=0, show_default=True,
+              help="Seed of the synthetic data generator.")
+@click.option('--xlrd', is_flag=True,
+              help="Also time parsing with the xlrd engine.")
+def benchmark_cmd(rows, output, work_dir, seed, xlrd):
+    """Generate synthetic contracts Excel exports of each size, time each
+    stage of importing a first export into an empty database and a later
+    export with inserted, modified and deleted contracts on top of it, and
+    append the timings and peak memory of each stage to OUTPUT."""
+    records = benchmark.run_benchmark(rows or benchmark.SIZES, output,
+                                      work_dir, seed, xlrd)
+    for rec in records:
+        print("{rows:>9} rows  {stage:<13} {seconds:>9.2f} s  "
+              "{peak_rss_mb:>8.1f} MB".format(**rec))
+
+@click.command('benchmark_parser',
+               short_help="Time the parser of the anuncio pages.")
+@click.option('--pages', 'pages_dir', type=click.Path(file_okay=False,
+                                                      exists=True),
+              help="Directory of anuncio pages saved as .html files. By "
+                   "default pages of both layouts are generated.")
+@click.option('--count', '-n', type=click.IntRange(min=1),
+              default=benchmark.PARSER_PAGES, show_default=True,
+              help="Number of generated pages of each layout.")
+@click.option('--repeat', type=click.IntRange(min=1), default=3,
+              show_default=True,
+              help="Number of passes over the pages, the fastest is kept.")
+@click.option('--output', '-o', type=click.Path(dir_okay=False),
+              default=benchmark.RESULTS_PATH, show_default=True,
+              help="JSON Lines file where the results are appended.")
+def benchmark_parser_cmd(pages_dir, count, repeat, output):
+    """Parse anuncio pages of the conditionalPrefixFor_92 and _155 layouts
+    without network access, and append the pages per second of each layout
+    to OUTPUT."""
+    records = benchmark.run_parser_benchmark(pages_dir, count, repeat, output)
+    for rec in records:
+        print("{rows:>7} pages  {stage:<21} {seconds:>8.2f} s  "
+              "{rows_per_sec:>8.1f} pages/s".format(**rec))
+
+@click.command('storage',
+               short_help="Show or switch the storage mode of the contracts.")
+@click.argument('mode', required=False,
+                type=click.Choice(['flat', 'normalized']))
+@click.option('--no-vacuum', is_flag=True,
+              help="Do not rebuild the database file after switching.")
+def storage_cmd(mode, no_vacuum):
+    """Show the storage mode of the contract tables, or switch it to MODE.
+    In normalized mode the repeated strings of the contract tables are
+    stored once in a lookup table, and the contract tables become views
+    with their usual columns. Back up the database before switching, since
+    the switch is not atomic, and switch to flat mode before upgrading the
+    database with alembic."""
+    with database.engine.connect() as conn:
+        normalized = storage.is_normalized(conn)
+    if mode == 'normalized' and not normalized:
+        storage.normalize(vacuum=not no_vacuum)
+    elif mode == 'flat' and normalized:
+        storage.flatten(vacuum=not no_vacuum)
+    with database.engine.connect() as conn:
+        current = 'normalized' if storage.is_normalized(conn) else 'flat'
+    print("Storage mode: {}, database size: {:.1f} MB".format(
+          current, storage.db_size() / 1024**2))
+
+@click.command('snapshot',
+               short_help="Export the contracts of a source year at a past "
+                          "export.")
+@click.argument('source')
+@click.argument('as_of', required=False)
+@click.option('--format', 'fmt', type=click.Choice(['jsonl', 'csv']),
+              default='jsonl', show_default=True,
+              help="Output format.")
+@click.option('--output', '-o', type=click.File('w'), default='-',
+              help="File where the contracts are written, by default the "
+                   "standard output.")
+def snapshot_cmd(source, as_of, fmt, output):
+    """Write the contracts of the SOURCE year as they were in the export
+    loaded at AS_OF, given as YYYY-MM-DD HH:MM:SS. Without AS_OF, list the
+    times of the exports of SOURCE that were loaded."""
+    times = history.export_times(source)
+    if as_of is None:
+        for updated in times:
+            print("{:%Y-%m-%d %H:%M:%S}".format(updated))
+        return
+    try:
+        when = datetime.strptime(as_of, '%Y-%m-%d %H:%M:%S')
+    except ValueError:
+        raise click.BadParameter("Expected YYYY-MM-DD HH:MM:SS",
+                                 param_hint='AS_OF')
+    if when not in times:
+        raise click.BadParameter("No export of {} was loaded at {}".format(
+                                 source, as_of), param_hint='AS_OF')
+    count = utils.write_records(history.iter_source_as_of(source, when),
+                                output, fmt, history.VERSION_COLS)
+    logging.getLogger('compranet').info("Wrote {} contracts".format(count))
+
+@click.command('changes',
+               short_help="Export the contracts changed by each load run.")
+@click.option('--run', 'run_ids', type=int, multiple=True,
+              help="_ID of a load run, may be repeated.")
+@click.option('--source', help="Source year of the load runs.")
+@click.option('--after', type=int,
+              help="Only export the load runs after this one.")
+@click.option('--runs', 'list_runs', is_flag=True,
+              help="List the load runs instead of their changes.")
+@click.option('--format', 'fmt', type=click.Choice(['jsonl', 'csv']),
+              default='jsonl', show_default=True,
+              help="Output format.")
+@click.option('--output', '-o', type=click.File('w'), default='-',
+              help="File where the changes are written, by default the "
+                   "standard output.")
+def changes_cmd(run_ids, source, after, list_runs, fmt, output):
+    """Write the contracts inserted, modified and deleted by each import of
+    an Excel export, with the values before and after of the changed
+    columns of modified contracts, and of every column of inserted and
+    deleted contracts. A consumer can process the changes
+    incrementally by passing the last load run it processed to --after.
+    With --runs, write the load runs and their counters instead."""
+    if list_runs:
+        runs = history.read_load_runs(source, after)
+        if run_ids:
+            runs = [run for run in runs if run['_ID'] in run_ids]
+        utils.write_records([runs], output, fmt)
+        return
+    count = utils.write_records(
+        history.iter_changes(run_ids or None, source, after),
+        output, fmt, history.FEED_COLS)
+    logging.getLogger('compranet').info("Wrote {} changes".format(count))
+
+@click.command('reparse_archive',
+               short_help="Parse the archived anuncio pages again.")
+@click.option('--jobs', '-j', type=click.IntRange(min=1),
+              help="Number of processes parsing the pages, by default the "
+                   "number of CPUs.")
+@click.option('--since',
+              help="Only parse the anuncios fetched since this time, given "
+                   "as YYYY-MM-DD HH:MM:SS.")
+@click.option('--dry-run', is_flag=True,
+              help="Parse the pages without writing the results.")
+def reparse_archive_cmd(jobs, since, dry_run):
+    """Run the anuncio parser again over the latest archived page of each
+    anuncio, without network access, and update contratos_web with the
+    results. Use it after fixing the parser for a change of the layout of
+    the site. Pages that cannot be parsed are logged and skipped."""
+    if since is not None:
+        try:
+            since = datetime.strptime(since, '%Y-%m-%d %H:%M:%S')
+        except ValueError:
+            raise click.BadParameter("Expected YYYY-MM-DD HH:MM:SS",
+                                     param_hint='--since')
+    counts = archive.reparse_archive(jobs, since, dry_run)
+    if counts['errors'] > 0:
+        raise click.ClickException("{} pages could not be parsed".format(
+                                   counts['errors']))
+
+@click.command('scrape_missing',
+               short_help="Scrape the anuncios that have not been scraped.")
+@click.option('--source', help="Only add the anuncios of this source year.")
+def scrape_missing_cmd(source):
+    """Add the anuncios of the contracts that have not been scraped to the
+    crawl frontier, and scrape the URLs of the frontier until none is
+    eligible. An interrupted run resumes where it stopped, and several
+    processes may drain the frontier at once."""
+    web.scrape_missing(source)
+
+@click.command('frontier', short_help="Inspect the crawl frontier.")
+@click.option('--retry-failed', is_flag=True,
+              help="Put the URLs that failed too many times back to pending.")
+def frontier_cmd(retry_failed):
+    """Print the number of URLs of the crawl frontier in each state."""
+    if retry_failed:
+        print("{} failed URLs put back to pending".format(
+              frontier.retry_failed()))
+    for state, count in frontier.count_states().items():
+        print("{:<8} {:>10}".format(state, count))
+
+@click.command('rescrape',
+               short_help="Scrape again the anuncios most likely to have "
+                          "changed.")
+@click.option('--budget', '-n', type=click.IntRange(min=1),
+              default=web.RESCRAPE_BUDGET, show_default=True,
+              help="Maximum number of anuncios to scrape.")
+@click.option('--min-age', type=click.FloatRange(min=0),
+              default=web.RESCRAPE_MIN_AGE.total_seconds() / 86400,
+              show_default=True,
+              help="Days since an anuncio was scraped before it is scraped "
+                   "again.")
+@click.option('--dry-run', is_flag=True,
+              help="Print the anuncios scheduled instead of scraping them.")
+def rescrape_cmd(budget, min_age, dry_run):
+    """Rank the anuncios already scraped by how long ago they were scraped,
+    whether their participation period is still open and how often their
+    page changed before, and scrape the top ones again. Changed pages have
+    their previous version saved to the history table. Meant to be run
+    nightly, see crontab."""
+    scheduled = web.rescrape(budget, timedelta(days=min_age), dry_run)
+    if dry_run:
+        for score, anuncio in scheduled:
+            print("{:>10.1f}  {}".format(score, anuncio))
 
 @click.command()
 def create_db():
@@ -125,6 +421,18 @@ def test_log():
 cli.add_command(fetch_xlsx_cmd)
 cli.add_command(load_xlsx_cmd)
 cli.add_command(pull_xlsx_cmd)
+cli.add_command(benchmark_cmd)
+cli.add_command(benchmark_parser_cmd)
+cli.add_command(cache_cmd)
+cli.add_command(update_fingerprints_cmd)
+cli.add_command(check_query_plans_cmd)
+cli.add_command(storage_cmd)
+cli.add_command(snapshot_cmd)
+cli.add_command(changes_cmd)
+cli.add_command(reparse_archive_cmd)
+cli.add_command(scrape_missing_cmd)
+cli.add_command(frontier_cmd)
+cli.add_command(rescrape_cmd)
 cli.add_command(create_db)
 cli.add_command(crontab)
 cli.add_command(test_log)
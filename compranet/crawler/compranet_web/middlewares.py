@@ -0,0 +1,229 @@
+# -*- coding: utf-8 -*-
+
+# Define here the downloader middlewares
+#
+# See documentation in:
+# http://doc.scrapy.org/en/latest/topics/downloader-middleware.html
+
+from datetime import datetime
+import logging
+import re
+import time
+
+import pytz
+from scrapy import signals
+from scrapy.exceptions import IgnoreRequest, NotConfigured
+from twisted.internet import reactor
+
+from compranet import archive
+from compranet.crawler.compranet_web.spiders.compranet_spider import anuncio_url
+
+
+logger = logging.getLogger('compranet.crawler')
+
+RETRY_IN_RE = re.compile(br'retry in ([0-9]+) sec')
+
+
+class RateLimitMiddleware(object):
+    """
+    Handles the 429 responses of CompraNet without blocking the reactor.
+
+    CompraNet answers with a 429 page asking to "retry in N sec" once a
+    client makes too many requests. On a 429 the engine is paused for N
+    seconds plus RATELIMIT_MARGIN, the requests already queued for the site
+    are held back until then, and the request is scheduled again.
+
+    The rate of the site's download slot is adapted to the 429s, like TCP
+    congestion control. The first 429 of a pause halves the concurrency of
+    the slot and doubles its download delay. Every RATELIMIT_PROBE_AFTER
+    successful responses without a 429 the concurrency is increased by one
+    and the delay decreased by RATELIMIT_DELAY_STEP, so the crawl rate
+    settles just under the limit of the server.
+
+    Settings
+    --------
+    RATELIMIT_ENABLED
+        Whether the middleware is enabled
+    RATELIMIT_MARGIN
+        Seconds added to the pause requested by the server
+    RATELIMIT_DEFAULT_PAUSE
+        Seconds to pause when a 429 does not say how long to wait
+    RATELIMIT_MAX_RETRIES
+        Number of times a request is retried after a 429 before giving up
+    RATELIMIT_MIN_DELAY, RATELIMIT_MAX_DELAY
+        Bounds of the download delay, which starts at DOWNLOAD_DELAY
+    RATELIMIT_MAX_CONCURRENCY
+        Upper bound of the concurrency, which starts at
+        CONCURRENT_REQUESTS_PER_DOMAIN
+    RATELIMIT_PROBE_AFTER
+        Number of successful responses between increases of the rate
+    RATELIMIT_DELAY_STEP
+        Factor applied to the delay when the rate is increased
+    """
+
+    def __init__(self, crawler):
+        settings = crawler.settings
+        if not settings.getbool('RATELIMIT_ENABLED'):
+            raise NotConfigured
+        self.crawler = crawler
+        self.margin = settings.getfloat('RATELIMIT_MARGIN', 5)
+        self.default_pause = settings.getfloat('RATELIMIT_DEFAULT_PAUSE', 60)
+        self.max_retries = settings.getint('RATELIMIT_MAX_RETRIES', 10)
+        self.min_delay = settings.getfloat('RATELIMIT_MIN_DELAY', 0.1)
+        self.max_delay = settings.getfloat('RATELIMIT_MAX_DELAY', 30)
+        self.max_concurrency = settings.getint('RATELIMIT_MAX_CONCURRENCY', 8)
+        self.probe_after = settings.getint('RATELIMIT_PROBE_AFTER', 50)
+        self.delay_step = settings.getfloat('RATELIMIT_DELAY_STEP', 0.9)
+        self.successes = 0
+        self.resume_at = 0
+        self.unpause_call = None
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        return(cls(crawler))
+
+    def get_slot(self, request):
+        key = request.meta.get('download_slot')
+        return(self.crawler.engine.downloader.slots.get(key))
+
+    def retry_after(self, response):
+        """Returns the number of seconds to wait requested by a 429"""
+        match = RETRY_IN_RE.search(response.body)
+        if match is not None:
+            return(int(match.group(1)))
+        header = response.headers.get('Retry-After')
+        if header is not None and header.isdigit():
+            return(int(header))
+        return(self.default_pause)
+
+    def pause(self, seconds):
+        """Pauses the engine, or extends the current pause"""
+        resume_at = time.time() + seconds
+        if resume_at <= self.resume_at:
+            return
+        self.resume_at = resume_at
+        if self.unpause_call is not None and self.unpause_call.active():
+            self.unpause_call.reset(seconds)
+        else:
+            self.crawler.engine.pause()
+            self.unpause_call = reactor.callLater(seconds, self.unpause)
+        logger.info("Too many requests, pausing for {:.0f} seconds..."
+                    .format(seconds))
+
+    def unpause(self):
+        logger.info("Resuming the crawl")
+        self.crawler.engine.unpause()
+
+    def slow_down(self, slot):
+        slot.concurrency = max(1, slot.concurrency // 2)
+        slot.delay = min(self.max_delay, max(slot.delay, self.min_delay) * 2)
+        self.log_rate(slot)
+
+    def hold(self, slot):
+        """Holds back the requests already queued in a slot until resume_at"""
+        # the downloader sends the next request of a slot delay seconds
+        # after lastseen
+        slot.lastseen = max(slot.lastseen, self.resume_at - slot.delay)
+
+    def speed_up(self, slot):
+        slot.concurrency = min(self.max_concurrency, slot.concurrency + 1)
+        slot.delay = max(self.min_delay, slot.delay * self.delay_step)
+        self.log_rate(slot)
+
+    def log_rate(self, slot):
+        stats = self.crawler.stats
+        stats.set_value('ratelimit/concurrency', slot.concurrency)
+        stats.set_value('ratelimit/delay', slot.delay)
+        logger.debug("Concurrency {}, download delay {:.2f} s".format(
+                     slot.concurrency, slot.delay))
+
+    def process_response(self, request, response, spider):
+        slot = self.get_slot(request)
+        if response.status != 429:
+            self.successes += 1
+            if slot is not None and self.successes >= self.probe_after:
+                self.successes = 0
+                self.speed_up(slot)
+            return(response)
+
+        self.crawler.stats.inc_value('ratelimit/429')
+        self.successes = 0
+        # the responses to the requests in flight when the limit was hit
+        # extend the pause but do not slow down again
+        paused = time.time() < self.resume_at
+        self.pause(self.retry_after(response) + self.margin)
+        if slot is not None:
+            if not paused:
+                self.slow_down(slot)
+            self.hold(slot)
+        retries = request.meta.get('ratelimit_retries', 0) + 1
+        if retries > self.max_retries:
+            self.crawler.stats.inc_value('ratelimit/gave_up')
+            raise IgnoreRequest("Gave up on {} after {} 429 responses".format(
+                                request.url, retries))
+        retry_req = request.replace(dont_filter=True)
+        retry_req.meta['ratelimit_retries'] = retries
+        return(retry_req)
+
+
+class ArchiveMiddleware(object):
+    """
+    Stores every anuncio page fetched in the archive of compranet.archive.
+
+    The HTML of each successful response is written gzipped to the archive,
+    and its anuncio, fetch time and hash are added to the anuncio_pages
+    table in batches of ARCHIVE_INDEX_BATCH_SIZE, and when the spider
+    closes. The fetch time is passed to the spider in the fetched meta key,
+    so that the _UPDATED of an item is the fetch time of its archived page.
+
+    Settings
+    --------
+    ARCHIVE_ENABLED
+        Whether the middleware is enabled
+    ARCHIVE_DIR
+        The path of the archive directory, by default the archive_dir of
+        config.ini
+    ARCHIVE_INDEX_BATCH_SIZE
+        Number of pages added to the index in each transaction
+    """
+
+    def __init__(self, crawler):
+        settings = crawler.settings
+        if not settings.getbool('ARCHIVE_ENABLED'):
+            raise NotConfigured
+        self.crawler = crawler
+        self.archive_dir = settings.get('ARCHIVE_DIR') or archive.ARCHIVE_DIR
+        self.batch_size = settings.getint('ARCHIVE_INDEX_BATCH_SIZE', 100)
+        self.pages = []
+        crawler.signals.connect(self.spider_closed,
+                                signal=signals.spider_closed)
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        return(cls(crawler))
+
+    def process_response(self, request, response, spider):
+        if response.status != 200:
+            return(response)
+        fetched = datetime.now(pytz.utc)
+        sha256 = archive.write_page(response.body, self.archive_dir)
+        self.pages.append({'ANUNCIO': anuncio_url(request),
+                           '_FETCHED': fetched, 'SHA256': sha256,
+                           'URL': response.url})
+        self.crawler.stats.inc_value('archive/pages')
+        if len(self.pages) >= self.batch_size:
+            self.flush()
+        request.meta['fetched'] = fetched
+        return(response)
+
+    def flush(self):
+        """Adds the pages stored since the last flush to the index"""
+        pages, self.pages = self.pages, []
+        try:
+            archive.index_pages(pages)
+        except Exception:
+            logger.exception("Could not index {} archived pages".format(
+                             len(pages)))
+
+    def spider_closed(self, spider):
+        self.flush()
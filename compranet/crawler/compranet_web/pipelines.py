@@ -6,23 +6,129 @@
 # See: http://doc.scrapy.org/en/latest/topics/item-pipeline.html
 
 import logging
+import time
 
-from compranet.database import get_session, ContratoWeb
+from twisted.internet.task import LoopingCall
+
+from compranet import frontier
+from compranet.database import get_session
+from compranet.web import upsert_records
+
+
+logger = logging.getLogger('compranet.crawler')
 
 
 class SqlitePipeline(object):
+    """
+    Writes the scraped anuncios to contratos_web in batches.
+
+    The items are buffered and upserted on ANUNCIO in a single transaction,
+    so that a scraped anuncio updates its row instead of failing on the
+    primary key, and the database syncs once per batch rather than once per
+    item. The previous version of an anuncio whose page changed is kept in
+    contratos_web_hist, see web.upsert_records. The buffer is written when
+    it holds SQLITE_BATCH_SIZE items, every SQLITE_FLUSH_INTERVAL seconds,
+    and when the spider closes.
+
+    The URLs of the items leased from the crawl frontier are marked as done
+    in the transaction that writes the items. If a batch cannot be written
+    its items are written one at a time, so that only the items that fail
+    are dropped and counted as failed attempts in the frontier.
+
+    Settings
+    --------
+    SQLITE_BATCH_SIZE
+        Number of items written in each transaction
+    SQLITE_FLUSH_INTERVAL
+        Seconds between writes of the items buffered
+    """
+
+    def __init__(self, batch_size=500, flush_interval=30, stats=None):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.stats = stats
+        self.items = []
+        self.written = 0
+        self.started = None
+        self.flush_call = None
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        settings = crawler.settings
+        return(cls(batch_size=settings.getint('SQLITE_BATCH_SIZE', 500),
+                   flush_interval=settings.getfloat('SQLITE_FLUSH_INTERVAL', 30),
+                   stats=crawler.stats))
+
     def open_spider(self, spider):
         self.session = get_session()
+        self.started = time.time()
+        self.flush_call = LoopingCall(self.flush)
+        self.flush_call.start(self.flush_interval, now=False)
 
     def close_spider(self, spider):
+        if self.flush_call is not None and self.flush_call.running:
+            self.flush_call.stop()
+        self.flush()
+        elapsed = time.time() - self.started
+        logger.info("Wrote {} items in {:.0f} s, {:.1f} items/s".format(
+                    self.written, elapsed, self.written / max(elapsed, 1e-9)))
         self.session.close()
 
     def process_item(self, item, spider):
+        self.items.append(dict(item))
+        if len(self.items) >= self.batch_size:
+            self.flush()
+        return item
+
+    def write(self, items):
+        """
+        Upserts items in one transaction, and marks the URLs leased from the
+        crawl frontier as done in the same transaction.
+        """
+        records = []
+        leases = []
+        for item in items:
+            record = dict(item)
+            lease_id = record.pop(frontier.LEASE_KEY, None)
+            if lease_id is not None:
+                leases.append((record['ANUNCIO'], lease_id))
+            records.append(record)
         try:
-            self.session.add(ContratoWeb(**item))
+            inserted, updated, changed = upsert_records(self.session, records)
+            frontier.complete(self.session, leases)
             self.session.commit()
-            logging.debug("Inserted to database {}".format(item['ANUNCIO']))
         except:
-            logging.exception("SqlitePipeline exception")
             self.session.rollback()
-        return item
+            raise
+        self.written += inserted + updated
+        if self.stats is not None:
+            self.stats.inc_value('sqlite/inserted', inserted)
+            self.stats.inc_value('sqlite/updated', updated)
+            self.stats.inc_value('sqlite/changed', changed)
+
+    def flush(self):
+        """Writes the items buffered"""
+        if len(self.items) == 0:
+            return
+        items, self.items = self.items, []
+        start = time.time()
+        try:
+            self.write(items)
+        except Exception:
+            logger.warning("Could not write a batch of {} items, writing them "
+                           "one at a time".format(len(items)))
+            for item in items:
+                try:
+                    self.write([item])
+                except Exception as e:
+                    logger.exception("Could not write {}".format(
+                                     item.get('ANUNCIO')))
+                    if self.stats is not None:
+                        self.stats.inc_value('sqlite/failed')
+                    if frontier.LEASE_KEY in item:
+                        frontier.fail(item['ANUNCIO'], item[frontier.LEASE_KEY],
+                                      repr(e))
+        now = time.time()
+        logger.info("Wrote {} items in {:.2f} s, {:.1f} items/s since the "
+                    "start".format(len(items), now - start,
+                                   self.written / max(now - self.started, 1e-9)))
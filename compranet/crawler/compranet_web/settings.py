@@ -19,14 +19,16 @@ NEWSPIDER_MODULE = 'compranet.crawler.compranet_web.spiders'
 #USER_AGENT = 'compranet (+http://www.yourdomain.com)'
 
 # Configure maximum concurrent requests performed by Scrapy (default: 16)
-CONCURRENT_REQUESTS = 1
+CONCURRENT_REQUESTS = 16
 
 # Configure a delay for requests for the same website (default: 0)
 # See http://scrapy.readthedocs.org/en/latest/topics/settings.html#download-delay
 # See also autothrottle settings and docs
+# The delay and the concurrency are the starting values of the download
+# slot of CompraNet, which RateLimitMiddleware adapts to its 429 responses
 DOWNLOAD_DELAY = 0.9
 # The download delay setting will honor only one of:
-#CONCURRENT_REQUESTS_PER_DOMAIN = 16
+CONCURRENT_REQUESTS_PER_DOMAIN = 1
 #CONCURRENT_REQUESTS_PER_IP = 16
 
 # Disable cookies (enabled by default)
@@ -49,9 +51,33 @@ DOWNLOAD_DELAY = 0.9
 
 # Enable or disable downloader middlewares
 # See http://scrapy.readthedocs.org/en/latest/topics/downloader-middleware.html
-#DOWNLOADER_MIDDLEWARES = {
-#    'compranet.middlewares.MyCustomDownloaderMiddleware': 543,
-#}
+# RateLimitMiddleware must see the 429 responses after they are decompressed
+# and before RetryMiddleware (550)
+DOWNLOADER_MIDDLEWARES = {
+    'compranet.crawler.compranet_web.middlewares.RateLimitMiddleware': 570,
+    # after RateLimitMiddleware, so that only the final pages are archived,
+    # and apart from the priorities of the default middlewares
+    'compranet.crawler.compranet_web.middlewares.ArchiveMiddleware': 565,
+}
+
+# Configure RateLimitMiddleware
+RATELIMIT_ENABLED = True
+# Seconds added to the pause requested by a 429 response
+RATELIMIT_MARGIN = 5
+# Seconds to pause when a 429 response does not say how long to wait
+RATELIMIT_DEFAULT_PAUSE = 60
+RATELIMIT_MAX_RETRIES = 10
+RATELIMIT_MIN_DELAY = 0.1
+RATELIMIT_MAX_DELAY = 30
+RATELIMIT_MAX_CONCURRENCY = 8
+# Successful responses between increases of the request rate
+RATELIMIT_PROBE_AFTER = 50
+RATELIMIT_DELAY_STEP = 0.9
+
+# Configure ArchiveMiddleware, the archive directory is set in config.ini
+ARCHIVE_ENABLED = True
+# Pages added to the index of the archive in each transaction
+ARCHIVE_INDEX_BATCH_SIZE = 100
 
 # Enable or disable extensions
 # See http://scrapy.readthedocs.org/en/latest/topics/extensions.html
@@ -64,6 +90,10 @@ DOWNLOAD_DELAY = 0.9
 ITEM_PIPELINES = {
     'compranet.crawler.compranet_web.pipelines.SqlitePipeline': 300,
 }
+# Items written to the database in each transaction, and seconds between
+# writes of the items buffered
+SQLITE_BATCH_SIZE = 500
+SQLITE_FLUSH_INTERVAL = 30
 
 # Enable and configure the AutoThrottle extension (disabled by default)
 # See http://doc.scrapy.org/en/latest/topics/autothrottle.html
@@ -87,4 +117,4 @@ ITEM_PIPELINES = {
 #HTTPCACHE_STORAGE = 'scrapy.extensions.httpcache.FilesystemCacheStorage'
 
 # Configure HttpErrorMiddleware settings
-HTTPERROR_ALLOWED_CODES = [402, 429]
+HTTPERROR_ALLOWED_CODES = [402]
@@ -1,216 +1,139 @@
 # coding: utf-8
+from collections import Counter
 from datetime import datetime
-import json
-import logging
-import re
-import time
 
-from lxml import html
-import pandas as pd
 import pytz
 import scrapy
+from scrapy import signals
+from twisted.internet.task import LoopingCall
+
+from compranet import frontier
+from compranet.anuncio import parse_anuncio, ParseError
+
+
+def anuncio_url(r):
+    """
+    Returns the URL of the anuncio requested, before any redirect, from a
+    request or a response.
+    """
+    if r.meta.get('redirect_times', 0) > 0:
+        return(r.meta['redirect_urls'][0])
+    return(r.url)
+
 
 class CompraNetSpider(scrapy.Spider):
     name = "compranet_web"
-    too_many_requests = False
 
-    def __init__(self, urls=None, *args, **kwargs):
+    def __init__(self, urls=None, use_frontier=False, *args, **kwargs):
         super(CompraNetSpider, self).__init__(*args, **kwargs)
-        # urls may be a list of urls or a path to a text file containing
-        # one url per line
-        if urls:
-            if isinstance(urls, list):
-                self.start_urls = urls
-            else:
-                with open(urls) as urlfile:
-                    urls_list = [line.strip() for line in urlfile]
-                    self.start_urls = urls_list
+        # urls may be an iterable of urls, such as a generator, or a path
+        # to a text file containing one url per line. Either is consumed
+        # lazily by start_requests. With use_frontier, the urls are leased
+        # from the crawl frontier instead, see compranet.frontier.
+        self.urls = urls
+        self.use_frontier = bool(use_frontier)
+        # number of URLs of each lease not finished yet, whose leases are
+        # renewed until they are, see renew_leases
+        self.leases = Counter()
+        self.renew_call = None
+
+    @classmethod
+    def from_crawler(cls, crawler, *args, **kwargs):
+        spider = super(CompraNetSpider, cls).from_crawler(crawler, *args,
+                                                          **kwargs)
+        crawler.signals.connect(spider.start_renewing,
+                                signal=signals.spider_opened)
+        crawler.signals.connect(spider.stop_renewing,
+                                signal=signals.spider_closed)
+        return(spider)
+
+    def start_renewing(self, spider):
+        if self.use_frontier:
+            self.renew_call = LoopingCall(self.renew_leases)
+            self.renew_call.start(
+                frontier.LEASE_RENEW_INTERVAL.total_seconds(), now=False)
+
+    def stop_renewing(self, spider):
+        if self.renew_call is not None and self.renew_call.running:
+            self.renew_call.stop()
+
+    def iter_urls(self):
+        if isinstance(self.urls, str):
+            with open(self.urls) as urlfile:
+                for line in urlfile:
+                    url = line.strip()
+                    if url:
+                        yield url
+        elif self.urls:
+            for url in self.urls:
+                yield url
+
+    def iter_leased(self):
+        """
+        Yields the (url, lease ID) of URLs leased from the frontier, a batch
+        at a time, until no URL is eligible.
+        """
+        worker = frontier.worker_name()
+        while True:
+            lease_id, urls = frontier.lease(worker=worker)
+            if len(urls) == 0:
+                return
+            self.logger.info("Leased {} URLs from the frontier".format(
+                             len(urls)))
+            self.leases[lease_id] += len(urls)
+            for url in urls:
+                yield (url, lease_id)
+
+    def renew_leases(self):
+        """
+        Renews the leases of the URLs not finished yet, which may wait in the
+        queues of Scrapy for longer than frontier.LEASE_DURATION.
+        """
+        if len(self.leases) == 0:
+            return
+        renewed = frontier.renew(list(self.leases))
+        self.logger.debug("Renewed the leases of {} URLs".format(renewed))
+
+    def release(self, lease_id):
+        """Stops renewing the lease of a URL that was fetched or failed"""
+        self.leases[lease_id] -= 1
+        if self.leases[lease_id] <= 0:
+            del self.leases[lease_id]
+
+    def start_requests(self):
+        if self.use_frontier:
+            for url, lease_id in self.iter_leased():
+                yield scrapy.Request(url, dont_filter=True,
+                                     errback=self.failed,
+                                     meta={'frontier_lease': lease_id})
+        else:
+            for url in self.iter_urls():
+                yield scrapy.Request(url, dont_filter=True)
 
     def parse(self, response):
-        # check for rate limiting
-        if response.status == 429:
-            self.too_many_requests = True
-            delay = int(re.search("retry in ([0-9]+) sec",
-                                  str(response.body)).group(1)) + 30
-            logging.info("Too many requests, pausing for {} seconds...".\
-                         format(delay))
-            for _ in range(delay):
-                time.sleep(1)
-            self.too_many_requests = False
-            return response.request
-        # another thread has hit the rate limit, wait until it lapses
-        while self.too_many_requests:
-            time.sleep(1)
-
-        # initialize output dictionary
-        now = datetime.now(pytz.utc)
-        output = {}
-        output['_UPDATED'] = now
-        if response.meta['redirect_times'] > 0:
-            output['ANUNCIO'] = response.meta['redirect_urls'][0]
-        else:
-            output['ANUNCIO'] = response.url
-
-        # FIXME: this parses twice, rewrite to use scrapy selectors instead
-        # of lxml?
-        pageString = response.body
-
-        # parse html
-        tree = html.fromstring(pageString)
-
-        # get main div
-        cntDetail = tree.xpath('/html/body/div[@id="main"]/div[@id="cnt"]/'
-                               'div[@id="cntDetail"]')[0]
-
-        # check if procedimiento is not found
-        alert = cntDetail.xpath('div[@class="alert"]')
-        if len(alert) == 1:
-            noSeEncuentra_str = ('El anuncio de este procedimiento de '
-                                 'contratación no se encuentra visible, '
-                                 'favor de ponerse en contacto con personal '
-                                 'de la Unidad Compradora.')
-            if alert[0].text_content().strip() == noSeEncuentra_str:
-                return(output)
-
-        def extractTable(liList, spec, labelIdx=0, valIdx=1):
-            output = {}
-            assert len(liList) == len(spec)
-            for i, (var, label) in enumerate(spec):
-                #print(var)
-                #print(label)
-                #print(liList[i][labelIdx].text)
-                assert liList[i][labelIdx].text == label
-                val = liList[i][valIdx].text
-                output[var] = val
-            return(output)
-
-
-        # Detalles del Expediente section
-        curList = cntDetail.xpath('h3[text()="Detalles del Expediente"]'
-                                  '/following-sibling::div[@class='
-                                  '"form_container"][1]/ul/li')
-        curSpec = [('CODIGO_EXPEDIENTE', 'Código del Expediente'),
-                ('TITULO_EXPEDIENTE', 'Descripción del Expediente')]
-        output.update(extractTable(curList, curSpec))
-
-        # Detalles del Anuncio section
-        curList = cntDetail.xpath('h3[text()="Detalles del Anuncio"]'
-                                  '/following-sibling::div[@class='
-                                  '"form_container"][1]/ul/li')
-        curSpec = [('_DESC_ANUNCIO', 'Descripción del Anuncio'),
-                ('_NOTAS', 'Notas'),
-                ('TIPO_CONTRATACION', 'Tipo de Contratación'),
-                ('_ENTIDAD_FEDERATIVA', 'Entidad Federativa'),
-                ('FECHA_APERTURA_PROPOSICIONES',
-                 'Plazo de participación o vigencia del anuncio')
-                ]
-        output.update(extractTable(curList, curSpec))
-
-        # conditionalPrefix table
-        # variation 1, contains only Detalles del Procedimiento section
-        curList = cntDetail.xpath('table[@id="conditionalPrefixFor_92"]/tr')
-        if len(curList) > 0:
-            #output['_CONDITIONAL_PREFIX_FOR'] = 92
-            assert curList[0].xpath('th/h4')[0].text == 'Detalles del Procedimiento'
-            assert curList[1].attrib['class'] == 'accessHidden'
-            curList = curList[2:]
-            curSpec = [(var, '\n' + label) for (var, label) in
-                        [('NUMERO_PROCEDIMIENTO', 'Número del Procedimiento (Anuncio)'),
-                        ('CARACTER', 'Carácter del procedimiento'),
-                        ('_CREDITO_EXTERNO', 'Crédito externo'),
-                        ('FORMA_PROCEDIMIENTO', 'Medio o forma del procedimiento'),
-                        ('_EXCLUSIVO_MIPYMES', 'Procedimiento exclusivo para MIPYMES'),
-                        ('PROC_F_PUBLICACION', 'Fecha de publicación del anuncio'
-                        ' (Convocatoria / Invitación / Adjudicación / Proyecto de Convocatoria)')
-                        ]
-                    ]
-            output.update(extractTable(curList, curSpec, labelIdx=1, valIdx=3))
-        # variation 2, contains Detalles del Procedimiento and Anexos sections
-        curList = cntDetail.xpath('table[@id="conditionalPrefixFor_155"]/tr')
-        if len(curList) > 0:
-            # v2 Detalles del Procedimiento
-            #output['_CONDITIONAL_PREFIX_FOR'] = 155
-            assert 'NUMERO_PROCEDIMIENTO' not in output
-            assert curList[0].xpath('th/h4')[0].text == 'DATOS GENERALES DEL PROCEDIMIENTO DE CONTRATACIÓN'
-            assert curList[1].attrib['class'] == 'accessHidden'
-            curList1 = curList[2:6]
-            curSpec = [(var, '\n' + label) for (var, label) in
-                [('NUMERO_PROCEDIMIENTO', 'Número del Procedimiento (Expediente)'),
-                ('CARACTER', 'Carácter del procedimiento'),
-                ('FORMA_PROCEDIMIENTO', 'Medio o forma del procedimiento'),
-                ('_EXCLUSIVO_MIPYMES', 'Procedimiento exclusivo para MIPYMES')
-                ]
-            ]
-            output.update(extractTable(curList1, curSpec, labelIdx=1, valIdx=3))
-            # v2 Anexos
-            assert curList[6].xpath('th/h4')[0].text == 'ANEXOS DEL PROCEDIMIENTO DE CONTRATACIÓN'
-            assert curList[7].attrib['class'] == 'accessHidden'
-            archives = []
-            for row in curList[8:]:
-                links = row[3].xpath('span/a')
-                if len(links) > 0:
-                    assert len(links) == 1
-                    link = links[0]
-                    archive = {}
-                    archive['href'] = link.attrib['href']
-                    archive['nombre'] = link.attrib['title'].replace('Descargar archivo adjunto: ','')
-                    archive['tamano'] = re.match(r'.+\(([0-9,]+\s.B)\)', row[3][0].text_content()).group(1)
-                    archive['descripcion'] = row[1].text
-                    archive['comentarios'] = row[2][0].text
-                    archives.append(archive)
-            # add conditionalPrefix archives
-            output['_ANEXOS_CP'] = archives
-
-        # Opportunity detail -- includes Procedimiento, Responsable, and possibly the Anexos sections
-        oppDetail = cntDetail.xpath('form[@name="opportunityDetailForm"]/div')[0]
-
-        # Procedimiento section
-        curList = oppDetail.xpath('h3[normalize-space(text())="Procedimiento"]/following-sibling::table[1]/tr')
-        # this section is not always present
-        if len(curList) > 0:
-            assert curList[0][2].text == 'Código'
-            assert curList[0][3].text == 'Título'
-            assert curList[0][4].text == 'FECHA Y HORA LÍMITE PARA PRESENTAR PROPOSICIONES'
-            procedimientos = []
-            for i in range(1, len(curList)):
-                procedimientos.append(
-                    {'codigo_procedimiento': curList[i][2].text,
-                    'titulo_procedimiento': curList[i][3].text,
-                    'fecha_limite_procedimiento': curList[1][4].text
-                    }
-                )
-            output['_PROCEDIMIENTOS'] = procedimientos
-
-        # Responsable section
-        curList = oppDetail.xpath('h3[contains(text(),"Responsable")]/following-sibling::div[1]/ul/li')
-        curSpec = [('NOMBRE_DE_LA_UC','Nombre de la Unidad Compradora (UC)'),
-                ('_NOMBRE_DEL_OPERADOR','Nombre del Operador en la UC'),
-                ('_CORREO_DEL_OPERADOR','Correo Electrónico del Operador en la UC')
-                ]
-        output.update(extractTable(curList, curSpec))
-
-        # Anexos section
-        curList = oppDetail.xpath('h3[contains(text(),"Anexos")]/following-sibling::table[1]/tr')
-        # this section is not always present
-        if len(curList) > 0:
-            archives = []
-
-            assert curList[0][1].text == 'Nombre del archivo'
-            assert curList[0][2].text == 'Descripción del archivo'
-            assert curList[0][3].text == 'Comentarios sobre Anexos'
-            assert curList[0][4].text == 'Ultima fecha de modificación'
-
-            for row in curList[1:]:
-                archive = {}
-                archive['href'] = row[1][1].attrib['href']
-                archive['nombre'] = row[1][1].attrib['title'].replace('Descargar archivo adjunto: ','')
-                archive['tamano'] = re.match(r'.+\(([0-9,]+ .B)\)', row[1].text_content()).group(1)
-                archive['descripcion'] = row[2].text
-                archive['comentarios'] = row[3].text
-                archive['fecha_de_modificacion'] = row[4].text
-                archives.append(archive)
-
-            # add opportunityDetail archives
-            output['_ANEXOS_OD'] = archives
-
-        return(output)
+        # rate limiting is handled by middlewares.RateLimitMiddleware
+        fetched = response.meta.get('fetched') or datetime.now(pytz.utc)
+        lease_id = response.meta.get('frontier_lease')
+        if lease_id is not None:
+            # the URL is marked as done when the pipeline writes its item,
+            # well within the lease
+            self.release(lease_id)
+        try:
+            item = parse_anuncio(response.body, anuncio_url(response), fetched)
+        except ParseError as e:
+            if lease_id is None:
+                raise
+            frontier.fail(anuncio_url(response), lease_id,
+                          'ParseError: {}'.format(e))
+            return
+        if lease_id is not None:
+            # the pipeline marks the URL as done when it writes the item
+            item[frontier.LEASE_KEY] = lease_id
+        return(item)
+
+    def failed(self, failure):
+        """Records a failed request of a URL leased from the frontier"""
+        request = failure.request
+        self.release(request.meta['frontier_lease'])
+        frontier.fail(anuncio_url(request), request.meta['frontier_lease'],
+                      repr(failure.value))
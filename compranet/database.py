@@ -1,17 +1,88 @@
+from contextlib import contextmanager
 import json
+import re
 
 from alembic.config import Config
 from alembic import command
-from sqlalchemy import Column, String, Integer, Float, DateTime, Boolean
+from sqlalchemy import Column, String, Integer, Float, Date, DateTime, Boolean
+from sqlalchemy import ForeignKey, ForeignKeyConstraint, Index
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event
 from sqlalchemy.orm import scoped_session, sessionmaker
 from sqlalchemy.types import TypeDecorator, VARCHAR
 
 from . import settings
 
 
+# SQLite pragmas set on each new connection, by profile. The serving profile
+# lets the web scraper and the xlsx loader share the database without
+# blocking each other, and the bulk-load profile trades durability on power
+# loss for write speed during an import.
+PRAGMAS = ['journal_mode', 'synchronous', 'cache_size', 'mmap_size',
+           'temp_store', 'busy_timeout']
+PROFILES = {
+    'serving': {'journal_mode': 'wal',
+                'synchronous': 'normal',
+                'cache_size': '-65536', # 64 MB
+                'mmap_size': '268435456', # 256 MB
+                'temp_store': 'memory',
+                'busy_timeout': '30000'},
+    'bulk-load': {'journal_mode': 'wal',
+                  'synchronous': 'off',
+                  'cache_size': '-1048576', # 1 GB
+                  'mmap_size': '1073741824', # 1 GB
+                  'temp_store': 'memory',
+                  'busy_timeout': '300000'},
+}
+PRAGMA_VALUE_RE = re.compile(r'^-?\w+$')
+
+def get_pragmas(profile_name):
+    """
+    Returns the pragmas of a profile, including the settings in config.ini.
+    """
+    pragmas = dict(PROFILES.get(profile_name, {}))
+    pragmas.update(settings.DB_PROFILES.get(profile_name, {}))
+    if profile_name == settings.DB_PROFILE:
+        pragmas.update(settings.DB_PRAGMAS)
+    for name, value in pragmas.items():
+        if name not in PRAGMAS:
+            raise ValueError("Unsupported pragma {}".format(name))
+        if not PRAGMA_VALUE_RE.match(value):
+            raise ValueError("Invalid value {} for pragma {}".format(value, name))
+    return(pragmas)
+
 engine = create_engine(settings.DB_URI)
+current_profile = settings.DB_PROFILE
+
+@event.listens_for(engine, 'connect')
+def set_pragmas(dbapi_connection, connection_record):
+    if engine.dialect.name != 'sqlite':
+        return
+    cursor = dbapi_connection.cursor()
+    for name, value in get_pragmas(current_profile).items():
+        cursor.execute('PRAGMA {} = {}'.format(name, value))
+    cursor.close()
+
+@contextmanager
+def profile(profile_name, sessions=()):
+    """
+    Uses a pragmas profile for the connections opened within the block.
+
+    The given sessions are closed when entering and leaving the block, so
+    that their next transaction opens a connection with the right profile.
+    """
+    global current_profile
+    get_pragmas(profile_name)
+    previous_profile = current_profile
+    for session in sessions:
+        session.close()
+    current_profile = profile_name
+    try:
+        yield
+    finally:
+        current_profile = previous_profile
+        for session in sessions:
+            session.close()
 
 session_factory = sessionmaker(bind=engine)
 Session = scoped_session(session_factory)
@@ -63,17 +134,17 @@ class ContratoXls(Base):
     TITULO_EXPEDIENTE = Column(String)
     PLANTILLA_EXPEDIENTE = Column(String)
     NUMERO_PROCEDIMIENTO = Column(String)
-    EXP_F_FALLO = Column(String) # DateTime, actually date in format %Y-%m-%d 00:00:00 GMT
-    PROC_F_PUBLICACION = Column(String) # DateTime, in format %Y-%m-%d %H:%M
-    FECHA_APERTURA_PROPOSICIONES = Column(String) # DateTime, in format %Y-%m-%d %H:%M
+    EXP_F_FALLO = Column(Date) # exported as %Y-%m-%d 00:00:00 GMT
+    PROC_F_PUBLICACION = Column(DateTime) # exported as %Y-%m-%d %H:%M
+    FECHA_APERTURA_PROPOSICIONES = Column(DateTime) # exported as %Y-%m-%d %H:%M
     CARACTER = Column(String)
     TIPO_CONTRATACION = Column(String)
     TIPO_PROCEDIMIENTO = Column(String)
     FORMA_PROCEDIMIENTO = Column(String)
     CODIGO_CONTRATO = Column(Integer, primary_key=True)
     TITULO_CONTRATO = Column(String)
-    FECHA_INICIO = Column(String) # Date, in format %Y-%m-%d
-    FECHA_FIN = Column(String) # Date, in format %Y-%m-%d
+    FECHA_INICIO = Column(Date) # exported as %Y-%m-%d
+    FECHA_FIN = Column(Date) # exported as %Y-%m-%d
     IMPORTE_CONTRATO = Column(Float)
     MONEDA = Column(String)
     ESTATUS_CONTRATO = Column(String)
@@ -82,7 +153,7 @@ class ContratoXls(Base):
     RAMO = Column(String)
     CLAVE_PROGRAMA = Column(String)
     APORTACION_FEDERAL = Column(Float)
-    FECHA_CELEBRACION = Column(String) # DateTime, actually date in format %Y-%m-%d 00:00:00 GMT
+    FECHA_CELEBRACION = Column(Date) # exported as %Y-%m-%d 00:00:00 GMT
     CONTRATO_MARCO = Column(Boolean)
     IDENTIFICADOR_CM = Column(String)
     COMPRA_CONSOLIDADA = Column(Boolean)
@@ -100,6 +171,17 @@ class ContratoXls(Base):
     ANUNCIO = Column(String)
     _SOURCE = Column(String, primary_key=True)
     _UPDATED = Column(DateTime)
+    _FINGERPRINT = Column(String) # SHA1 of the other columns, see xlsx.fingerprint
+
+    __table_args__ = (
+        Index('ix_contratos_xls_source_fingerprint',
+              '_SOURCE', 'CODIGO_CONTRATO', '_FINGERPRINT'),
+        Index('ix_contratos_xls_source_anuncio', '_SOURCE', 'ANUNCIO'),
+        Index('ix_contratos_xls_anuncio', 'ANUNCIO'),
+        Index('ix_contratos_xls_proc_f_publicacion', 'PROC_F_PUBLICACION'),
+        Index('ix_contratos_xls_fecha_celebracion', 'FECHA_CELEBRACION'),
+        Index('ix_contratos_xls_source_updated', '_SOURCE', '_UPDATED'),
+    )
 
 class ContratoXlsHistorial(Base):
     __tablename__ = 'contratos_xls_hist'
@@ -114,17 +196,17 @@ class ContratoXlsHistorial(Base):
     TITULO_EXPEDIENTE = Column(String)
     PLANTILLA_EXPEDIENTE = Column(String)
     NUMERO_PROCEDIMIENTO = Column(String)
-    EXP_F_FALLO = Column(String) # DateTime, actually date in format %Y-%m-%d 00:00:00 GMT
-    PROC_F_PUBLICACION = Column(String) # DateTime, in format %Y-%m-%d %H:%M
-    FECHA_APERTURA_PROPOSICIONES = Column(String) # DateTime, in format %Y-%m-%d %H:%M
+    EXP_F_FALLO = Column(Date) # exported as %Y-%m-%d 00:00:00 GMT
+    PROC_F_PUBLICACION = Column(DateTime) # exported as %Y-%m-%d %H:%M
+    FECHA_APERTURA_PROPOSICIONES = Column(DateTime) # exported as %Y-%m-%d %H:%M
     CARACTER = Column(String)
     TIPO_CONTRATACION = Column(String)
     TIPO_PROCEDIMIENTO = Column(String)
     FORMA_PROCEDIMIENTO = Column(String)
     CODIGO_CONTRATO = Column(Integer)
     TITULO_CONTRATO = Column(String)
-    FECHA_INICIO = Column(String) # Date, in format %Y-%m-%d
-    FECHA_FIN = Column(String) # Date, in format %Y-%m-%d
+    FECHA_INICIO = Column(Date) # exported as %Y-%m-%d
+    FECHA_FIN = Column(Date) # exported as %Y-%m-%d
     IMPORTE_CONTRATO = Column(Float)
     MONEDA = Column(String)
     ESTATUS_CONTRATO = Column(String)
@@ -133,7 +215,7 @@ class ContratoXlsHistorial(Base):
     RAMO = Column(String)
     CLAVE_PROGRAMA = Column(String)
     APORTACION_FEDERAL = Column(Float)
-    FECHA_CELEBRACION = Column(String) # DateTime, actually date in format %Y-%m-%d 00:00:00 GMT
+    FECHA_CELEBRACION = Column(Date) # exported as %Y-%m-%d 00:00:00 GMT
     CONTRATO_MARCO = Column(Boolean)
     IDENTIFICADOR_CM = Column(String)
     COMPRA_CONSOLIDADA = Column(Boolean)
@@ -151,9 +233,38 @@ class ContratoXlsHistorial(Base):
     ANUNCIO = Column(String)
     _SOURCE = Column(String)
     _UPDATED = Column(DateTime)
+    _SUPERSEDED = Column(DateTime) # when the next version or the deletion was exported
     _REMOVED = Column(Boolean)
     _ID = Column(Integer, primary_key=True, autoincrement=True)
 
+    __table_args__ = (
+        Index('ix_contratos_xls_hist_contrato',
+              'CODIGO_CONTRATO', '_SOURCE', '_UPDATED'),
+        Index('ix_contratos_xls_hist_source_superseded',
+              '_SOURCE', '_SUPERSEDED', '_UPDATED'),
+    )
+
+class ContratoXlsDelta(Base):
+    """
+    A previous version of a contract, stored as the values of the columns
+    that changed in the next version. See history.contract_versions.
+    """
+    __tablename__ = 'contratos_xls_delta'
+
+    _ID = Column(Integer, primary_key=True, autoincrement=True)
+    CODIGO_CONTRATO = Column(Integer)
+    _SOURCE = Column(String)
+    _UPDATED = Column(DateTime) # when the previous version was first exported
+    _SUPERSEDED = Column(DateTime) # when the next version was exported
+    _CHANGES = Column(JSONEncodedObject) # dict, previous value of each changed column
+
+    __table_args__ = (
+        Index('ix_contratos_xls_delta_contrato',
+              'CODIGO_CONTRATO', '_SOURCE', '_UPDATED'),
+        Index('ix_contratos_xls_delta_source_superseded',
+              '_SOURCE', '_SUPERSEDED', '_UPDATED'),
+    )
+
 class SourceXls(Base):
     __tablename__ = 'sources_xls'
 
@@ -161,6 +272,89 @@ class SourceXls(Base):
     _UPDATED = Column(DateTime, primary_key=True)
     SHA256 = Column(String)
 
+    __table_args__ = (
+        Index('ix_sources_xls_sha256', 'SHA256'),
+    )
+
+class RemoteXls(Base):
+    __tablename__ = 'remotes_xls'
+
+    _SOURCE = Column(String, primary_key=True)
+    URL = Column(String)
+    LAST_MODIFIED = Column(String) # Last-Modified header of the last version seen
+    ETAG = Column(String) # ETag header of the last version seen
+    _CHECKED = Column(DateTime)
+
+class LoadRun(Base):
+    """An import of an Excel export, see xlsx.load_source_df"""
+    __tablename__ = 'load_runs'
+
+    _ID = Column(Integer, primary_key=True, autoincrement=True)
+    _SOURCE = Column(String)
+    _UPDATED = Column(DateTime)
+    SHA256 = Column(String)
+    _LOADED = Column(DateTime) # when the export was imported
+    INSERTED = Column(Integer)
+    MODIFIED = Column(Integer)
+    DELETED = Column(Integer)
+    UNCHANGED = Column(Integer)
+
+    __table_args__ = (
+        ForeignKeyConstraint(['_SOURCE', '_UPDATED'],
+                             ['sources_xls._SOURCE', 'sources_xls._UPDATED']),
+        Index('ix_load_runs_source', '_SOURCE', '_UPDATED'),
+    )
+
+class LoadChange(Base):
+    """A contract inserted, modified or deleted by a load run"""
+    __tablename__ = 'load_changes'
+
+    _ID = Column(Integer, primary_key=True, autoincrement=True)
+    RUN_ID = Column(Integer, ForeignKey('load_runs._ID'))
+    CODIGO_CONTRATO = Column(Integer)
+    CHANGE = Column(String) # inserted, modified or deleted
+    # dict, [before, after] of each changed column, before is None for an
+    # insertion and after is None for a deletion
+    COLUMNS = Column(JSONEncodedObject)
+
+    __table_args__ = (
+        Index('ix_load_changes_run', 'RUN_ID'),
+    )
+
+class AnuncioPage(Base):
+    """A fetched anuncio page stored in the archive, see archive.py"""
+    __tablename__ = 'anuncio_pages'
+
+    _ID = Column(Integer, primary_key=True, autoincrement=True)
+    ANUNCIO = Column(String)
+    _FETCHED = Column(DateTime)
+    SHA256 = Column(String) # of the HTML, names the file in the archive
+    URL = Column(String) # of the page, after redirects
+
+    __table_args__ = (
+        Index('ix_anuncio_pages_anuncio', 'ANUNCIO', '_FETCHED'),
+        Index('ix_anuncio_pages_fetched', '_FETCHED'),
+    )
+
+class FrontierUrl(Base):
+    """An anuncio URL in the crawl frontier, see frontier.py"""
+    __tablename__ = 'crawl_frontier'
+
+    ANUNCIO = Column(String, primary_key=True)
+    STATE = Column(String) # pending, leased, done or failed
+    RETRIES = Column(Integer)
+    # when the URL can be leased, for a leased URL when its lease expires
+    NEXT_ELIGIBLE = Column(DateTime)
+    LEASE_ID = Column(String)
+    LEASED_BY = Column(String)
+    _ADDED = Column(DateTime)
+    ERROR = Column(String) # of the last failed attempt
+
+    __table_args__ = (
+        Index('ix_crawl_frontier_state', 'STATE', 'NEXT_ELIGIBLE'),
+        Index('ix_crawl_frontier_lease', 'LEASE_ID'),
+    )
+
 class ContratoWeb(Base):
     __tablename__ = 'contratos_web'
 
@@ -214,3 +408,7 @@ class ContratoWebHistorial(Base):
     _UPDATED = Column(DateTime)
     _REMOVED = Column(Boolean)
     _ID = Column(Integer, primary_key=True, autoincrement=True)
+
+    __table_args__ = (
+        Index('ix_contratos_web_hist_anuncio', 'ANUNCIO', '_UPDATED'),
+    )
@@ -0,0 +1,241 @@
+"""
+Crawl frontier of the web scraper.
+
+The anuncio URLs to scrape are queued in the crawl_frontier table, so that a
+crawl interrupted by a crash, a reboot or a long 429 lockout resumes where
+it stopped, and so that several crawler processes can drain the same
+frontier. Each URL is in one of the states
+
+pending
+    waiting to be fetched, from NEXT_ELIGIBLE on
+leased
+    handed to a crawler, whose lease expires at NEXT_ELIGIBLE
+done
+    fetched and written to contratos_web
+failed
+    given up on after MAX_RETRIES failed attempts
+
+A crawler leases a batch of URLs in a single UPDATE, which SQLite runs
+under its write lock, so no URL is leased by two crawlers at once. A URL is
+marked done in the transaction that writes its item, see
+pipelines.SqlitePipeline, and a failed attempt puts it back to pending with
+an exponential backoff. A crawler renews the leases of the URLs it has not
+finished every LEASE_RENEW_INTERVAL, so that the URLs waiting in its queue,
+for instance during a long 429 lockout, are not leased by another crawler.
+The lease of a crawler that stopped without finishing its URLs expires
+after LEASE_DURATION, and they are leased again.
+"""
+from datetime import datetime, timedelta
+import logging
+import os
+import socket
+import uuid
+
+from sqlalchemy import and_, bindparam, func, select
+
+from .database import engine, FrontierUrl
+
+
+logger = logging.getLogger('compranet.frontier')
+
+PENDING = 'pending'
+LEASED = 'leased'
+DONE = 'done'
+FAILED = 'failed'
+STATES = [PENDING, LEASED, DONE, FAILED]
+
+# number of URLs leased at a time by a crawler
+LEASE_BATCH_SIZE = 20
+# time after which the URLs leased by a crawler that stopped renewing its
+# leases are leased again
+LEASE_DURATION = timedelta(minutes=30)
+# interval between the renewals of the leases of a running crawler, which
+# must be well below LEASE_DURATION
+LEASE_RENEW_INTERVAL = timedelta(minutes=5)
+MAX_RETRIES = 5
+# delay before the first retry of a URL, doubled on each retry
+RETRY_DELAY = timedelta(minutes=5)
+# number of URLs added to the frontier in each statement
+ENQUEUE_BATCH_SIZE = 1000
+# key of the items that holds the lease of their URL
+LEASE_KEY = '_FRONTIER_LEASE'
+
+
+def worker_name():
+    """Returns the name of the crawler process, stored in LEASED_BY"""
+    return('{}:{}'.format(socket.gethostname(), os.getpid()))
+
+def enqueue(urls, now=None, engine=engine):
+    """
+    Adds URLs to the frontier as pending.
+
+    The URLs already in the frontier keep their state, so a URL is never
+    queued twice. urls may be a generator, which is consumed in batches.
+
+    Returns
+    -------
+    int
+        The number of URLs added
+    """
+    if now is None:
+        now = datetime.utcnow()
+    table = FrontierUrl.__table__
+    stmt = table.insert().prefix_with('OR IGNORE')
+    added = 0
+
+    def write(batch):
+        with engine.begin() as conn:
+            return(conn.execute(stmt, [
+                {'ANUNCIO': url, 'STATE': PENDING, 'RETRIES': 0,
+                 'NEXT_ELIGIBLE': now, '_ADDED': now} for url in batch])
+                .rowcount)
+
+    batch = []
+    for url in urls:
+        batch.append(url)
+        if len(batch) >= ENQUEUE_BATCH_SIZE:
+            added += write(batch)
+            batch = []
+    if batch:
+        added += write(batch)
+    logger.info("Added {} URLs to the crawl frontier".format(added))
+    return(added)
+
+def lease_query(now, limit, lease_id, leased_by, expires):
+    """
+    Returns the UPDATE that leases the first limit URLs eligible at now.
+    """
+    table = FrontierUrl.__table__
+    eligible = (select([table.c.ANUNCIO])
+                .where(and_(table.c.STATE.in_([PENDING, LEASED]),
+                            table.c.NEXT_ELIGIBLE <= now))
+                .order_by(table.c.NEXT_ELIGIBLE)
+                .limit(limit))
+    return(table.update()
+           .where(table.c.ANUNCIO.in_(eligible))
+           .values(STATE=LEASED, LEASE_ID=lease_id, LEASED_BY=leased_by,
+                   NEXT_ELIGIBLE=expires))
+
+def lease(limit=LEASE_BATCH_SIZE, worker=None, now=None, engine=engine):
+    """
+    Leases the pending URLs that are eligible, and those whose lease expired.
+
+    Returns
+    -------
+    tuple
+        The lease ID, and the list of URLs leased
+    """
+    if now is None:
+        now = datetime.utcnow()
+    lease_id = uuid.uuid4().hex
+    with engine.begin() as conn:
+        conn.execute(lease_query(now, limit, lease_id,
+                                 worker or worker_name(),
+                                 now + LEASE_DURATION))
+        rs = conn.execute(leased_query(lease_id))
+        urls = [row[0] for row in rs]
+    return((lease_id, urls))
+
+def leased_query(lease_id):
+    """Returns the query of the URLs of a lease"""
+    table = FrontierUrl.__table__
+    return(select([table.c.ANUNCIO]).where(table.c.LEASE_ID == lease_id))
+
+def renew_query(lease_ids, expires):
+    """
+    Returns the UPDATE that extends to expires the leases of the URLs still
+    leased under lease_ids.
+    """
+    table = FrontierUrl.__table__
+    return(table.update()
+           .where(and_(table.c.LEASE_ID.in_(lease_ids),
+                       table.c.STATE == LEASED))
+           .values(NEXT_ELIGIBLE=expires))
+
+def renew(lease_ids, now=None, engine=engine):
+    """
+    Extends the leases of the URLs still leased under lease_ids, which then
+    expire LEASE_DURATION after now.
+
+    Returns
+    -------
+    int
+        The number of URLs whose lease was extended
+    """
+    if len(lease_ids) == 0:
+        return(0)
+    if now is None:
+        now = datetime.utcnow()
+    with engine.begin() as conn:
+        rs = conn.execute(renew_query(lease_ids, now + LEASE_DURATION))
+        return(rs.rowcount)
+
+def complete_query():
+    """
+    Returns the UPDATE that marks a leased URL as done, with the bound
+    parameters url and lease_id.
+    """
+    table = FrontierUrl.__table__
+    return(table.update()
+           .where(and_(table.c.ANUNCIO == bindparam('url'),
+                       table.c.LEASE_ID == bindparam('lease_id')))
+           .values(STATE=DONE, LEASE_ID=None, ERROR=None))
+
+def complete(session, leases):
+    """
+    Marks leased URLs as done, in the current transaction of the session.
+
+    A URL whose lease expired and was leased again by another crawler is
+    left to that crawler.
+
+    Parameters
+    ----------
+    leases : list of tuple
+        The (url, lease ID) of each URL
+    """
+    if len(leases) == 0:
+        return
+    session.execute(complete_query(), [{'url': url, 'lease_id': lease_id}
+                           for url, lease_id in leases])
+
+def fail(url, lease_id, error, now=None, engine=engine):
+    """
+    Records a failed attempt to scrape a leased URL.
+
+    The URL is leased again after RETRY_DELAY, doubled on each retry, or
+    marked as failed after MAX_RETRIES attempts.
+    """
+    if now is None:
+        now = datetime.utcnow()
+    table = FrontierUrl.__table__
+    where = and_(table.c.ANUNCIO == url, table.c.LEASE_ID == lease_id)
+    with engine.begin() as conn:
+        retries = conn.execute(select([table.c.RETRIES]).where(where)).scalar()
+        if retries is None:
+            return
+        retries += 1
+        state = FAILED if retries >= MAX_RETRIES else PENDING
+        conn.execute(table.update().where(where).values(
+                     STATE=state, RETRIES=retries, LEASE_ID=None,
+                     NEXT_ELIGIBLE=now + RETRY_DELAY * 2 ** (retries - 1),
+                     ERROR=error))
+    logger.warning("Failed to scrape {} ({} of {} attempts): {}".format(
+                   url, retries, MAX_RETRIES, error))
+
+def count_states(engine=engine):
+    """Returns the number of URLs of the frontier in each state"""
+    table = FrontierUrl.__table__
+    with engine.connect() as conn:
+        rs = conn.execute(select([table.c.STATE, func.count()])
+                          .group_by(table.c.STATE))
+        counts = dict(rs.fetchall())
+    return({state: counts.get(state, 0) for state in STATES})
+
+def retry_failed(engine=engine):
+    """Puts the failed URLs back to pending, returns their number"""
+    table = FrontierUrl.__table__
+    with engine.begin() as conn:
+        rs = conn.execute(table.update().where(table.c.STATE == FAILED)
+                          .values(STATE=PENDING, RETRIES=0,
+                                  NEXT_ELIGIBLE=datetime.utcnow()))
+        return(rs.rowcount)
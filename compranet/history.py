@@ -0,0 +1,373 @@
+"""
+History of the contracts of the Excel files.
+
+The previous versions of a contract are stored in two tables. A modification
+stores a ContratoXlsDelta with the previous values of the changed columns
+only, and every xlsx.SNAPSHOT_INTERVAL modifications a full copy of the
+previous version in ContratoXlsHistorial instead. A deletion stores a full
+copy of the deleted version followed by a _REMOVED row, which has null
+values except for the contract keys and the time of the deletion.
+
+A version is rebuilt from the nearest newer full copy, which is either the
+current row in ContratoXls or a row of ContratoXlsHistorial, by applying the
+deltas in between from the newest to the oldest. Every version and delta
+records the time it was first exported in _UPDATED and the time of the
+export that replaced it in _SUPERSEDED.
+
+The contracts of a source year as they were exported at a given time are
+read with iter_source_as_of, through the indexes on _SOURCE and
+_SUPERSEDED, so that the cost of a snapshot depends on the size of the
+snapshot and on the changes made since, rather than on the whole history.
+"""
+import logging
+
+from sqlalchemy import and_, select
+
+from .database import ContratoXls, ContratoXlsHistorial, ContratoXlsDelta
+from .database import LoadChange, LoadRun, SourceXls
+from . import xlsx
+
+
+logger = logging.getLogger('compranet.history')
+
+# columns of a version of a contract
+VERSION_COLS = [col.key for col in ContratoXls.__table__.columns
+                if col.key in ContratoXlsHistorial.__table__.columns]
+# number of contracts in each batch yielded by iter_source_as_of
+SNAPSHOT_BATCH_SIZE = 10000
+# number of change events in each batch yielded by iter_changes
+FEED_BATCH_SIZE = 10000
+# keys of the change events yielded by iter_changes
+FEED_COLS = ['RUN_ID', '_SOURCE', '_UPDATED', 'CODIGO_CONTRATO', 'CHANGE',
+             'COLUMNS']
+
+
+def read_events(source, ids, session=xlsx.session):
+    """
+    Reads the current rows and the history of contracts.
+
+    Parameters
+    ----------
+    source : str
+        The source year string, e.g. '2016' or '2010_2012'
+    ids : sequence of int
+        The CODIGO_CONTRATO values of the contracts
+
+    Returns
+    -------
+    dict
+        A list of (kind, row) tuples for each contract, ordered by _UPDATED,
+        where kind is 'current', 'copy', 'removed' or 'delta' and row is a
+        dict
+    """
+    events = {}
+    for ids_chunk in xlsx.chunks([int(cc) for cc in ids]):
+        current, copies, deltas = event_queries(source, ids_chunk)
+        rs = session.execute(current)
+        for row in rs:
+            version = dict(row, _SUPERSEDED=None, _REMOVED=False)
+            events.setdefault(version['CODIGO_CONTRATO'], []).append(
+                ('current', version))
+        rs = session.execute(copies)
+        for row in rs:
+            version = dict(row)
+            kind = 'removed' if version['_REMOVED'] else 'copy'
+            events.setdefault(version['CODIGO_CONTRATO'], []).append(
+                (kind, version))
+        rs = session.execute(deltas)
+        for row in rs:
+            events.setdefault(row['CODIGO_CONTRATO'], []).append(
+                ('delta', dict(row)))
+    for contract_events in events.values():
+        contract_events.sort(key=lambda event: event[1]['_UPDATED'])
+    return(events)
+
+def event_queries(source, ids):
+    """
+    Returns the queries of the current rows and of the history of
+    contracts, see read_events.
+
+    Returns
+    -------
+    tuple
+        The selects of the current rows of ContratoXls, of the rows of
+        ContratoXlsHistorial and of the rows of ContratoXlsDelta
+    """
+    xls = ContratoXls.__table__
+    hist = ContratoXlsHistorial.__table__
+    delta = ContratoXlsDelta.__table__
+    current = (select([xls.c[col] for col in VERSION_COLS])
+               .where(and_(xls.c._SOURCE == source,
+                           xls.c.CODIGO_CONTRATO.in_(ids))))
+    copies = (select([hist.c[col] for col in VERSION_COLS] +
+                     [hist.c._SUPERSEDED, hist.c._REMOVED, hist.c._ID])
+              .where(and_(hist.c._SOURCE == source,
+                          hist.c.CODIGO_CONTRATO.in_(ids))))
+    deltas = (select([delta])
+              .where(and_(delta.c._SOURCE == source,
+                          delta.c.CODIGO_CONTRATO.in_(ids))))
+    return(current, copies, deltas)
+
+def replay(events):
+    """
+    Rebuilds the versions of a contract from its events.
+
+    Parameters
+    ----------
+    events : list of tuple
+        The events of a contract, as returned by read_events
+
+    Returns
+    -------
+    list of dict
+        The versions of the contract, oldest first, with the VERSION_COLS,
+        _SUPERSEDED and _REMOVED keys. A deletion is a version with _REMOVED
+        set to True and null values except for the contract keys.
+    """
+    versions = []
+    newer = None
+    for kind, row in reversed(events):
+        if kind == 'delta':
+            if newer is None:
+                raise ValueError("The delta of contract {} updated on {} has "
+                                 "no newer version".format(
+                                 row['CODIGO_CONTRATO'], row['_UPDATED']))
+            version = dict(newer)
+            version.update((col, xlsx.decode_value(col, val))
+                           for col, val in row['_CHANGES'].items())
+            version.update(_UPDATED=row['_UPDATED'],
+                           _SUPERSEDED=row['_SUPERSEDED'], _REMOVED=False)
+        else:
+            version = {key: row[key] for key in VERSION_COLS}
+            version.update(_SUPERSEDED=row['_SUPERSEDED'],
+                           _REMOVED=bool(row['_REMOVED']))
+        versions.append(version)
+        newer = None if version['_REMOVED'] else version
+    versions.reverse()
+    return(versions)
+
+def contract_versions(codigo, source, session=xlsx.session):
+    """
+    Rebuilds all the versions of a contract.
+
+    Parameters
+    ----------
+    codigo : int
+        The CODIGO_CONTRATO of the contract
+    source : str
+        The source year string, e.g. '2016' or '2010_2012'
+
+    Returns
+    -------
+    list of dict
+        The versions of the contract, oldest first, see replay
+    """
+    events = read_events(source, [codigo], session)
+    return(replay(events.get(int(codigo), [])))
+
+def contract_as_of(codigo, source, when, session=xlsx.session):
+    """
+    Rebuilds the version of a contract that was current at a given time.
+
+    Returns
+    -------
+    dict or None
+        The version exported last on or before when, see replay, or None if
+        the contract had not been exported yet or had been deleted
+    """
+    return(version_as_of(contract_versions(codigo, source, session), when))
+
+def version_as_of(versions, when):
+    """
+    Returns the version that was current at a given time, or None.
+
+    Parameters
+    ----------
+    versions : list of dict
+        The versions of a contract, oldest first, as returned by replay
+    when : datetime
+        The time of the version
+    """
+    current = None
+    for version in versions:
+        if version['_UPDATED'] > when:
+            break
+        current = version
+    if current is None or current['_REMOVED']:
+        return(None)
+    return(current)
+
+def export_times(source, session=xlsx.session):
+    """Returns the times of the exports of a source year that were loaded"""
+    rs = session.execute(export_times_query(source))
+    return([row[0] for row in rs])
+
+def export_times_query(source):
+    """Returns the query of the times of the exports of a source year"""
+    sources = SourceXls.__table__
+    return(select([sources.c._UPDATED])
+           .where(sources.c._SOURCE == source)
+           .order_by(sources.c._UPDATED))
+
+def snapshot_queries(source, when):
+    """
+    Returns the queries of the rows of a source year that were current at a
+    given time.
+
+    Returns
+    -------
+    tuple
+        The selects of the current rows of ContratoXls, of the full copies
+        of ContratoXlsHistorial and of the CODIGO_CONTRATO of the deltas
+    """
+    xls = ContratoXls.__table__
+    hist = ContratoXlsHistorial.__table__
+    delta = ContratoXlsDelta.__table__
+    current = (select([xls.c[col] for col in VERSION_COLS])
+               .where(and_(xls.c._SOURCE == source,
+                           xls.c._UPDATED <= when)))
+    copies = (select([hist.c[col] for col in VERSION_COLS])
+              .where(and_(hist.c._SOURCE == source,
+                          hist.c._SUPERSEDED > when,
+                          hist.c._UPDATED <= when,
+                          hist.c._REMOVED == False)))
+    deltas = (select([delta.c.CODIGO_CONTRATO])
+              .where(and_(delta.c._SOURCE == source,
+                          delta.c._SUPERSEDED > when,
+                          delta.c._UPDATED <= when)))
+    return(current, copies, deltas)
+
+def iter_source_as_of(source, when, session=xlsx.session,
+                      batch_size=SNAPSHOT_BATCH_SIZE):
+    """
+    Reads the contracts of a source year as they were at an export time.
+
+    The contracts are yielded in batches, so that only one batch is held in
+    memory at a time, and in no particular order. The versions that were
+    stored as deltas are rebuilt with replay.
+
+    Parameters
+    ----------
+    source : str
+        The source year string, e.g. '2016' or '2010_2012'
+    when : datetime
+        The _UPDATED time of one of the exports of the source year in
+        the SourceXls table
+    batch_size : int
+        The maximum number of contracts of each batch
+
+    Yields
+    ------
+    list of dict
+        The contracts, with the VERSION_COLS keys
+
+    Raises
+    ------
+    ValueError
+        Raised if no export of the source year was loaded at that time
+    """
+    if when not in export_times(source, session):
+        raise ValueError("No export of source {} was loaded on {}".format(
+                         source, when))
+    current, copies, deltas = snapshot_queries(source, when)
+    for stmt in (current, copies):
+        rs = session.execute(stmt)
+        while True:
+            rows = rs.fetchmany(batch_size)
+            if not rows:
+                break
+            yield [dict(row) for row in rows]
+    rs = session.execute(deltas)
+    while True:
+        ids = [row[0] for row in rs.fetchmany(batch_size)]
+        if not ids:
+            break
+        batch = []
+        for events in read_events(source, ids, session).values():
+            version = version_as_of(replay(events), when)
+            batch.append({col: version[col] for col in VERSION_COLS})
+        yield batch
+
+def read_load_runs(source=None, after=None, session=xlsx.session):
+    """
+    Reads the load runs, oldest first.
+
+    Parameters
+    ----------
+    source : str, optional
+        The source year of the runs, by default all of them
+    after : int, optional
+        Only the runs with a larger _ID are read
+
+    Returns
+    -------
+    list of dict
+        The rows of the LoadRun table
+    """
+    rs = session.execute(load_runs_query(source, after))
+    return([dict(row) for row in rs])
+
+def load_runs_query(source=None, after=None):
+    """Returns the query of the load runs, see read_load_runs"""
+    runs = LoadRun.__table__
+    stmt = select([runs]).order_by(runs.c._ID)
+    if source is not None:
+        stmt = stmt.where(runs.c._SOURCE == source)
+    if after is not None:
+        stmt = stmt.where(runs.c._ID > after)
+    return(stmt)
+
+def iter_changes(run_ids=None, source=None, after=None, session=xlsx.session,
+                 batch_size=FEED_BATCH_SIZE):
+    """
+    Reads the change events of load runs.
+
+    The events of each run are read in pages of batch_size, keyed on their
+    _ID, so that no statement is left open between batches and only one
+    batch is held in memory at a time.
+
+    Parameters
+    ----------
+    run_ids : sequence of int, optional
+        The _ID of the runs, by default those selected by source and after
+    source : str, optional
+        The source year of the runs, by default all of them
+    after : int, optional
+        Only the runs with a larger _ID are read, so that a consumer can
+        resume from the last run it processed
+
+    Yields
+    ------
+    list of dict
+        The change events, with the FEED_COLS keys, in the order of the runs
+        and of the changes
+    """
+    runs = read_load_runs(source, after, session)
+    if run_ids is not None:
+        run_ids = set(run_ids)
+        runs = [run for run in runs if run['_ID'] in run_ids]
+    for run in runs:
+        last_id = 0
+        while True:
+            rows = session.execute(
+                changes_query(run['_ID'], last_id, batch_size)).fetchall()
+            if not rows:
+                break
+            last_id = rows[-1]['_ID']
+            yield [{'RUN_ID': run['_ID'],
+                    '_SOURCE': run['_SOURCE'],
+                    '_UPDATED': run['_UPDATED'],
+                    'CODIGO_CONTRATO': row['CODIGO_CONTRATO'],
+                    'CHANGE': row['CHANGE'],
+                    'COLUMNS': row['COLUMNS']} for row in rows]
+
+def changes_query(run_id, after, limit):
+    """
+    Returns the query of the next change events of a load run, see
+    iter_changes.
+    """
+    changes = LoadChange.__table__
+    return(select([changes])
+           .where(and_(changes.c.RUN_ID == run_id, changes.c._ID > after))
+           .order_by(changes.c._ID)
+           .limit(limit))
@@ -0,0 +1,280 @@
+"""
+Query plan checks for the queries of the xlsx loader and the web scraper.
+
+Each query is compiled for SQLite and passed to EXPLAIN QUERY PLAN. A query
+fails the check when its plan scans one of the contract tables without a
+covering index, which usually means that an index is missing and that the
+query reads the whole table. Run the check after adding a query or changing
+an index, either against the configured database or against an empty
+database created from the models. The statements are built by the same
+query functions that the loader, the history and the scraper execute, so
+that a change of a query is checked as it is made.
+
+The plans are made on an empty copy of the schema of the database, without
+the statistics gathered by ANALYZE, so that the check depends on the
+indexes only and not on the rows. With the statistics of a database that
+holds a single source year, for instance, SQLite rightly scans contratos_xls
+to read that source, although the index on _SOURCE exists.
+"""
+import logging
+import re
+
+from sqlalchemy import bindparam, create_engine, select
+
+from .database import Base, engine
+from .database import ContratoXls, ContratoWebHistorial
+from . import archive
+from . import frontier
+from . import history
+from . import xlsx
+from .web import anuncio_rows_query, missing_anuncios_query
+from .web import rescrape_candidates_query
+
+
+logger = logging.getLogger('compranet.queryplan')
+
+SCAN_RE = re.compile(r'^SCAN (TABLE )?(?P<table>\w+)')
+# order in which the objects of a schema are created
+SCHEMA_ORDER = {'table': 0, 'index': 1, 'view': 2, 'trigger': 3}
+# queries that read every row, for which a scan is the expected plan
+FULL_READS = {'xlsx.load_xlsx_many', 'xlsx.update_fingerprints',
+              'web.schedule_rescrape'}
+
+
+def param(name):
+    """Returns a bound parameter set to NULL"""
+    return(bindparam(name, None))
+
+def ids_param(name, size=2):
+    """Returns a list of bound parameters for an IN clause"""
+    return([param('{}_{}'.format(name, idx)) for idx in range(size)])
+
+def loader_queries():
+    """
+    Returns the queries made by the xlsx loader.
+
+    Returns
+    -------
+    list of tuple
+        The (name, statement) of each query
+    """
+    current, copies, deltas = history.event_queries(param('source'),
+                                                    ids_param('ids'))
+    return([
+        ('xlsx.fetch_xlsx', xlsx.remote_validators_query(ids_param('years'))),
+        ('xlsx.find_loaded',
+         xlsx.loaded_query(param('source'), param('updated')).limit(1)),
+        ('xlsx.find_loaded (sha256)',
+         xlsx.loaded_query(sha256=param('sha256')).limit(1)),
+        ('xlsx.load_xlsx_many', xlsx.loaded_sha256_query()),
+        ('xlsx.read_source_fingerprints',
+         xlsx.source_fingerprints_query(param('source'))),
+        ('xlsx.read_source_db', xlsx.source_rows_query(param('source'))),
+        ('xlsx.read_source_db (ids)',
+         xlsx.source_rows_query(param('source'), ids_param('ids'))),
+        ('xlsx.update_fingerprints', xlsx.stored_sources_query()),
+        ('xlsx.update_df', xlsx.update_query(ContratoXls.__table__)),
+        ('xlsx.load_source_df (delete)',
+         xlsx.delete_query(param('source'), ids_param('ids'))),
+        ('xlsx.read_delta_depths',
+         xlsx.delta_depths_query(param('source'), ids_param('ids'))),
+        ('history.read_events (current)', current),
+        ('history.read_events (copies)', copies),
+        ('history.read_events (deltas)', deltas),
+    ])
+
+def range_queries():
+    """
+    Returns the date range filters on the contracts.
+
+    Returns
+    -------
+    list of tuple
+        The (name, statement) of each query
+    """
+    xls = ContratoXls.__table__
+    return([
+        ('publication date range',
+         select([xls]).where(xls.c.PROC_F_PUBLICACION.between(
+             param('start'), param('end')))),
+        ('signing date range',
+         select([xls]).where(xls.c.FECHA_CELEBRACION.between(
+             param('start'), param('end')))),
+    ])
+
+def history_queries():
+    """
+    Returns the queries of the point-in-time snapshots and of the change
+    feed.
+
+    Returns
+    -------
+    list of tuple
+        The (name, statement) of each query
+    """
+    current, copies, deltas = history.snapshot_queries(param('source'),
+                                                       param('when'))
+    return([
+        ('history.iter_source_as_of (current)', current),
+        ('history.iter_source_as_of (copies)', copies),
+        ('history.iter_source_as_of (deltas)', deltas),
+        ('history.read_load_runs', history.load_runs_query(param('source'))),
+        ('history.iter_changes',
+         history.changes_query(param('run_id'), param('last_id'),
+                               param('limit'))),
+        ('history.export_times', history.export_times_query(param('source'))),
+    ])
+
+def scraper_queries():
+    """
+    Returns the queries made by the web scraper.
+
+    Returns
+    -------
+    list of tuple
+        The (name, statement) of each query
+    """
+    web_hist = ContratoWebHistorial.__table__
+    return([
+        ('web.iter_missing_anuncios',
+         missing_anuncios_query(after=param('after'), limit=param('limit'))),
+        ('web.iter_missing_anuncios (source)',
+         missing_anuncios_query(param('source'), param('after'),
+                                param('limit'))),
+        ('web.upsert_records', anuncio_rows_query(ids_param('ids'))),
+        ('web.schedule_rescrape',
+         rescrape_candidates_query(param('stale_before'))),
+        ('frontier.lease',
+         frontier.lease_query(param('now'), param('limit'), param('lease_id'),
+                              param('leased_by'), param('expires'))),
+        ('frontier.lease (leased)', frontier.leased_query(param('lease_id'))),
+        ('frontier.renew',
+         frontier.renew_query(ids_param('lease_ids'), param('expires'))),
+        ('frontier.complete', frontier.complete_query()),
+        ('archive.reparse_archive', archive.latest_pages_query()),
+        ('archive.reparse_archive (since)',
+         archive.latest_pages_query(param('since'))),
+        ('web history',
+         select([web_hist]).where(web_hist.c.ANUNCIO == param('anuncio'))
+         .order_by(web_hist.c._UPDATED)),
+    ])
+
+def explain(connection, stmt):
+    """
+    Returns the lines of the query plan of a statement.
+
+    The statement is run through EXPLAIN QUERY PLAN with all of its bound
+    parameters set to NULL, including those that are only given a value when
+    the statement is executed, which does not change the plan.
+    """
+    # render_postcompile expands the IN clauses of literal lists, which
+    # newer SQLAlchemy versions otherwise render at execution time
+    compiled = stmt.compile(dialect=connection.dialect,
+                            compile_kwargs={'render_postcompile': True})
+    params = compiled.construct_params({name: None
+                                        for name in compiled.binds})
+    if compiled.positional:
+        params = [params[name] for name in compiled.positiontup]
+    cursor = connection.connection.cursor()
+    try:
+        cursor.execute('EXPLAIN QUERY PLAN ' + str(compiled), params)
+        plan = [row[-1] for row in cursor.fetchall()]
+    finally:
+        cursor.close()
+    return(plan)
+
+def full_scans(plan, tables):
+    """
+    Returns the tables scanned without a covering index in a query plan.
+
+    Only the scans of the given tables are returned, since subqueries,
+    constant rows and the rows of a view materialized for its INSTEAD OF
+    triggers are also reported as scans.
+    """
+    scans = []
+    for line in plan:
+        match = SCAN_RE.match(line)
+        if match is None or 'COVERING INDEX' in line:
+            continue
+        if match.group('table') in tables:
+            scans.append(match.group('table'))
+    return(scans)
+
+def copy_schema(connection):
+    """
+    Creates an empty in-memory database with the schema of a database.
+
+    The copy has the tables, indexes, views and triggers of the database,
+    but neither its rows nor the sqlite_stat tables written by ANALYZE.
+
+    Returns
+    -------
+    sqlalchemy.engine.Engine
+    """
+    rs = connection.execute("SELECT type, sql FROM sqlite_master "
+                            "WHERE sql IS NOT NULL "
+                            "AND name NOT LIKE 'sqlite_%'")
+    rows = sorted(rs.fetchall(), key=lambda row: SCHEMA_ORDER[row[0]])
+    mem_engine = create_engine('sqlite://')
+    # an in-memory database lives as long as its single pooled connection
+    raw_conn = mem_engine.raw_connection()
+    try:
+        raw_conn.connection.executescript(
+            ''.join('{};\n'.format(row[1]) for row in rows))
+    finally:
+        raw_conn.close()
+    return(mem_engine)
+
+def check_query_plans(connection=None, queries=None):
+    """
+    Checks that no query scans a full table.
+
+    The queries in FULL_READS are not checked, since they read every row.
+
+    Parameters
+    ----------
+    connection : sqlalchemy.engine.Connection, optional
+        A connection to the database whose indexes are checked, by default
+        the configured database. The plans are made on a copy of its schema,
+        see copy_schema.
+    queries : list of tuple, optional
+        The (name, statement) of the queries to check, by default those of
+        the loader, the date range filters, the history snapshots and those
+        of the scraper
+
+    Returns
+    -------
+    list of dict
+        The name, plan lines and fully scanned tables of each query
+    """
+    if queries is None:
+        queries = (loader_queries() + range_queries() + history_queries() +
+                   scraper_queries())
+    close = connection is None
+    if connection is None:
+        connection = engine.connect()
+    try:
+        schema_engine = copy_schema(connection)
+    finally:
+        if close:
+            connection.close()
+    with schema_engine.connect() as schema_conn:
+        rs = schema_conn.execute("SELECT name FROM sqlite_master "
+                                 "WHERE type = 'table'")
+        tables = {row[0] for row in rs}
+        results = []
+        for name, stmt in queries:
+            plan = explain(schema_conn, stmt)
+            scans = [] if name in FULL_READS else full_scans(plan, tables)
+            if scans:
+                logger.warning("{} scans {}".format(name, ', '.join(scans)))
+            results.append({'name': name, 'plan': plan, 'scans': scans})
+    schema_engine.dispose()
+    return(results)
+
+def check_models():
+    """Checks the query plans against an empty database built from the models"""
+    mem_engine = create_engine('sqlite://')
+    Base.metadata.create_all(mem_engine)
+    with mem_engine.connect() as connection:
+        return(check_query_plans(connection))
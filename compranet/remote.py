@@ -0,0 +1,250 @@
+"""
+HTTP access to the contracts archives published by CompraNet.
+
+The freshness of the archives is checked with conditional HEAD requests, so
+that an archive that has not changed costs a single round trip, and the
+checks for all the source years run concurrently over one pooled session.
+Stale archives are downloaded concurrently by a bounded pool of workers.
+Each download is written to a .part file that is resumed with a Range
+request after a dropped connection, and is only moved into place once its
+size matches the Content-Length announced by the server.
+"""
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import os
+import re
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+
+logger = logging.getLogger('compranet.remote')
+
+POOL_SIZE = 16
+TIMEOUT = 60
+DOWNLOAD_WORKERS = 4
+DOWNLOAD_ATTEMPTS = 5
+CHUNK_SIZE = 1024 * 1024
+CONTENT_RANGE_RE = re.compile(r'bytes (\d+)-(\d+)/(\d+|\*)')
+
+
+def make_session(pool_size=POOL_SIZE):
+    """
+    Creates an HTTP session with a connection pool of the given size.
+
+    Certificates are not verified, as CompraNet's are not valid.
+    """
+    http = requests.Session()
+    http.verify = False
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+    http.mount('http://', adapter)
+    http.mount('https://', adapter)
+    return(http)
+
+def check_remote(http, url, last_modified=None, etag=None, timeout=TIMEOUT):
+    """
+    Checks whether a remote file has changed since it was last seen.
+
+    Parameters
+    ----------
+    http : requests.Session
+        The HTTP session used for the request
+    url : str
+        The URL of the remote file
+    last_modified : str, optional
+        The Last-Modified header of the version that was last seen
+    etag : str, optional
+        The ETag header of the version that was last seen
+
+    Returns
+    -------
+    dict
+        'modified' is False if the server reported that the file has not
+        changed, and 'last_modified' and 'etag' are the validators of the
+        current version of the file
+    """
+    headers = {}
+    if last_modified:
+        headers['If-Modified-Since'] = last_modified
+    if etag:
+        headers['If-None-Match'] = etag
+    resp = http.head(url, headers=headers, timeout=timeout,
+                     allow_redirects=True)
+    if resp.status_code == 405:
+        # HEAD is not allowed, make a conditional GET without reading the body
+        resp = http.get(url, headers=headers, timeout=timeout, stream=True)
+        resp.close()
+    if resp.status_code == 304:
+        return({'modified': False,
+                'last_modified': last_modified,
+                'etag': etag})
+    resp.raise_for_status()
+    return({'modified': True,
+            'last_modified': resp.headers.get('Last-Modified'),
+            'etag': resp.headers.get('ETag')})
+
+def check_all(http, urls, validators=None, max_workers=POOL_SIZE):
+    """
+    Checks concurrently whether several remote files have changed.
+
+    Parameters
+    ----------
+    http : requests.Session
+        The HTTP session used for the requests
+    urls : dict
+        The URL to check for each key
+    validators : dict, optional
+        The (last_modified, etag) tuple of the version that was last seen
+        for each key
+
+    Returns
+    -------
+    dict
+        The result of check_remote for each key, or the exception raised
+        while checking it
+    """
+    validators = validators or {}
+    results = {}
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {key: executor.submit(check_remote, http, url,
+                                        *validators.get(key, (None, None)))
+                   for key, url in urls.items()}
+        for key, future in futures.items():
+            try:
+                results[key] = future.result()
+            except Exception as exc:
+                results[key] = exc
+    return(results)
+
+def download(http, url, path, if_range=None, max_attempts=DOWNLOAD_ATTEMPTS,
+             timeout=TIMEOUT):
+    """
+    Downloads a remote file, resuming a previous partial download.
+
+    The file is written to path + '.part' and moved to path once its size
+    matches the size announced by the server. If the .part file already
+    exists, or the connection drops, the download is resumed from the end of
+    the .part file with a Range request.
+
+    Parameters
+    ----------
+    http : requests.Session
+        The HTTP session used for the requests
+    url : str
+        The URL of the remote file
+    path : str
+        The path where the file is saved
+    if_range : str, optional
+        The ETag or Last-Modified header of the expected version, so that a
+        partial download of a different version is restarted from scratch
+    max_attempts : int
+        The number of requests to make before giving up
+
+    Returns
+    -------
+    dict
+        The path, the number of bytes received, the elapsed seconds and the
+        throughput in bytes per second
+    """
+    part_path = path + '.part'
+    start = time.time()
+    received = 0
+    attempt = 0
+    while True:
+        attempt += 1
+        offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+        headers = {}
+        if offset > 0:
+            headers['Range'] = 'bytes={}-'.format(offset)
+            if if_range:
+                headers['If-Range'] = if_range
+        try:
+            resp = http.get(url, headers=headers, stream=True, timeout=timeout)
+            try:
+                if resp.status_code == 206:
+                    match = CONTENT_RANGE_RE.match(resp.headers['Content-Range'])
+                    if int(match.group(1)) != offset:
+                        raise IOError("Unexpected Content-Range {}".format(
+                                      resp.headers['Content-Range']))
+                    total = match.group(3)
+                    total = None if total == '*' else int(total)
+                    mode = 'ab'
+                elif resp.status_code == 200:
+                    # the server sent the whole file
+                    length = resp.headers.get('Content-Length')
+                    total = None if length is None else int(length)
+                    mode = 'wb'
+                elif resp.status_code == 416 and offset > 0:
+                    # the .part file does not match the remote file
+                    os.remove(part_path)
+                    continue
+                else:
+                    resp.raise_for_status()
+                    raise IOError("Unexpected status {} for {}".format(
+                                  resp.status_code, url))
+                with open(part_path, mode) as outfile:
+                    for chunk in resp.iter_content(CHUNK_SIZE):
+                        outfile.write(chunk)
+                        received += len(chunk)
+            finally:
+                resp.close()
+        except (requests.ConnectionError, requests.Timeout,
+                requests.exceptions.ChunkedEncodingError) as exc:
+            if attempt >= max_attempts:
+                raise
+            logger.warning("Download of {} interrupted ({}), resuming..."
+                           .format(url, exc))
+            time.sleep(2 ** attempt)
+            continue
+
+        size = os.path.getsize(part_path)
+        if total is not None and size != total:
+            if size < total and attempt < max_attempts:
+                logger.warning("Download of {} incomplete ({} of {} bytes), "
+                               "resuming...".format(url, size, total))
+                continue
+            raise IOError("Downloaded {} bytes of {} from {}".format(
+                          size, total, url))
+        break
+
+    os.replace(part_path, path)
+    elapsed = time.time() - start
+    rate = received / elapsed if elapsed > 0 else float('inf')
+    logger.info("Downloaded {} ({:.1f} MB in {:.1f} s, {:.2f} MB/s)".format(
+                os.path.basename(path), received / 1024**2, elapsed,
+                rate / 1024**2))
+    return({'path': path, 'bytes': received, 'seconds': elapsed,
+            'rate': rate})
+
+def download_all(http, jobs, max_workers=DOWNLOAD_WORKERS):
+    """
+    Downloads several remote files concurrently.
+
+    Parameters
+    ----------
+    http : requests.Session
+        The HTTP session used for the requests
+    jobs : dict
+        The (url, path, if_range) arguments of download for each key
+    max_workers : int
+        The maximum number of files to download at the same time
+
+    Returns
+    -------
+    dict
+        The result of download for each key, or the exception raised while
+        downloading it
+    """
+    results = {}
+    if not jobs:
+        return(results)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {key: executor.submit(download, http, *args)
+                   for key, args in jobs.items()}
+        for key, future in futures.items():
+            try:
+                results[key] = future.result()
+            except Exception as exc:
+                results[key] = exc
+    return(results)
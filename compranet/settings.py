@@ -21,12 +21,25 @@ def rel2abs(path, base_dir=BASE_DIR):
 
 RAW_DIR = rel2abs(main_cfg['raw_dir'])
 INTERIM_DIR = rel2abs(main_cfg['interim_dir'])
+CACHE_DIR = rel2abs(main_cfg.get('cache_dir',
+                                 os.path.join(INTERIM_DIR, 'cache')))
+CACHE_MAX_SIZE = main_cfg.getint('cache_max_size_mb', 2048) * 1024 * 1024
+ARCHIVE_DIR = rel2abs(main_cfg.get('archive_dir',
+                                   os.path.join(INTERIM_DIR, 'archive')))
 SQLITE_DB_PATH = rel2abs(main_cfg['sqlite_db_path'])
 DB_URI = "sqlite:///{}".format(SQLITE_DB_PATH)
 ALEMBIC_INI_PATH = rel2abs(main_cfg['alembic_ini_path'])
 ALEMBIC_SCRIPT_LOCATION = rel2abs(main_cfg['alembic_script_location'])
 VIRTUALENV_PATH = os.path.expanduser(main_cfg['virtualenv_path'])
 
+# SQLite performance profiles, see database.PROFILES
+db_cfg = config['database'] if config.has_section('database') else {}
+DB_PROFILE = db_cfg.get('profile', 'serving')
+DB_PRAGMAS = {key: val for key, val in db_cfg.items() if key != 'profile'}
+DB_PROFILES = {section.split(':', 1)[1]: dict(config[section])
+               for section in config.sections()
+               if section.startswith('database:')}
+
 # Set up logging
 fileConfig(config_path)
 smtp_handler = BufferingSMTPHandler(**config['email'])
@@ -0,0 +1,241 @@
+"""
+Normalized storage of the contract tables.
+
+Most string columns of the contracts Excel files repeat a few thousand
+distinct values, such as the name of the agency or the supplier, over
+millions of rows, and contratos_xls_hist copies them again for every
+version of a contract. In normalized mode each distinct value of the
+columns in INTERNED_COLS is stored once in the xls_strings table, and the
+rows of contratos_xls and contratos_xls_hist are stored in the
+contratos_xls_data and contratos_xls_hist_data tables with the integer ID of
+each string instead of the string.
+
+contratos_xls and contratos_xls_hist are then views with the flat shape of
+the original tables, which join the strings back. INSTEAD OF triggers on the
+views intern new strings and write to the data tables, so the loader and any
+other query keep working unchanged. One caveat is that the primary key of a
+row inserted through the ORM in contratos_xls_hist is not returned, which
+the loader does not rely on since it inserts with executemany.
+
+The mode is switched with normalize and flatten. The Alembic migrations
+expect flat mode. Each migration that alters or indexes the contract tables
+checks in sqlite_master, in its upgrade and its downgrade, that
+contratos_xls is not a view, and stops before changing anything otherwise,
+asking to run 'compranet-cli storage flat' first.
+"""
+import logging
+
+from sqlalchemy import Column, Index, Integer, MetaData, String, Table
+
+from . import database
+from .database import ContratoXls, ContratoXlsHistorial
+
+
+logger = logging.getLogger('compranet.storage')
+
+TABLES = [ContratoXls.__table__, ContratoXlsHistorial.__table__]
+INTERNED_COLS = [
+    'GOBIERNO', 'SIGLAS', 'DEPENDENCIA', 'CLAVEUC', 'NOMBRE_DE_LA_UC',
+    'RESPONSABLE', 'PLANTILLA_EXPEDIENTE', 'CARACTER', 'TIPO_CONTRATACION',
+    'TIPO_PROCEDIMIENTO', 'FORMA_PROCEDIMIENTO', 'MONEDA', 'ESTATUS_CONTRATO',
+    'ARCHIVADO', 'RAMO', 'CLAVE_PROGRAMA', 'ESTRATIFICACION_MUC',
+    'PROVEEDOR_CONTRATISTA', 'ESTRATIFICACION_MPC', 'SIGLAS_PAIS',
+    'ESTATUS_EMPRESA', 'CUENTA_ADMINISTRADA_POR', 'ORGANISMO',
+]
+DATA_SUFFIX = '_data'
+
+strings_metadata = MetaData()
+strings_table = Table('xls_strings', strings_metadata,
+                      Column('ID', Integer, primary_key=True),
+                      Column('VALUE', String, nullable=False, unique=True))
+
+
+def quote(name):
+    return('"{}"'.format(name))
+
+def data_table(table):
+    """
+    Returns the table that stores the rows of a contract table in normalized
+    mode, without its indexes.
+    """
+    columns = [Column(col.name,
+                      Integer if col.name in INTERNED_COLS else col.type,
+                      primary_key=col.primary_key)
+               for col in table.columns]
+    return(Table(table.name + DATA_SUFFIX, MetaData(), *columns))
+
+def data_indexes(table, data):
+    """Returns the indexes of a contract table, on its data table"""
+    return([Index(idx.name, *[data.c[col.name] for col in idx.columns])
+            for idx in table.indexes])
+
+def lookup_sql(value):
+    return('(SELECT ID FROM xls_strings WHERE VALUE = {})'.format(value))
+
+def select_sql(table):
+    """Returns a SELECT with the flat shape of a contract table"""
+    data_name = quote(table.name + DATA_SUFFIX)
+    cols = []
+    joins = []
+    for col in table.columns:
+        if col.name in INTERNED_COLS:
+            alias = quote('s_' + col.name)
+            cols.append('{}.VALUE AS {}'.format(alias, quote(col.name)))
+            joins.append('LEFT JOIN xls_strings AS {a} ON {a}.ID = {d}.{c}'
+                         .format(a=alias, d=data_name, c=quote(col.name)))
+        else:
+            cols.append('{}.{}'.format(data_name, quote(col.name)))
+    return('SELECT {} FROM {} {}'.format(', '.join(cols), data_name,
+                                         ' '.join(joins)))
+
+def trigger_sql(table):
+    """
+    Returns the INSTEAD OF triggers that write through the view of a
+    contract table.
+    """
+    name = quote(table.name)
+    data_name = quote(table.name + DATA_SUFFIX)
+    cols = [col.name for col in table.columns]
+    keys = [col.name for col in table.primary_key.columns]
+
+    def values(row):
+        return(', '.join(lookup_sql('{}.{}'.format(row, quote(col)))
+                         if col in INTERNED_COLS
+                         else '{}.{}'.format(row, quote(col))
+                         for col in cols))
+
+    def intern(row):
+        rows = ' UNION ALL '.join('SELECT {}.{} AS VALUE'.format(row, quote(col))
+                                  for col in cols if col in INTERNED_COLS)
+        return('INSERT OR IGNORE INTO xls_strings (VALUE) '
+               'SELECT VALUE FROM ({}) WHERE VALUE IS NOT NULL;'.format(rows))
+
+    where = ' AND '.join('{c} = OLD.{c}'.format(c=quote(key)) for key in keys)
+    assignments = ', '.join(
+        '{} = {}'.format(quote(col),
+                         lookup_sql('NEW.' + quote(col)) if col in INTERNED_COLS
+                         else 'NEW.' + quote(col))
+        for col in cols)
+    return([
+        """CREATE TRIGGER {trg} INSTEAD OF INSERT ON {name} BEGIN
+            {intern}
+            INSERT INTO {data} ({cols}) VALUES ({values});
+        END""".format(trg=quote(table.name + '_insert'), name=name,
+                      intern=intern('NEW'), data=data_name,
+                      cols=', '.join(quote(col) for col in cols),
+                      values=values('NEW')),
+        """CREATE TRIGGER {trg} INSTEAD OF UPDATE ON {name} BEGIN
+            {intern}
+            UPDATE {data} SET {assignments} WHERE {where};
+        END""".format(trg=quote(table.name + '_update'), name=name,
+                      intern=intern('NEW'), data=data_name,
+                      assignments=assignments, where=where),
+        """CREATE TRIGGER {trg} INSTEAD OF DELETE ON {name} BEGIN
+            DELETE FROM {data} WHERE {where};
+        END""".format(trg=quote(table.name + '_delete'), name=name,
+                      data=data_name, where=where),
+    ])
+
+def is_normalized(conn):
+    """Returns whether the contract tables are in normalized mode"""
+    rs = conn.execute("SELECT type FROM sqlite_master WHERE name = ?",
+                      (ContratoXls.__tablename__,))
+    row = rs.fetchone()
+    return(row is not None and row[0] == 'view')
+
+def normalize_table(conn, table):
+    """Moves the rows of a flat contract table to its data table"""
+    name = quote(table.name)
+    logger.info("Normalizing {}...".format(table.name))
+    for col in INTERNED_COLS:
+        conn.execute('INSERT OR IGNORE INTO xls_strings (VALUE) '
+                     'SELECT DISTINCT {c} FROM {t} WHERE {c} IS NOT NULL'
+                     .format(c=quote(col), t=name))
+    data = data_table(table)
+    data.create(conn)
+    cols = [col.name for col in table.columns]
+    exprs = [lookup_sql('{}.{}'.format(name, quote(col)))
+             if col in INTERNED_COLS else '{}.{}'.format(name, quote(col))
+             for col in cols]
+    conn.execute('INSERT INTO {} ({}) SELECT {} FROM {}'.format(
+                 quote(data.name), ', '.join(quote(col) for col in cols),
+                 ', '.join(exprs), name))
+    conn.execute('DROP TABLE {}'.format(name))
+    for idx in data_indexes(table, data):
+        idx.create(conn)
+    conn.execute('CREATE VIEW {} AS {}'.format(name, select_sql(table)))
+    for sql in trigger_sql(table):
+        conn.execute(sql)
+
+def flatten_table(conn, table):
+    """Moves the rows of a contract data table back to a flat table"""
+    name = quote(table.name)
+    logger.info("Flattening {}...".format(table.name))
+    for action in ['insert', 'update', 'delete']:
+        conn.execute('DROP TRIGGER IF EXISTS {}'.format(
+                     quote(table.name + '_' + action)))
+    conn.execute('DROP VIEW {}'.format(name))
+    # the indexes of the data table have the names of those of the flat table
+    for idx in table.indexes:
+        conn.execute('DROP INDEX IF EXISTS {}'.format(quote(idx.name)))
+    table.create(conn)
+    cols = ', '.join(quote(col.name) for col in table.columns)
+    conn.execute('INSERT INTO {} ({}) {}'.format(name, cols,
+                                                 select_sql(table)))
+    conn.execute('DROP TABLE {}'.format(quote(table.name + DATA_SUFFIX)))
+
+def normalize(engine=database.engine, vacuum=True):
+    """
+    Switches the contract tables to normalized mode.
+
+    SQLite commits the transaction before each schema change, so the
+    database should be backed up before switching modes.
+    """
+    with database.profile('bulk-load'):
+        with engine.begin() as conn:
+            if is_normalized(conn):
+                logger.info("The contract tables are already normalized")
+                return
+            strings_table.create(conn, checkfirst=True)
+            for table in TABLES:
+                normalize_table(conn, table)
+        if vacuum:
+            vacuum_db(engine)
+
+def flatten(engine=database.engine, vacuum=True):
+    """
+    Switches the contract tables back to flat mode.
+
+    SQLite commits the transaction before each schema change, so the
+    database should be backed up before switching modes.
+    """
+    with database.profile('bulk-load'):
+        with engine.begin() as conn:
+            if not is_normalized(conn):
+                logger.info("The contract tables are already flat")
+                return
+            for table in TABLES:
+                flatten_table(conn, table)
+            strings_table.drop(conn)
+        if vacuum:
+            vacuum_db(engine)
+
+def vacuum_db(engine=database.engine):
+    """Rebuilds the database file, releasing the space of the dropped tables"""
+    logger.info("Vacuuming the database...")
+    # VACUUM cannot run inside a transaction, and the DBAPI connection only
+    # begins one before data changes
+    conn = engine.raw_connection()
+    try:
+        cursor = conn.cursor()
+        cursor.execute('VACUUM')
+        cursor.close()
+    finally:
+        conn.close()
+
+def db_size(engine=database.engine):
+    """Returns the size of the database in bytes"""
+    with engine.connect() as conn:
+        page_count = conn.execute('PRAGMA page_count').scalar()
+        page_size = conn.execute('PRAGMA page_size').scalar()
+    return(page_count * page_size)
@@ -1,3 +1,6 @@
+import csv
+from datetime import date, datetime
+import json
 from logging.handlers import BufferingHandler
 import smtplib
 
@@ -43,3 +46,56 @@ class BufferingSMTPHandler(BufferingHandler):
             finally:
                 smtp_server.close()
                 self.release()
+
+
+def json_default(obj):
+    """Serializes the dates of the records written by write_records"""
+    if isinstance(obj, datetime):
+        return(obj.isoformat(' '))
+    if isinstance(obj, date):
+        return(obj.isoformat())
+    raise TypeError("{!r} is not JSON serializable".format(obj))
+
+def write_records(batches, outfile, fmt='jsonl', columns=None):
+    """
+    Writes batches of records to a file as JSON Lines or CSV.
+
+    Only one batch is held in memory at a time. In CSV, the values that are
+    lists or dicts are written as JSON.
+
+    Parameters
+    ----------
+    batches : iterable of list of dict
+        The records to write
+    outfile : file
+        A text file open for writing
+    fmt : str
+        'jsonl' or 'csv'
+    columns : list of str, optional
+        The CSV columns, by default the keys of the first record
+
+    Returns
+    -------
+    int
+        The number of records written
+    """
+    if fmt not in ('jsonl', 'csv'):
+        raise ValueError("Unknown format {}".format(fmt))
+    count = 0
+    writer = None
+    for batch in batches:
+        if not batch:
+            continue
+        if fmt == 'jsonl':
+            for rec in batch:
+                outfile.write(json.dumps(rec, default=json_default) + '\n')
+        else:
+            if writer is None:
+                writer = csv.DictWriter(outfile, columns or list(batch[0]),
+                                        extrasaction='ignore')
+                writer.writeheader()
+            writer.writerows({key: json.dumps(val, default=json_default)
+                              if isinstance(val, (dict, list)) else val
+                              for key, val in rec.items()} for rec in batch)
+        count += len(batch)
+    return(count)
@@ -1,76 +1,442 @@
+from collections import OrderedDict
+from datetime import datetime, timedelta
+import heapq
 import json
 import logging
 import os
+import re
 
+import dateutil.tz
 from scrapy.crawler import CrawlerProcess
 from scrapy.utils.project import get_project_settings
+from sqlalchemy import and_, bindparam, exists, func, or_, select
 
-from .database import get_session
+from . import database
+from . import frontier
+from .database import engine, get_session
 from .database import ContratoWeb, ContratoWebHistorial
 from .database import ContratoXls
 from .crawler.compranet_web.spiders.compranet_spider import CompraNetSpider
+from .xlsx import chunks, TZ_CDMX
 
 
 logger = logging.getLogger('compranet.web')
 
+# number of records of a JSON Lines file written in each transaction
+LOAD_BATCH_SIZE = 5000
+# number of missing anuncios read from the database at a time
+MISSING_PAGE_SIZE = 1000
+# number of anuncios scraped again by each run of rescrape
+RESCRAPE_BUDGET = 2000
+# anuncios scraped more recently are not scraped again
+RESCRAPE_MIN_AGE = timedelta(days=1)
+# factor applied to the staleness of an anuncio whose participation period
+# has not ended
+OPEN_WEIGHT = 4
+# increase of the staleness factor for each past change of an anuncio
+CHANGE_WEIGHT = 1
+# dates of the anuncio pages, either DD/MM/YYYY or YYYY-MM-DD, optionally
+# followed by the time
+WEB_DATE_RES = [
+    re.compile(r'(?P<day>\d{1,2})/(?P<month>\d{1,2})/(?P<year>\d{4})'
+               r'(?:\s+(?P<hour>\d{1,2}):(?P<minute>\d{2}))?'),
+    re.compile(r'(?P<year>\d{4})-(?P<month>\d{1,2})-(?P<day>\d{1,2})'
+               r'(?:[\sT]+(?P<hour>\d{1,2}):(?P<minute>\d{2}))?'),
+]
+
 session = get_session()
 
 def read_jl(jl_path, drop_keys={'_CONDITIONAL_PREFIX_FOR'}):
-    """Read a JSON Lines file"""
+    """Reads a JSON Lines file lazily, yielding the record of each line"""
     # TODO: remove drop_keys once scraper removes these fields
-    def drop(d, keys):
-        for key in keys:
-            d.pop(key, None)
-        return(d)
-
     with open(jl_path) as jl_file:
-        jl = [drop(json.loads(line), drop_keys) for line in jl_file]
-        return(jl)
+        for line in jl_file:
+            record = json.loads(line)
+            for key in drop_keys:
+                record.pop(key, None)
+            yield record
+
+def count_lines(path):
+    """Returns the number of lines of a text file"""
+    with open(path) as text_file:
+        return(sum(1 for line in text_file))
+
+def changed_cols(old, rec):
+    """
+    Returns the columns of a scraped record whose values differ from those
+    of the row of the anuncio, ignoring _UPDATED.
+    """
+    return([col for col, val in rec.items()
+            if col not in ('ANUNCIO', '_UPDATED') and old.get(col) != val])
+
+def anuncio_rows_query(anuncios):
+    """Returns the query of the rows of contratos_web of anuncios"""
+    table = ContratoWeb.__table__
+    return(select([table]).where(table.c.ANUNCIO.in_(anuncios)))
+
+def upsert_records(session, records, update=True, history=True):
+    """
+    Inserts or updates rows of contratos_web, matched on ANUNCIO.
+
+    The rows of the ANUNCIOs already in the table are read in chunks, then
+    the new records are inserted and the existing rows updated with
+    executemany, in the current transaction of the session. Only the
+    columns of a record are updated, so a record with only ANUNCIO and
+    _UPDATED, from an anuncio that is no longer visible, keeps the fields
+    scraped before. When several records have the same ANUNCIO the last one
+    is written.
+
+    The previous version of each row whose values changed is copied to
+    contratos_web_hist, so the history table holds every past version of
+    an anuncio, while a row that did not change only has its _UPDATED set.
+    With update set to False the existing rows are left unchanged. With
+    history set to False the changed rows are overwritten without copying
+    them to contratos_web_hist, for records that are not new versions of
+    the anuncios, such as the pages of the archive parsed again.
+
+    Returns
+    -------
+    tuple of int
+        The number of rows inserted, updated and changed, where the rows
+        left unchanged by update set to False are not counted as updated
+    """
+    table = ContratoWeb.__table__
+    latest = OrderedDict((rec['ANUNCIO'], rec) for rec in records)
+    existing = {}
+    for chunk in chunks(list(latest)):
+        rs = session.execute(anuncio_rows_query(chunk))
+        existing.update((row['ANUNCIO'], dict(row)) for row in rs)
+
+    # executemany needs the same keys in every record of a statement
+    inserts = OrderedDict()
+    updates = OrderedDict()
+    previous = []
+    n_changed = 0
+    for anuncio, rec in latest.items():
+        cols = tuple(sorted(rec))
+        if anuncio in existing:
+            if not update:
+                continue
+            old = existing[anuncio]
+            if changed_cols(old, rec):
+                n_changed += 1
+                if history:
+                    old['_REMOVED'] = False
+                    previous.append(old)
+            params = {col: val for col, val in rec.items() if col != 'ANUNCIO'}
+            params['keyANUNCIO'] = anuncio
+            updates.setdefault(cols, []).append(params)
+        else:
+            inserts.setdefault(cols, []).append(rec)
+    if previous:
+        session.execute(ContratoWebHistorial.__table__.insert(), previous)
+    for batch in inserts.values():
+        session.execute(table.insert(), batch)
+    for cols, batch in updates.items():
+        if len(cols) == 1:
+            continue
+        stmt = (table.update()
+                .where(table.c.ANUNCIO == bindparam('keyANUNCIO')))
+        session.execute(stmt, batch)
+    return((len(latest) - len(existing), len(existing) if update else 0,
+            n_changed))
 
-def load_jl(jl_path, updated, urls_path=None, skip_dup=False, session=session):
-    """Load a JSON Lines file to database"""
-    # TODO: implement change tracking
+def load_jl(jl_path, updated, urls_path=None, skip_dup=False, session=session,
+            batch_size=LOAD_BATCH_SIZE):
+    """
+    Loads a JSON Lines file of scraped anuncios to the database.
+
+    The file is read one line at a time and the records are upserted in
+    batches of batch_size, each in its own transaction, so the memory used
+    does not depend on the size of the file. The previous version of an
+    anuncio is saved to contratos_web_hist only when its record changed,
+    see upsert_records.
+
+    Parameters
+    ----------
+    jl_path : str
+        The path of the JSON Lines file
+    updated : datetime
+        The time the anuncios were scraped, stored in _UPDATED
+    urls_path : str, optional
+        The path of a text file with the ANUNCIO of each line of the JSON
+        Lines file, for files written before the scraper stored it
+    skip_dup : bool
+        Whether to skip the anuncios already in the database instead of
+        updating them
+    session: sqlalchemy.orm.session.Session
+        An SQLAlchemy session to connect to the database
+    batch_size : int
+        The number of records written in each transaction
+
+    Returns
+    -------
+    dict
+        The number of anuncios inserted, updated and changed
+    """
     # TODO: remove updated argument once field is added to scraper
     # TODO: remove urls_path and skip_dup after import of old results
-    jl = read_jl(jl_path)
+    records = read_jl(jl_path)
     if urls_path is not None:
-        with open(urls_path) as urls_file:
-            urls = [url.strip() for url in urls_file.readlines()]
-        assert len(urls) == len(jl)
-
-    for idx, json_obj in enumerate(jl):
-        json_obj['_UPDATED'] = updated
-        if urls_path:
-            json_obj['ANUNCIO'] = urls[idx]
-        anuncio = json_obj['ANUNCIO']
-        if anuncio == '':
-            continue
-        if skip_dup:
-            qr = session.query(ContratoWeb).get(anuncio)
-            if qr is None:
-                print("Adding {}".format(anuncio))
-                session.add(ContratoWeb(**json_obj))
-            else:
-                print("Skipping {}".format(anuncio))
-        else:
-            session.add(ContratoWeb(**json_obj))
+        if count_lines(urls_path) != count_lines(jl_path):
+            raise ValueError("{} and {} have different numbers of lines"
+                             .format(urls_path, jl_path))
+        urls_file = open(urls_path)
+        records = (dict(rec, ANUNCIO=url.strip())
+                   for rec, url in zip(records, urls_file))
+
+    counts = {'inserted': 0, 'updated': 0, 'changed': 0}
+
+    def write(batch):
+        inserted, updated, changed = upsert_records(session, batch,
+                                                    update=not skip_dup)
         session.commit()
+        counts['inserted'] += inserted
+        counts['updated'] += updated
+        counts['changed'] += changed
+        logger.info("Loaded {inserted} inserted, {updated} updated and "
+                    "{changed} changed anuncios".format(**counts))
 
-def scrape_missing(source=None):
-    #TODO: add support for tracking scraper history
+    try:
+        with database.profile('bulk-load', [session]):
+            batch = []
+            for rec in records:
+                if rec['ANUNCIO'] == '':
+                    continue
+                rec['_UPDATED'] = updated
+                batch.append(rec)
+                if len(batch) >= batch_size:
+                    write(batch)
+                    batch = []
+            if batch:
+                write(batch)
+    except:
+        session.rollback()
+        raise
+    finally:
+        if urls_path is not None:
+            urls_file.close()
+    return(counts)
+
+def crawl(urls=None, use_frontier=False):
+    """
+    Scrapes anuncio URLs with CompraNetSpider, writing to the database.
+
+    urls may be a generator, which the spider consumes as it schedules the
+    requests. With use_frontier, the URLs are leased from the crawl
+    frontier instead, until none is eligible.
+    """
     settings_module = 'compranet.crawler.compranet_web.settings'
     os.environ['SCRAPY_SETTINGS_MODULE'] = settings_module
-    session = get_session()
-    w_urls = set(x[0] for x in session.query(ContratoWeb.ANUNCIO).all())
-    if source is None:
-        x_urls = set(x[0] for x in session.query(ContratoXls.ANUNCIO).all())
-    else:
-        xls_query = (session.query(ContratoXls.ANUNCIO)
-                     .filter(ContratoXls._SOURCE == source))
-        x_urls = set(x[0] for x in xls_query.all())
-    urls_to_scrape = list(x_urls.difference(w_urls))
     process = CrawlerProcess(get_project_settings())
-    process.crawl(CompraNetSpider, urls=urls_to_scrape)
+    process.crawl(CompraNetSpider, urls=urls, use_frontier=use_frontier)
     process.start()
 
+def missing_anuncios_query(source=None, after=None, limit=MISSING_PAGE_SIZE):
+    """
+    Returns the query of a page of the ANUNCIOs of contratos_xls that are
+    not in contratos_web.
+
+    The query is an anti-join, which reads the ANUNCIOs in the order of the
+    index of contratos_xls on ANUNCIO and looks each one up in the primary
+    key of contratos_web.
+
+    Parameters
+    ----------
+    source : str, optional
+        Only the ANUNCIOs of the contracts of this source year are selected
+    after : str, optional
+        The last ANUNCIO of the previous page
+    limit : int
+        The number of ANUNCIOs in the page
+    """
+    xls = ContratoXls.__table__
+    web = ContratoWeb.__table__
+    conditions = [xls.c.ANUNCIO != None, xls.c.ANUNCIO != '',
+                  ~exists().where(web.c.ANUNCIO == xls.c.ANUNCIO)]
+    if source is not None:
+        conditions.append(xls.c._SOURCE == source)
+    if after is not None:
+        conditions.append(xls.c.ANUNCIO > after)
+    return(select([xls.c.ANUNCIO]).where(and_(*conditions))
+           .group_by(xls.c.ANUNCIO).order_by(xls.c.ANUNCIO).limit(limit))
+
+def iter_missing_anuncios(source=None, page_size=MISSING_PAGE_SIZE,
+                          engine=engine):
+    """
+    Yields the ANUNCIOs of contratos_xls that are not in contratos_web.
+
+    The ANUNCIOs are read a page at a time with keyset pagination on
+    ANUNCIO, each page in its own short transaction, so the memory used does
+    not depend on the number of contracts, and the crawl can write to the
+    database between pages. An anuncio scraped while the pages are read
+    has already been yielded, so no anuncio is skipped or yielded twice.
+
+    Parameters
+    ----------
+    source : str, optional
+        Only the ANUNCIOs of the contracts of this source year are yielded
+    page_size : int
+        The number of ANUNCIOs read at a time
+    """
+    after = None
+    while True:
+        with engine.connect() as conn:
+            page = [row[0] for row in conn.execute(
+                missing_anuncios_query(source, after, page_size))]
+        for anuncio in page:
+            yield anuncio
+        if len(page) < page_size:
+            return
+        after = page[-1]
+
+def scrape_missing(source=None):
+    """
+    Scrapes the anuncios of the contracts that have not been scraped yet.
+
+    The missing anuncios are added to the crawl frontier, which keeps the
+    state of those queued by earlier runs, and the frontier is drained. An
+    interrupted run resumes where it stopped, and several processes may run
+    scrape_missing at once without fetching a URL twice.
+
+    Parameters
+    ----------
+    source : str, optional
+        Only the anuncios of the contracts of this source year are added
+    """
+    frontier.enqueue(iter_missing_anuncios(source))
+    crawl(use_frontier=True)
+
+def parse_web_date(value):
+    """
+    Parses a date of an anuncio page, such as FECHA_APERTURA_PROPOSICIONES.
+
+    The last date of the value is returned, or None if it has no date.
+    """
+    if not value:
+        return(None)
+    for date_re in WEB_DATE_RES:
+        matches = list(date_re.finditer(value))
+        if len(matches) == 0:
+            continue
+        # the end of a period is its last date
+        match = matches[-1]
+        parts = {key: int(val) for key, val in match.groupdict().items()
+                 if val is not None}
+        try:
+            return(datetime(**parts))
+        except ValueError:
+            return(None)
+    return(None)
+
+def parse_web_date_utc(value):
+    """
+    Parses a date of an anuncio page, which is in Mexico City time, as a
+    naive datetime in UTC, the time of the _UPDATED column.
+    """
+    parsed = parse_web_date(value)
+    if parsed is None:
+        return(None)
+    return(parsed.replace(tzinfo=TZ_CDMX).astimezone(dateutil.tz.tzutc())
+           .replace(tzinfo=None))
+
+def rescrape_score(updated, apertura, changes, now):
+    """
+    Returns the priority of scraping an anuncio again.
+
+    The score is the number of days since the anuncio was scraped, so that
+    every anuncio is eventually refreshed, multiplied by the likelihood
+    that its page changed in that time. An anuncio whose participation
+    period has not ended is still receiving clarifications and annexes, and
+    one that changed often before is likely to change again.
+
+    The times are naive datetimes in UTC.
+
+    Parameters
+    ----------
+    updated : datetime or None
+        The time the anuncio was last scraped, None if unknown
+    apertura : datetime or None
+        The end of the participation period of the anuncio
+    changes : int
+        The number of past versions of the anuncio in contratos_web_hist
+    now : datetime
+        The current time
+    """
+    if updated is None:
+        age = 365.0
+    else:
+        age = max((now - updated).total_seconds(), 0) / 86400
+    score = age * (1 + CHANGE_WEIGHT * changes)
+    if apertura is not None and apertura > now:
+        score *= OPEN_WEIGHT
+    return(score)
+
+def rescrape_candidates_query(stale_before):
+    """
+    Returns the query of the anuncios scraped before stale_before, with
+    their number of past versions.
+    """
+    web = ContratoWeb.__table__
+    hist = ContratoWebHistorial.__table__
+    changes = (select([hist.c.ANUNCIO, func.count().label('CHANGES')])
+               .group_by(hist.c.ANUNCIO).alias('changes'))
+    return(select([web.c.ANUNCIO, web.c._UPDATED,
+                   web.c.FECHA_APERTURA_PROPOSICIONES,
+                   func.coalesce(changes.c.CHANGES, 0)])
+           .select_from(web.outerjoin(changes,
+                                      web.c.ANUNCIO == changes.c.ANUNCIO))
+           .where(or_(web.c._UPDATED < stale_before, web.c._UPDATED == None)))
+
+def schedule_rescrape(budget=RESCRAPE_BUDGET, min_age=RESCRAPE_MIN_AGE,
+                      now=None, session=session):
+    """
+    Chooses the anuncios to scrape again within a budget of requests.
+
+    The anuncios scraped at least min_age ago are ranked by rescrape_score,
+    streaming the rows of contratos_web and keeping only the best budget
+    anuncios in memory. The times are compared in UTC, in which the crawler
+    stores _UPDATED, while the dates of the pages are in Mexico City time
+    and are converted.
+
+    Parameters
+    ----------
+    budget : int
+        The maximum number of anuncios to scrape
+    min_age : datetime.timedelta
+        Anuncios scraped more recently are not scraped again
+    now : datetime, optional
+        The current time in UTC, by default the time of the call
+    session: sqlalchemy.orm.session.Session
+        An SQLAlchemy session to connect to the database
+
+    Returns
+    -------
+    list of tuple
+        The (score, anuncio) of the chosen anuncios, highest score first
+    """
+    if now is None:
+        now = datetime.utcnow()
+    rs = session.execute(rescrape_candidates_query(now - min_age))
+    scored = ((rescrape_score(updated, parse_web_date_utc(apertura), changes,
+                              now), anuncio)
+              for anuncio, updated, apertura, changes in rs)
+    return(heapq.nlargest(budget, scored))
+
+def rescrape(budget=RESCRAPE_BUDGET, min_age=RESCRAPE_MIN_AGE, dry_run=False):
+    """
+    Scrapes again the anuncios chosen by schedule_rescrape.
+
+    The pages that changed since they were last scraped have their previous
+    version saved to contratos_web_hist.
 
+    Returns
+    -------
+    list of tuple
+        The (score, anuncio) of the anuncios scheduled
+    """
+    scheduled = schedule_rescrape(budget, min_age)
+    logger.info("Scheduled {} anuncios to scrape again".format(len(scheduled)))
+    if not dry_run and scheduled:
+        crawl([anuncio for score, anuncio in scheduled])
+    return(scheduled)
@@ -1,9 +1,13 @@
+from collections import deque, OrderedDict
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
+from functools import reduce
 import hashlib
+import io
+from itertools import islice
 import logging
 import os
 import re
-import shutil
 import zipfile
 
 import dateutil.tz
@@ -12,10 +16,17 @@ import pandas as pd
 import numpy as np
 import requests
 from send2trash import send2trash
+from sqlalchemy import and_, bindparam, Boolean, Date, DateTime, Float, Integer
+from sqlalchemy import func, or_, select
 
+from . import database
 from .database import get_session
-from .database import SourceXls, ContratoXls, ContratoXlsHistorial
+from .database import SourceXls, ContratoXls, ContratoXlsHistorial, RemoteXls
+from .database import ContratoXlsDelta, LoadRun, LoadChange
+from . import cache
+from . import remote
 from . import settings
+from . import xlsx_reader
 
 
 requests.packages.urllib3.disable_warnings()
@@ -36,7 +47,36 @@ XLSX_RE = re.compile(XLSX_RE_STR)
 TZ_CDMX = dateutil.tz.gettz('Mexico/General')
 
 NOW_YEAR = datetime.now(TZ_CDMX).year
-ALL_YEARS = (str(year) for year in range(2015, NOW_YEAR + 1))
+ALL_YEARS = [str(year) for year in range(2015, NOW_YEAR + 1)]
+
+# integer columns, which pandas reads as float64 when they are nullable
+INT_COLS = ['CODIGO_EXPEDIENTE', 'CODIGO_CONTRATO', 'CONVENIO_MODIFICATORIO',
+            'CONTRATO_MARCO', 'COMPRA_CONSOLIDADA', 'PLURIANUAL', 'FOLIO_RUPC',
+            'C_EXTERNO']
+# maximum number of bound parameters in an IN clause, below the SQLite limit
+SQL_CHUNK_SIZE = 500
+# number of rows written by each executemany
+WRITE_BATCH_SIZE = 10000
+# columns identifying a contract in the ContratosXls table
+KEY_COLS = ('CODIGO_CONTRATO', '_SOURCE')
+# separator of the column values hashed by fingerprint
+FINGERPRINT_SEP = '\x1f'
+# formats of the date columns in the contracts Excel files
+DATE_FORMATS = OrderedDict([
+    ('EXP_F_FALLO', '%Y-%m-%d %H:%M:%S GMT'),
+    ('PROC_F_PUBLICACION', '%Y-%m-%d %H:%M'),
+    ('FECHA_APERTURA_PROPOSICIONES', '%Y-%m-%d %H:%M'),
+    ('FECHA_INICIO', '%Y-%m-%d'),
+    ('FECHA_FIN', '%Y-%m-%d'),
+    ('FECHA_CELEBRACION', '%Y-%m-%d %H:%M:%S GMT'),
+])
+DATE_COLS = list(DATE_FORMATS)
+# formats of the date values in the changes of the contracts history deltas
+DELTA_DATE_FORMAT = '%Y-%m-%d'
+DELTA_DATETIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+# a modified contract is recorded in the history as a full snapshot instead
+# of a delta once it has this many deltas since its last full copy
+SNAPSHOT_INTERVAL = 10
 
 
 def find_xlsx(years=ALL_YEARS, base_dir=RAW_DIR):
@@ -59,6 +99,38 @@ def latest_xlsx(years=ALL_YEARS):
     """
     return [found[-1] for found in find_xlsx(years).values() if found]
 
+def latest_xlsx_dict(years=ALL_YEARS, base_dir=RAW_DIR):
+    """
+    Returns a dict with the path to the most recent contracts Excel file of
+    each source year that has been downloaded
+    """
+    found_dict = find_xlsx(years, base_dir)
+    return {year: found[-1] for year, found in found_dict.items() if found}
+
+def remote_validators_query(years):
+    """Returns the query of the RemoteXls rows of source years"""
+    remotes = RemoteXls.__table__
+    return(select([remotes]).where(remotes.c._SOURCE.in_(years)))
+
+def save_remote(source, url, check, session=session):
+    """
+    Stores the validators of the version of a remote archive that was seen.
+
+    Parameters
+    ----------
+    source : str
+        The source year string of the archive
+    url : str
+        The URL of the archive
+    check : dict
+        The result of remote.check_remote for the archive
+    """
+    session.merge(RemoteXls(_SOURCE=source, URL=url,
+                            LAST_MODIFIED=check['last_modified'],
+                            ETAG=check['etag'],
+                            _CHECKED=datetime.now(TZ_CDMX)))
+    session.commit()
+
 def parse_pathname(pathname):
     dirname, filename = os.path.split(pathname)
     match = XLSX_RE.match(filename)
@@ -73,14 +145,20 @@ def pathname_to_updatetime(pathname):
     _, _, _, dt = parse_pathname(pathname)
     return(dt)
 
-def fetch_xlsx(years=ALL_YEARS, raw_dir=RAW_DIR, rm_zip=True):
+def fetch_xlsx(years=ALL_YEARS, raw_dir=RAW_DIR, extract=False, rm_zip=True,
+               max_workers=remote.DOWNLOAD_WORKERS):
     """
     Download new versions of the contracts Excel files if they are newer
 
     Find the newest versions of the contracts Excel files in the raw directory
     for each source year and then check this against the timestamp at the
-    download URL. If there is a newer version, download the archive and
-    extract it.
+    download URL. The checks for all the years are made concurrently with
+    conditional requests, using the validators of the last version seen that
+    are stored in the RemoteXls table. The archives with a newer version are
+    then downloaded concurrently, resuming any partial download left by a
+    previous run. Unless extract is True, the archive is kept as is and
+    renamed after the Excel file it contains, since xlsx2df can read it
+    without extracting it.
 
     Parameters
     ----------
@@ -88,8 +166,12 @@ def fetch_xlsx(years=ALL_YEARS, raw_dir=RAW_DIR, rm_zip=True):
         The source years to download
     raw_dir : str
         The path of the directory containing the contracts Excel files
+    extract : bool
+        Whether to extract the Excel file from the zip archive
     rm_zip : bool
         Whether to delete the zip archive after extracting the Excel file
+    max_workers : int
+        The maximum number of archives to download at the same time
 
     Returns
     -------
@@ -99,21 +181,37 @@ def fetch_xlsx(years=ALL_YEARS, raw_dir=RAW_DIR, rm_zip=True):
 
     downloaded = []
 
+    years = list(years)
+    urls = {year: URL_PREFIX + ZIP_FORMAT.format(year=year) for year in years}
+    latest = latest_xlsx_dict(years, raw_dir)
+    # Only send the validators when there is a previously downloaded file
+    seen = session.execute(remote_validators_query(years))
+    validators = {row._SOURCE: (row.LAST_MODIFIED, row.ETAG)
+                  for row in seen if row._SOURCE in latest}
+    http = remote.make_session()
+    checks = remote.check_all(http, urls, validators)
+
+    stale = {}
     for year in years:
         try:
             zip_name = ZIP_FORMAT.format(year=year)
-            url = URL_PREFIX + zip_name
+            url = urls[year]
+            check = checks[year]
+            if isinstance(check, Exception):
+                raise check
 
             # Check if there is a previously downloaded file
-            latest_list = latest_xlsx([year])
-            if latest_list:
+            if year in latest:
+                if not check['modified']:
+                    logger.info("{} has not been modified".format(zip_name))
+                    save_remote(year, url, check)
+                    continue
+
                 # Find the time that the latest local file was generated
-                loc_time = pathname_to_updatetime(latest_list[-1])
+                loc_time = pathname_to_updatetime(latest[year])
 
                 # Find the last modified time of file on server
-                resp = requests.get(url, stream=True, verify=False)
-                last_mod = resp.headers['Last-Modified']
-                srv_time = dateutil.parser.parse(last_mod)
+                srv_time = dateutil.parser.parse(check['last_modified'])
 
                 msg = ("The server version of {} was modified at {}, "
                        "{} after the local file was generated")
@@ -126,28 +224,55 @@ def fetch_xlsx(years=ALL_YEARS, raw_dir=RAW_DIR, rm_zip=True):
                 # local file was generated.
                 if srv_time < (loc_time + relativedelta(hours=+6)):
                     logger.info("Skipping the download of {}".format(zip_name))
+                    save_remote(year, url, check)
                     continue
 
             # There is a newer version or force is True, so we download
-            print("Downloading {}...".format(zip_name))
             zip_path = os.path.join(raw_dir, zip_name)
-            response = requests.get(url, stream=True, verify=False)
-            if response.status_code == 200:
-                with open(zip_path, 'wb') as f:
-                    shutil.copyfileobj(response.raw, f)
+            # Only resume a partial download of the same version
+            if_range = check['etag'] or check['last_modified']
+            stale[year] = (url, zip_path, if_range)
+        except:
+            logger.exception("Error while checking {}".format(zip_name))
+
+    results = remote.download_all(http, stale, max_workers)
+
+    for year in years:
+        if year not in stale:
+            continue
+        try:
+            zip_name = ZIP_FORMAT.format(year=year)
+            url, zip_path, _ = stale[year]
+            result = results[year]
+            if isinstance(result, Exception):
+                raise result
 
-            # Extract the xlsx from the zip file
-            logger.info("Extracting {}...".format(zip_name))
             with zipfile.ZipFile(zip_path, 'r') as zf:
-                for member in zf.namelist():
-                    zf.extract(member, raw_dir)
-                    downloaded.append(os.path.join(raw_dir, member))
-                zf.extractall(raw_dir)
-
-            if rm_zip:
-                # Trash the zip file after extracting
-                logger.info("Deleting {}...".format(zip_name))
-                send2trash(zip_path)
+                members = zf.namelist()
+                if extract:
+                    # Extract the xlsx from the zip file
+                    logger.info("Extracting {}...".format(zip_name))
+                    zf.extractall(raw_dir)
+
+            if extract:
+                downloaded.extend(os.path.join(raw_dir, m) for m in members)
+                if rm_zip:
+                    # Trash the zip file after extracting
+                    logger.info("Deleting {}...".format(zip_name))
+                    send2trash(zip_path)
+            else:
+                # Name the zip file after the xlsx it contains so that it is
+                # found by find_xlsx
+                if len(members) != 1:
+                    raise ValueError("Unexpected contents of {}: {}"
+                                     .format(zip_name, members))
+                xlsx_name = os.path.basename(members[0])
+                archive_name = os.path.splitext(xlsx_name)[0] + '.zip'
+                archive_path = os.path.join(raw_dir, archive_name)
+                logger.info("Saving {} as {}".format(zip_name, archive_name))
+                os.replace(zip_path, archive_path)
+                downloaded.append(archive_path)
+            save_remote(year, url, checks[year])
         except:
             logger.exception("Error while downloading {}".format(zip_name))
 
@@ -208,14 +333,37 @@ def drop_dup(df):
 
     return(df)
 
-def xlsx2df(pathname):
+def read_excel_xlrd(pathname, converters):
     """
-    Reads an Excel spreadsheet into a dataframe, dropping duplicate rows.
+    Reads a Contratos Excel file with pandas.read_excel and xlrd.
+
+    The Excel file is read into memory first when it is inside a zip archive.
+    """
+    with zipfile.ZipFile(pathname, 'r') as zf:
+        members = zf.namelist()
+        if xlsx_reader.SHEET_PATH in members:
+            xlsx_buf = None
+        elif len(members) == 1:
+            xlsx_buf = io.BytesIO(zf.read(members[0]))
+        else:
+            raise ValueError("Unexpected contents of zip archive: {}"
+                             .format(members))
+    if xlsx_buf is None:
+        return(pd.read_excel(pathname, converters=converters))
+    return(pd.read_excel(xlsx_buf, converters=converters))
+
+def parse_xlsx(pathname, engine='stream'):
+    """
+    Parses a Contratos Excel file into a dataframe, dropping duplicate rows.
 
     Parameters
     ----------
     pathname : str
-        The path of a Contratos Excel file that was retrieved from CompraNet
+        The path of a Contratos Excel file that was retrieved from CompraNet,
+        or of the zip archive containing it
+    engine : {'stream', 'xlrd'}
+        Whether to read the file with the streaming reader in xlsx_reader or
+        with pandas.read_excel, which loads the whole workbook in memory
 
     Returns
     -------
@@ -223,11 +371,140 @@ def xlsx2df(pathname):
     """
     raw_dir, filename, source, updated = parse_pathname(pathname)
     converters = {'RAMO': str}
-    df = pd.read_excel(pathname, converters=converters)
+    if engine == 'stream':
+        df = xlsx_reader.read_xlsx(pathname, converters=converters)
+    elif engine == 'xlrd':
+        df = read_excel_xlrd(pathname, converters)
+    else:
+        raise ValueError("Unknown engine {}".format(engine))
     # The 2010_2012 Excel has duplicate rows, so we drop them.
     if source == '2010_2012':
         df = drop_dup(df)
     assert not df['CODIGO_CONTRATO'].duplicated().any()
+    df = df.reset_index(drop=True)
+    df = parse_dates(df)
+    # files with a different set of columns are rejected by load_source_df
+    if set(fingerprint_cols()).issubset(df.columns):
+        df['_FINGERPRINT'] = fingerprint(df)
+    return(df)
+
+def parse_dates(df):
+    """
+    Converts the date columns of a contracts DataFrame to datetime64.
+
+    Each column is parsed with a single vectorized call using its format in
+    DATE_FORMATS. The few values in another format are then parsed one by
+    one, and those that are not dates become NaT. The columns that have the
+    Date type in the ContratosXls table are truncated to the day.
+
+    Parameters
+    ----------
+    df : pandas.DataFrame
+        A DataFrame read from a contracts Excel file
+
+    Returns
+    -------
+    pandas.DataFrame
+    """
+    df = df.copy()
+    for col, fmt in DATE_FORMATS.items():
+        if col not in df.columns:
+            continue
+        vals = df[col]
+        if not np.issubdtype(vals.dtype, np.datetime64):
+            parsed = pd.to_datetime(vals, format=fmt, errors='coerce')
+            retry = parsed.isnull() & vals.notnull()
+            if retry.any():
+                parsed.loc[retry] = pd.to_datetime(vals[retry], errors='coerce')
+                n_bad = (parsed.isnull() & vals.notnull()).sum()
+                if n_bad > 0:
+                    logger.warning("{} values of {} are not dates".format(
+                                   n_bad, col))
+            vals = parsed
+        if isinstance(ContratoXls.__table__.columns[col].type, Date):
+            vals = vals.dt.floor('D')
+        df[col] = vals
+    return(df)
+
+def fingerprint_cols():
+    """Returns the columns of the ContratosXls table that are fingerprinted"""
+    return([col.key for col in ContratoXls.__table__.columns
+            if not col.key.startswith('_')])
+
+def fingerprint(df):
+    """
+    Computes a fingerprint of the contents of each contract.
+
+    The values of the columns returned by fingerprint_cols are normalized
+    according to the column type in the ContratosXls table, so that a row
+    read from a contracts Excel file and the same row read back from the
+    database have the same fingerprint.
+
+    Parameters
+    ----------
+    df : pandas.DataFrame
+        A contracts DataFrame, read with xlsx2df or from the database
+
+    Returns
+    -------
+    pandas.Series
+        The hexadecimal SHA1 hash of the normalized values of each row
+    """
+    parts = []
+    for col in fingerprint_cols():
+        col_type = ContratoXls.__table__.columns[col].type
+        vals = df[col]
+        null = vals.isnull()
+        if isinstance(col_type, (Integer, Boolean)):
+            vals = vals.where(~null, 0).astype(float).astype(np.int64)
+        elif isinstance(col_type, Float):
+            vals = vals.where(~null, 0).astype(float)
+        elif isinstance(col_type, Date):
+            vals = pd.Series(pd.to_datetime(vals).values
+                             .astype('datetime64[D]').astype(str),
+                             index=vals.index)
+        elif isinstance(col_type, DateTime):
+            vals = pd.Series(pd.to_datetime(vals).values
+                             .astype('datetime64[s]').astype(str),
+                             index=vals.index)
+        vals = vals.astype(str).where(~null, '')
+        parts.append(vals)
+    joined = reduce(lambda left, right: left + FINGERPRINT_SEP + right, parts)
+    return(joined.map(lambda row: hashlib.sha1(row.encode('utf-8')).hexdigest()))
+
+def xlsx2df(pathname, engine='stream', sha256=None, use_cache=True):
+    """
+    Reads an Excel spreadsheet into a dataframe, dropping duplicate rows.
+
+    The parsed dataframe is stored in the parse cache, keyed by the SHA256 of
+    the file, so that later reads of the same file skip the parsing.
+
+    Parameters
+    ----------
+    pathname : str
+        The path of a Contratos Excel file that was retrieved from CompraNet,
+        or of the zip archive containing it
+    engine : {'stream', 'xlrd'}
+        The reader to use if the file is not in the cache, see parse_xlsx
+    sha256 : str, optional
+        The hexadecimal SHA256 hash of the file, computed if not given
+    use_cache : bool
+        Whether to read from and write to the parse cache
+
+    Returns
+    -------
+    pandas.DataFrame
+    """
+    raw_dir, filename, source, updated = parse_pathname(pathname)
+    df = None
+    if use_cache:
+        if sha256 is None:
+            sha256 = hashfile(pathname)
+        df = cache.read_cache(sha256)
+    if df is None:
+        df = parse_xlsx(pathname, engine)
+        if use_cache:
+            cache.write_cache(df, sha256)
     df = df.assign(_SOURCE=source, _UPDATED=updated)
     return(df)
 
@@ -265,11 +542,7 @@ def series2dict(series):
             s[key] = None
 
     # convert int cols from pandas (which are float64 if nullable, otherwise int64)
-    int_cols = ['CODIGO_EXPEDIENTE', 'CODIGO_CONTRATO', 'CONVENIO_MODIFICATORIO',
-                'CONTRATO_MARCO', 'COMPRA_CONSOLIDADA', 'PLURIANUAL', 'FOLIO_RUPC',
-                'C_EXTERNO']
-    float_cols = ['IMPORTE_CONTRATO', 'APORTACION_FEDERAL']
-    for col in int_cols:
+    for col in INT_COLS:
         if col in s:
             fval = s[col]
             if fval is not None:
@@ -278,6 +551,35 @@ def series2dict(series):
 
     return(s)
 
+def df2records(df):
+    """
+    Converts a contracts DataFrame to a list of dictionaries
+
+    This is the DataFrame counterpart of series2dict. NaN is replaced with
+    None and integers are converted where appropriate, so that the records
+    can be passed directly to bulk insert and update statements.
+
+    Parameters
+    ----------
+    df : pandas.DataFrame
+        A contracts DataFrame
+
+    Returns
+    -------
+    list of dict
+    """
+    df = df.astype(object).where(pd.notnull(df), None)
+    records = df.to_dict('records')
+    int_cols = [col for col in INT_COLS if col in df.columns]
+    for rec in records:
+        for col in int_cols:
+            fval = rec[col]
+            if fval is not None:
+                assert np.floor(fval) == fval
+                rec[col] = int(fval)
+
+    return(records)
+
 def dict_diff(d1, d2, ignore_keys={'_UPDATED'}):
     comp_keys = set(d1.keys()).difference(ignore_keys)
     assert comp_keys == set(d2.keys()).difference(ignore_keys)
@@ -292,6 +594,350 @@ def dict_equals(d1, d2, ignore_keys=['_UPDATED']):
     diff = dict_diff(d1, d2, ignore_keys)
     return(len(diff) == 0)
 
+def df_diff(df1, df2):
+    """
+    Compares two DataFrames cell by cell, treating null values as equal.
+
+    Parameters
+    ----------
+    df1, df2 : pandas.DataFrame
+        DataFrames with identical index and columns
+
+    Returns
+    -------
+    pandas.DataFrame
+        A boolean DataFrame that is True where the cells differ
+    """
+    both_null = df1.isnull() & df2.isnull()
+    return(~((df1 == df2) | both_null))
+
+def encode_value(col, value):
+    """
+    Converts a value of a contracts column to a value that can be stored in
+    the JSON changes of a history delta.
+    """
+    if value is None or pd.isnull(value):
+        return(None)
+    col_type = ContratoXls.__table__.c[col].type
+    if isinstance(col_type, DateTime):
+        return(value.strftime(DELTA_DATETIME_FORMAT))
+    if isinstance(col_type, Date):
+        return(value.strftime(DELTA_DATE_FORMAT))
+    if isinstance(value, np.generic):
+        return(value.item())
+    return(value)
+
+def decode_value(col, value):
+    """Converts a value stored by encode_value back to its column type"""
+    if value is None:
+        return(None)
+    col_type = ContratoXls.__table__.c[col].type
+    if isinstance(col_type, DateTime):
+        return(datetime.strptime(value, DELTA_DATETIME_FORMAT))
+    if isinstance(col_type, Date):
+        return(datetime.strptime(value, DELTA_DATE_FORMAT).date())
+    return(value)
+
+def delta_records(df_old, changed, superseded, batch_size=WRITE_BATCH_SIZE):
+    """
+    Builds the history deltas of modified contracts.
+
+    Parameters
+    ----------
+    df_old : pandas.DataFrame
+        The previous versions of the contracts, indexed by CODIGO_CONTRATO
+    changed : pandas.DataFrame
+        A boolean DataFrame with the same index, True where a column has
+        changed in the new version, as returned by df_diff
+    superseded : datetime
+        The export time of the new versions
+
+    Returns
+    -------
+    list of dict
+        Rows of the ContratoXlsDelta table
+    """
+    records = []
+    cols = list(changed.columns)
+    for start in range(0, len(df_old), batch_size):
+        batch = df_old.iloc[start:start + batch_size]
+        masks = changed.loc[batch.index].values
+        for rec, mask in zip(df2records(batch), masks):
+            changes = {col: encode_value(col, rec[col])
+                       for col, flag in zip(cols, mask) if flag}
+            records.append({'CODIGO_CONTRATO': rec['CODIGO_CONTRATO'],
+                            '_SOURCE': rec['_SOURCE'],
+                            '_UPDATED': rec['_UPDATED'],
+                            '_SUPERSEDED': superseded,
+                            '_CHANGES': changes})
+    return(records)
+
+def change_records(run_id, df_old, df_new, changed, batch_size=WRITE_BATCH_SIZE):
+    """
+    Builds the change events of modified contracts.
+
+    Parameters
+    ----------
+    run_id : int
+        The _ID of the LoadRun
+    df_old, df_new : pandas.DataFrame
+        The previous and new versions of the contracts, indexed by
+        CODIGO_CONTRATO
+    changed : pandas.DataFrame
+        A boolean DataFrame with the same index and columns, True where a
+        column has changed, as returned by df_diff
+
+    Returns
+    -------
+    list of dict
+        Rows of the LoadChange table, with the [before, after] values of
+        each changed column
+    """
+    records = []
+    cols = list(changed.columns)
+    for start in range(0, len(df_old), batch_size):
+        old_batch = df_old.iloc[start:start + batch_size]
+        new_batch = df_new.loc[old_batch.index]
+        masks = changed.loc[old_batch.index].values
+        for old, new, mask in zip(df2records(old_batch),
+                                  df2records(new_batch), masks):
+            columns = {col: [encode_value(col, old[col]),
+                             encode_value(col, new[col])]
+                       for col, flag in zip(cols, mask) if flag}
+            records.append({'RUN_ID': run_id,
+                            'CODIGO_CONTRATO': old['CODIGO_CONTRATO'],
+                            'CHANGE': 'modified',
+                            'COLUMNS': columns})
+    return(records)
+
+def row_change_records(run_id, df, change, batch_size=WRITE_BATCH_SIZE):
+    """
+    Builds the change events of inserted or deleted contracts.
+
+    Parameters
+    ----------
+    run_id : int
+        The _ID of the LoadRun
+    df : pandas.DataFrame
+        The inserted contracts, or the last versions of the deleted ones
+    change : {'inserted', 'deleted'}
+        The kind of change
+
+    Returns
+    -------
+    list of dict
+        Rows of the LoadChange table, with [None, after] for each non-null
+        column of an inserted contract and [before, None] for each non-null
+        column of a deleted contract
+    """
+    records = []
+    for start in range(0, len(df), batch_size):
+        for rec in df2records(df.iloc[start:start + batch_size]):
+            values = ((col, encode_value(col, val)) for col, val in rec.items())
+            if change == 'inserted':
+                columns = {col: [None, val] for col, val in values
+                           if val is not None}
+            else:
+                columns = {col: [val, None] for col, val in values
+                           if val is not None}
+            records.append({'RUN_ID': run_id,
+                            'CODIGO_CONTRATO': rec['CODIGO_CONTRATO'],
+                            'CHANGE': change,
+                            'COLUMNS': columns})
+    return(records)
+
+def read_delta_depths(source, ids, session=session):
+    """
+    Counts the history deltas of contracts since their last full copy.
+
+    Parameters
+    ----------
+    source : str
+        The source year string, e.g. '2016' or '2010_2012'
+    ids : sequence of int
+        The CODIGO_CONTRATO values of the contracts
+
+    Returns
+    -------
+    dict
+        The number of deltas superseded after the last full snapshot of each
+        contract, contracts without deltas are missing
+    """
+    depths = {}
+    for ids_chunk in chunks([int(cc) for cc in ids]):
+        rs = session.execute(delta_depths_query(source, ids_chunk))
+        depths.update(rs.fetchall())
+    return(depths)
+
+def delta_depths_query(source, ids):
+    """
+    Returns the query of the number of deltas of contracts since their last
+    full copy, see read_delta_depths.
+    """
+    hist = ContratoXlsHistorial.__table__
+    delta = ContratoXlsDelta.__table__
+    last_copy = (select([func.max(hist.c._SUPERSEDED)])
+                 .where(and_(hist.c.CODIGO_CONTRATO == delta.c.CODIGO_CONTRATO,
+                             hist.c._SOURCE == delta.c._SOURCE,
+                             hist.c._REMOVED == False))
+                 .as_scalar())
+    return(select([delta.c.CODIGO_CONTRATO, func.count()])
+           .where(and_(delta.c._SOURCE == source,
+                       delta.c.CODIGO_CONTRATO.in_(ids),
+                       or_(last_copy == None,
+                           delta.c._SUPERSEDED > last_copy)))
+           .group_by(delta.c.CODIGO_CONTRATO))
+
+def read_source_db(source, session=session, ids=None):
+    """
+    Reads the contracts of a source year from the database.
+
+    Parameters
+    ----------
+    source : str
+        The source year string, e.g. '2016' or '2010_2012'
+
+    session: sqlalchemy.orm.session.Session
+        An SQLAlchemy session to connect to the database
+
+    ids : sequence of int, optional
+        The CODIGO_CONTRATO values to read, by default all of them
+
+    Returns
+    -------
+    pandas.DataFrame
+        A DataFrame with the columns of the ContratosXls table, indexed by
+        CODIGO_CONTRATO
+    """
+    if ids is None:
+        df = pd.read_sql(source_rows_query(source), session.connection(),
+                         parse_dates=DATE_COLS)
+    else:
+        ids = [int(cc) for cc in ids]
+        dfs = [pd.read_sql(source_rows_query(source, ids_chunk),
+                           session.connection(), parse_dates=DATE_COLS)
+               for ids_chunk in chunks(ids)]
+        if len(dfs) == 0:
+            dfs = [pd.read_sql(source_rows_query(source).limit(0),
+                               session.connection(), parse_dates=DATE_COLS)]
+        df = pd.concat(dfs, ignore_index=True)
+    df = df.set_index('CODIGO_CONTRATO', drop=False)
+    return(df)
+
+def source_rows_query(source, ids=None):
+    """
+    Returns the query of the contracts of a source year, or of those with
+    the CODIGO_CONTRATO values in ids.
+    """
+    xls = ContratoXls.__table__
+    stmt = select([xls]).where(xls.c._SOURCE == source)
+    if ids is not None:
+        stmt = stmt.where(xls.c.CODIGO_CONTRATO.in_(ids))
+    return(stmt)
+
+def read_source_fingerprints(source, session=session):
+    """
+    Reads the fingerprints of the contracts of a source year.
+
+    Returns
+    -------
+    pandas.Series
+        The _FINGERPRINT column of the ContratosXls table, indexed by
+        CODIGO_CONTRATO
+    """
+    df = pd.read_sql(source_fingerprints_query(source), session.connection())
+    return(df.set_index('CODIGO_CONTRATO')['_FINGERPRINT'])
+
+def source_fingerprints_query(source):
+    """Returns the query of the fingerprints of a source year"""
+    xls = ContratoXls.__table__
+    return(select([xls.c.CODIGO_CONTRATO, xls.c._FINGERPRINT])
+           .where(xls.c._SOURCE == source))
+
+def stored_sources_query():
+    """Returns the query of the source years in the ContratosXls table"""
+    return(select([ContratoXls.__table__.c._SOURCE]).distinct())
+
+def update_fingerprints(session=session, source=None):
+    """
+    Recomputes the fingerprints of the contracts stored in the database.
+
+    Parameters
+    ----------
+    session: sqlalchemy.orm.session.Session
+        An SQLAlchemy session to connect to the database
+
+    source : str, optional
+        The source year to update, by default all of them
+    """
+    if source is None:
+        rs = session.execute(stored_sources_query())
+        sources = [row[0] for row in rs]
+    else:
+        sources = [source]
+    for source in sources:
+        logger.info("Updating fingerprints of source {}".format(source))
+        df = read_source_db(source, session)
+        df = df.assign(_FINGERPRINT=fingerprint(df))
+        update_df(session, ContratoXls.__table__,
+                  df[['CODIGO_CONTRATO', '_SOURCE', '_FINGERPRINT']])
+    session.commit()
+
+def chunks(seq, size=SQL_CHUNK_SIZE):
+    """Yields successive chunks of a sequence"""
+    for idx in range(0, len(seq), size):
+        yield seq[idx:idx + size]
+
+def insert_records(session, table, records, batch_size=WRITE_BATCH_SIZE):
+    """
+    Inserts rows into a table with executemany, in batches.
+
+    All the records must have the same keys. The statements are executed in
+    the current transaction of the session.
+    """
+    stmt = table.insert()
+    for batch in chunks(records, batch_size):
+        session.execute(stmt, batch)
+
+def insert_df(session, table, df, batch_size=WRITE_BATCH_SIZE):
+    """
+    Inserts the rows of a contracts DataFrame into a table, in batches.
+
+    Only batch_size rows are converted to records at a time.
+    """
+    stmt = table.insert()
+    for start in range(0, len(df), batch_size):
+        session.execute(stmt, df2records(df.iloc[start:start + batch_size]))
+
+def update_query(table, keys=KEY_COLS):
+    """
+    Returns the UPDATE of the rows of a table matched on the keys columns,
+    with the bound parameters 'key' + column for the keys, see update_df.
+    """
+    where = and_(*[table.c[key] == bindparam('key' + key) for key in keys])
+    return(table.update().where(where))
+
+def delete_query(source, ids):
+    """Returns the DELETE of contracts from the ContratosXls table"""
+    xls = ContratoXls.__table__
+    return(xls.delete().where(and_(xls.c._SOURCE == source,
+                                   xls.c.CODIGO_CONTRATO.in_(ids))))
+
+def update_df(session, table, df, keys=KEY_COLS, batch_size=WRITE_BATCH_SIZE):
+    """
+    Updates rows of a table from a contracts DataFrame, in batches.
+
+    The rows are matched on the keys columns and every other column of the
+    DataFrame is updated with executemany.
+    """
+    stmt = update_query(table, keys)
+    renames = {key: 'key' + key for key in keys}
+    for start in range(0, len(df), batch_size):
+        batch = df2records(df.iloc[start:start + batch_size])
+        params = [{renames.get(col, col): val for col, val in rec.items()}
+                  for rec in batch]
+        session.execute(stmt, params)
+
 def load_source_df(df_new, sha256, session=session):
     """
     Finds changes in the new DataFrame and updates the database accordingly.
@@ -300,8 +946,16 @@ def load_source_df(df_new, sha256, session=session):
     against the database to identify the changes in the corresponding source
     year. The changes can be to add a new contract or modify or delete an
     existing contract. New contracts are simply inserted. When a change is made
-    to an existing contract the previous versions are recorded in the
-    ContratosXlsHistorial table.
+    to an existing contract the previous version is recorded in the history,
+    as a ContratoXlsDelta with the previous values of the changed columns or
+    periodically as a full ContratoXlsHistorial snapshot. Deleted contracts
+    are recorded as a full snapshot followed by a _REMOVED row. See
+    history.contract_versions. The import is recorded as a LoadRun, with a
+    LoadChange for each inserted, modified or deleted contract.
+
+    The fingerprints of the whole source year are read from the database in
+    a single query and compared against the new DataFrame. Only the contracts
+    whose fingerprints differ are read in full and compared column by column.
 
     Parameters
     ----------
@@ -321,8 +975,7 @@ def load_source_df(df_new, sha256, session=session):
         ContratosXls table, or if the input dataframe does not correspond
         to a single source and export.
     AssertionError
-        Raised if more than one row is retrieved from a given CODIGO_CONTRATO
-        and _SOURCE.
+        Raised if CODIGO_CONTRATO is not unique in df_new.
     """
     try:
         df_cols = set(df_new.columns)
@@ -339,65 +992,106 @@ def load_source_df(df_new, sha256, session=session):
         source = source[0]
         updated = updated[0]
 
-        cnt_unchanged = cnt_inserted = cnt_modified = cnt_deleted = 0
-
-        def db_get_cc(cc, source):
-            # TODO: replace query with get
-            rs = session.query(ContratoXls).filter(ContratoXls.CODIGO_CONTRATO == cc,
-                                                   ContratoXls._SOURCE == source)
-            assert rs.count() == 1
-            return(rs)
+        assert not df_new['CODIGO_CONTRATO'].duplicated().any()
+        df_new = df_new.set_index('CODIGO_CONTRATO', drop=False)
+        old_fp = read_source_fingerprints(source, session)
 
-        rs = session.query(ContratoXls.CODIGO_CONTRATO).filter(ContratoXls._SOURCE == source)
-        old_ids = set(row[0] for row in rs)
-        new_ids = set(df_new['CODIGO_CONTRATO'])
         # deleted contracts found in db but not in latest xlsx
-        deleted_ids = old_ids.difference(new_ids)
+        deleted_ids = old_fp.index.difference(df_new.index)
         # inserted contracts found in latest xlsx but not in db
-        inserted_ids = new_ids.difference(old_ids)
+        inserted_ids = df_new.index.difference(old_fp.index)
+        # contracts found in both are unchanged if the fingerprint matches
+        common_ids = df_new.index.intersection(old_fp.index)
+        same_fp = (old_fp.loc[common_ids].values ==
+                   df_new.loc[common_ids, '_FINGERPRINT'].values)
+        check_ids = common_ids[~same_fp]
+
+        # otherwise they are modified if any column has changed
+        df_old = read_source_db(source, session,
+                                check_ids.union(deleted_ids))
+        comp_cols = sorted(tbl_cols.difference({'_UPDATED', '_FINGERPRINT'}))
+        changed_cells = df_diff(df_old.loc[check_ids, comp_cols],
+                                df_new.loc[check_ids, comp_cols])
+        changed = changed_cells.any(axis=1)
+        modified_ids = check_ids[changed.values]
+        # the fingerprints of the rest are outdated, e.g. missing
+        refresh_ids = check_ids[~changed.values]
+        hist_cols = [col.key for col in ContratoXls.__table__.columns
+                     if col.key in ContratoXlsHistorial.__table__.columns]
+
+        cnt_deleted = len(deleted_ids)
+        cnt_inserted = len(inserted_ids)
+        cnt_modified = len(modified_ids)
+        cnt_unchanged = len(common_ids) - cnt_modified
+
+        # all the writes below are executed in the session transaction, so
+        # they are rolled back together if any of them fails
+        xls_table = ContratoXls.__table__
+        hist_table = ContratoXlsHistorial.__table__
+        delta_table = ContratoXlsDelta.__table__
 
         # handle deleted contracts
-        for cc in deleted_ids:
-            db_res = db_get_cc(cc, source)
-            db_row = db_res.one()
-            db_dict = row2dict(db_row)
+        hist_rows = []
+        for db_dict in df2records(df_old.loc[deleted_ids, hist_cols]):
             # add row to the hist table for the old version
-            hist_row = ContratoXlsHistorial(_REMOVED=False, **db_dict)
-            session.add(hist_row)
+            hist_rows.append(dict(db_dict, _SUPERSEDED=updated, _REMOVED=False))
             # add row to the hist table for the deletion
-            del_row = ContratoXlsHistorial(CODIGO_CONTRATO=cc, _REMOVED=True,
-                                           _SOURCE=source, _UPDATED=updated)
-            session.add(del_row)
-            # delete the row in the main contract table
-            db_res.delete()
-            cnt_deleted += 1
-
-        # handle modified and inserted contracts
-        for idx, xls_row in df_new.iterrows():
-            cc = xls_row['CODIGO_CONTRATO']
-            xls_dict = series2dict(xls_row)
-            if cc not in inserted_ids: # contract id found in main table
-                db_res = db_get_cc(cc, source)
-                db_row = db_res.one()
-                db_dict = row2dict(db_row)
-                # if there is a change, add old ver to hist table and update
-                if not dict_equals(db_dict, xls_dict):
-                    # add row to history table for the old version
-                    hist_row = ContratoXlsHistorial(_REMOVED=False, **db_dict)
-                    session.add(hist_row)
-                    # update row in main contract table
-                    for key, val in xls_dict.items():
-                        setattr(db_row, key, val)
-                    cnt_modified += 1
-                else: # if there isn't a change, then do nothing
-                    cnt_unchanged += 1
-            else: # contract id not found in main table
-                # add row to the main contract table
-                session.add(ContratoXls(**xls_dict))
-                cnt_inserted += 1
-
-        session.add(SourceXls(_SOURCE=source, _UPDATED=updated, SHA256=sha256))
+            del_row = dict.fromkeys(hist_cols)
+            del_row.update(CODIGO_CONTRATO=db_dict['CODIGO_CONTRATO'],
+                           _REMOVED=True, _SOURCE=source, _UPDATED=updated,
+                           _SUPERSEDED=None)
+            hist_rows.append(del_row)
+        insert_records(session, hist_table, hist_rows)
+        # record the old versions of the modified contracts as deltas with
+        # the previous values of the changed columns, or as full snapshots
+        # every SNAPSHOT_INTERVAL changes so that rebuilding a version never
+        # applies more than SNAPSHOT_INTERVAL deltas
+        depths = read_delta_depths(source, modified_ids, session)
+        snapshot = np.array([depths.get(cc, 0) >= SNAPSHOT_INTERVAL
+                             for cc in modified_ids], dtype=bool)
+        hist_df = (df_old.loc[modified_ids[snapshot], hist_cols]
+                         .assign(_SUPERSEDED=updated, _REMOVED=False))
+        insert_df(session, hist_table, hist_df)
+        delta_ids = modified_ids[~snapshot]
+        insert_records(session, delta_table,
+                       delta_records(df_old.loc[delta_ids, hist_cols],
+                                     changed_cells.loc[delta_ids], updated))
+
+        # delete the rows in the main contract table
+        for cc_chunk in chunks([int(cc) for cc in deleted_ids]):
+            session.execute(delete_query(source, cc_chunk))
+        # update the modified rows in the main contract table
+        update_df(session, xls_table, df_new.loc[modified_ids])
+        refresh_cols = ['CODIGO_CONTRATO', '_SOURCE', '_FINGERPRINT']
+        update_df(session, xls_table, df_new.loc[refresh_ids, refresh_cols])
+        # add the inserted rows to the main contract table
+        insert_df(session, xls_table, df_new.loc[inserted_ids])
+
+        # merge in case the export is being reloaded
+        session.merge(SourceXls(_SOURCE=source, _UPDATED=updated, SHA256=sha256))
+        # record the load run and the contracts it changed
+        rs = session.execute(LoadRun.__table__.insert().values(
+            _SOURCE=source, _UPDATED=updated, SHA256=sha256,
+            _LOADED=datetime.now(), INSERTED=cnt_inserted,
+            MODIFIED=cnt_modified, DELETED=cnt_deleted,
+            UNCHANGED=cnt_unchanged))
+        run_id = rs.inserted_primary_key[0]
+        change_table = LoadChange.__table__
+        insert_records(session, change_table,
+                       row_change_records(run_id,
+                                          df_new.loc[inserted_ids, comp_cols],
+                                          'inserted'))
+        insert_records(session, change_table,
+                       row_change_records(run_id,
+                                          df_old.loc[deleted_ids, comp_cols],
+                                          'deleted'))
+        insert_records(session, change_table,
+                       change_records(run_id,
+                                      df_old.loc[modified_ids, comp_cols],
+                                      df_new.loc[modified_ids, comp_cols],
+                                      changed_cells.loc[modified_ids]))
         session.commit()
+        logger.info("Load run {}".format(run_id))
         logger.info("{} rows unchanged".format(cnt_unchanged))
         logger.info("{} rows inserted".format(cnt_inserted))
         logger.info("{} rows modified".format(cnt_modified))
@@ -407,7 +1101,9 @@ def load_source_df(df_new, sha256, session=session):
         session.rollback()
         raise
 
-def hashfile(pathname, hasher=hashlib.sha256(), blocksize=65536):
+def hashfile(pathname, hasher=None, blocksize=65536):
+    if hasher is None:
+        hasher = hashlib.sha256()
     with open(pathname, 'rb') as infile:
         buf = infile.read(blocksize)
         while len(buf) > 0:
@@ -415,26 +1111,174 @@ def hashfile(pathname, hasher=hashlib.sha256(), blocksize=65536):
             buf = infile.read(blocksize)
         return(hasher.hexdigest())
 
-def load_xlsx(pathname, session=session):
+def find_loaded(source=None, updated=None, sha256=None, session=session):
     """
-    Reads a contracts Excel file and imports the changes the database.
+    Finds a previously loaded export in the SourceXls table.
+
+    Returns
+    -------
+    SourceXls or None
+        The first loaded export matching all the given arguments
+    """
+    stmt = loaded_query(source, updated, sha256)
+    return(session.query(SourceXls).from_statement(stmt.limit(1)).first())
+
+def loaded_query(source=None, updated=None, sha256=None):
+    """
+    Returns the query of the loaded exports matching all the given
+    arguments, see find_loaded.
+    """
+    sources = SourceXls.__table__
+    stmt = select([sources])
+    if source is not None:
+        stmt = stmt.where(sources.c._SOURCE == source)
+    if updated is not None:
+        stmt = stmt.where(sources.c._UPDATED == updated)
+    if sha256 is not None:
+        stmt = stmt.where(sources.c.SHA256 == sha256)
+    return(stmt)
+
+def loaded_sha256_query():
+    """Returns the query of the SHA256 of every loaded export"""
+    return(select([SourceXls.__table__.c.SHA256]))
+
+def import_df(pathname, df_new, sha256, session=session):
+    """
+    Imports a DataFrame read from a contracts Excel file, logging the outcome.
     """
     filename = os.path.basename(pathname)
-    logger.info("Reading {}...".format(filename))
-    sha256 = hashfile(pathname)
-    df_new = xlsx2df(pathname)
     logger.info("Beginning data import from {}".format(filename))
     try:
-        load_source_df(df_new, sha256, session)
+        with database.profile('bulk-load', [session]):
+            load_source_df(df_new, sha256, session)
         logger.info("Successfully imported data from {}".format(filename))
     except:
         logger.exception("Failed to import data from {}".format(filename))
 
-def pull_xlsx(years=ALL_YEARS, session=session):
+def load_xlsx(pathname, session=session, engine='stream', force=False):
+    """
+    Reads a contracts Excel file and imports the changes the database.
+
+    The file is skipped without being read when its export has already been
+    loaded, and without being parsed when its SHA256 matches an export that
+    has already been loaded, unless force is True.
+    """
+    filename = os.path.basename(pathname)
+    _, _, source, updated = parse_pathname(pathname)
+    if not force and find_loaded(source, updated, session=session):
+        logger.info("{} has already been loaded, skipping".format(filename))
+        return
+    logger.info("Reading {}...".format(filename))
+    # the file is hashed in a streaming pass before it is parsed, so that an
+    # export identical to a loaded one is skipped without parsing it
+    sha256 = hashfile(pathname)
+    loaded = find_loaded(sha256=sha256, session=session)
+    if not force and loaded is not None:
+        msg = "{} is identical to the {} export of {}, skipping"
+        logger.info(msg.format(filename, loaded._SOURCE, loaded._UPDATED))
+        return
+    df_new = xlsx2df(pathname, engine=engine, sha256=sha256)
+    import_df(pathname, df_new, sha256, session)
+
+def parse_job(pathname, sha256, engine='stream'):
+    """
+    Parses a contracts Excel file in a worker process, see xlsx2df.
+    """
+    logger.info("Reading {}...".format(os.path.basename(pathname)))
+    return(xlsx2df(pathname, engine=engine, sha256=sha256))
+
+def load_xlsx_many(pathnames, session=session, engine='stream', force=False,
+                   jobs=1):
+    """
+    Reads several contracts Excel files and imports their changes in order.
+
+    The files are parsed in parallel by a pool of jobs processes, while this
+    process imports the parsed DataFrames one at a time, ordered by source
+    year and export time, so that the history of each contract is recorded
+    in the right order. At most jobs files are submitted ahead of the one
+    being imported, so that only that many DataFrames are held in memory
+    however many files are loaded.
+
+    Each file is hashed before it is submitted, and skipped unless force is
+    True when its SHA256 matches an export already loaded or an earlier file
+    of the same call.
+
+    Parameters
+    ----------
+    pathnames : list of str
+        The paths of the contracts Excel files or of the zip archives
+        containing them
+    session: sqlalchemy.orm.session.Session
+        An SQLAlchemy session to connect to the database
+    engine : {'stream', 'xlrd'}
+        The reader used to parse the files, see parse_xlsx
+    force : bool
+        Whether to load files that have already been loaded
+    jobs : int
+        The number of worker processes parsing the files
+    """
+    pathnames = sorted(pathnames, key=lambda p: parse_pathname(p)[2:])
+    if jobs <= 1:
+        for pathname in pathnames:
+            load_xlsx(pathname, session, engine, force)
+        return
+
+    pending = []
+    for pathname in pathnames:
+        _, filename, source, updated = parse_pathname(pathname)
+        if not force and find_loaded(source, updated, session=session):
+            logger.info("{} has already been loaded, skipping".format(filename))
+        else:
+            pending.append(pathname)
+    if force:
+        seen_sha256 = None
+    else:
+        seen_sha256 = {row[0] for row in
+                       session.execute(loaded_sha256_query())}
+    # do not share an open database connection with the worker processes
+    session.close()
+
+    def hashed():
+        """Yields the (pathname, sha256) of the files to parse"""
+        for pathname in pending:
+            sha256 = hashfile(pathname)
+            if seen_sha256 is not None:
+                if sha256 in seen_sha256:
+                    logger.info("{} is identical to an export already loaded "
+                                "or queued, skipping".format(
+                                os.path.basename(pathname)))
+                    continue
+                seen_sha256.add(sha256)
+            yield (pathname, sha256)
+
+    to_parse = hashed()
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        window = deque()
+
+        def submit(count):
+            for pathname, sha256 in islice(to_parse, count):
+                window.append((pathname, sha256,
+                               executor.submit(parse_job, pathname, sha256,
+                                               engine)))
+
+        submit(jobs)
+        while window:
+            pathname, sha256, future = window.popleft()
+            # keep the workers busy while this file is imported
+            submit(1)
+            try:
+                df_new = future.result()
+            except:
+                logger.exception("Failed to read {}".format(
+                                 os.path.basename(pathname)))
+                continue
+            import_df(pathname, df_new, sha256, session)
+            del df_new
+
+def pull_xlsx(years=ALL_YEARS, session=session, engine='stream', force=False,
+              jobs=1):
     """
     Download, process, and load updated Excel files
     """
     downloaded = fetch_xlsx(years)
-    for pathname in downloaded:
-        load_xlsx(pathname, session)
-
+    load_xlsx_many(downloaded, session, engine, force, jobs)
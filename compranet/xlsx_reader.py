@@ -0,0 +1,255 @@
+"""
+Streaming reader for the CompraNet contracts Excel files.
+
+The contracts Excel files are several hundred MB once uncompressed, and
+loading them with xlrd builds the object model of the whole workbook in
+memory. This module instead parses the worksheet XML incrementally, straight
+out of the xlsx archive, and yields the rows in batches. The xlsx file can
+also be read while still inside the Contratos{year}.zip archive that is
+downloaded from CompraNet, in which case the compressed xlsx is copied to a
+temporary file, which is deleted once read.
+"""
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+import re
+import shutil
+import tempfile
+import zipfile
+
+from lxml import etree
+import pandas as pd
+
+
+NS = '{http://schemas.openxmlformats.org/spreadsheetml/2006/main}'
+SHEET_PATH = 'xl/worksheets/sheet1.xml'
+STRINGS_PATH = 'xl/sharedStrings.xml'
+STYLES_PATH = 'xl/styles.xml'
+BATCH_SIZE = 10000
+# size of the blocks copied out of a zip archive
+COPY_BLOCK_SIZE = 1048576
+# strings that pandas reads as NaN by default
+NA_VALUES = {'', '#N/A', '#N/A N/A', '#NA', '-1.#IND', '-1.#QNAN', '-NaN',
+             '-nan', '1.#IND', '1.#QNAN', 'N/A', 'NA', 'NULL', 'NaN', 'nan'}
+# built-in number formats that represent dates or times
+DATE_FMT_IDS = set(range(14, 23)) | {45, 46, 47}
+DATE_FMT_RE = re.compile(r'[dmyhs]', re.IGNORECASE)
+FMT_LITERAL_RE = re.compile(r'"[^"]*"|\[[^\]]*\]|\\.')
+COL_REF_RE = re.compile(r'[A-Z]+')
+EXCEL_EPOCH = datetime(1899, 12, 30)
+
+
+@contextmanager
+def open_workbook(fileobj):
+    """
+    Opens an xlsx file as a zip archive, to be used in a with statement.
+
+    Parameters
+    ----------
+    fileobj : str or file-like object
+        The path of an xlsx file or of a zip archive containing a single xlsx
+        file, or a seekable file object with the contents of either
+
+    Yields
+    ------
+    zipfile.ZipFile
+    """
+    with zipfile.ZipFile(fileobj, 'r') as zf:
+        members = zf.namelist()
+        if SHEET_PATH in members:
+            yield zf
+            return
+        # this is the archive downloaded from CompraNet, open the xlsx inside
+        # it. The members of an archive cannot be seeked, so the xlsx is
+        # copied to a temporary file rather than read into memory.
+        members = [m for m in members if m.lower().endswith('.xlsx')]
+        if len(members) != 1:
+            raise ValueError("Expected a single xlsx file in the archive, "
+                             "found {}".format(members))
+        xlsx_file = tempfile.TemporaryFile()
+        with zf.open(members[0]) as member:
+            shutil.copyfileobj(member, xlsx_file, COPY_BLOCK_SIZE)
+    with xlsx_file, zipfile.ZipFile(xlsx_file, 'r') as xlsx_zf:
+        yield xlsx_zf
+
+def iter_elements(infile, tag):
+    """Incrementally parses an XML file, freeing each element once read"""
+    for _, elem in etree.iterparse(infile, events=('end',), tag=tag):
+        yield elem
+        elem.clear()
+        while elem.getprevious() is not None:
+            del elem.getparent()[0]
+
+def read_shared_strings(zf):
+    """Reads the shared strings table of a workbook into a list"""
+    if STRINGS_PATH not in zf.namelist():
+        return([])
+    strings = []
+    with zf.open(STRINGS_PATH) as infile:
+        for si in iter_elements(infile, NS + 'si'):
+            t = si.find(NS + 't')
+            if t is not None:
+                strings.append(t.text or '')
+            else:
+                # rich text is split into runs
+                runs = si.iterfind(NS + 'r/' + NS + 't')
+                strings.append(''.join(r.text or '' for r in runs))
+    return(strings)
+
+def read_date_styles(zf):
+    """Returns the set of cell style indices that are formatted as dates"""
+    if STYLES_PATH not in zf.namelist():
+        return(set())
+    with zf.open(STYLES_PATH) as infile:
+        styles = etree.parse(infile).getroot()
+    date_fmt_ids = set(DATE_FMT_IDS)
+    for num_fmt in styles.iterfind(NS + 'numFmts/' + NS + 'numFmt'):
+        fmt_code = FMT_LITERAL_RE.sub('', num_fmt.get('formatCode', ''))
+        if DATE_FMT_RE.search(fmt_code):
+            date_fmt_ids.add(int(num_fmt.get('numFmtId')))
+    cell_xfs = styles.iterfind(NS + 'cellXfs/' + NS + 'xf')
+    return({idx for idx, xf in enumerate(cell_xfs)
+            if int(xf.get('numFmtId', 0)) in date_fmt_ids})
+
+def col_index(ref):
+    """Converts a cell reference such as 'AB12' to a 0-based column index"""
+    idx = 0
+    for char in COL_REF_RE.match(ref).group(0):
+        idx = idx * 26 + ord(char) - ord('A') + 1
+    return(idx - 1)
+
+def iter_rows(zf, shared_strings=None, date_styles=None):
+    """
+    Yields the rows of the first worksheet of a workbook as lists.
+
+    Numbers are returned as int when they are integral and as float
+    otherwise, cells formatted as dates as datetime and empty cells and
+    strings in NA_VALUES as None.
+    """
+    if shared_strings is None:
+        shared_strings = read_shared_strings(zf)
+    if date_styles is None:
+        date_styles = read_date_styles(zf)
+    cell_tag = NS + 'c'
+    with zf.open(SHEET_PATH) as infile:
+        for row in iter_elements(infile, NS + 'row'):
+            values = []
+            for cell in row.iterchildren(cell_tag):
+                ref = cell.get('r')
+                if ref is not None:
+                    idx = col_index(ref)
+                    if idx > len(values):
+                        values.extend([None] * (idx - len(values)))
+                values.append(cell_value(cell, shared_strings, date_styles))
+            yield values
+
+def cell_value(cell, shared_strings, date_styles):
+    """Converts a worksheet cell element to a Python value"""
+    cell_type = cell.get('t', 'n')
+    if cell_type == 'inlineStr':
+        value = ''.join(cell.itertext())
+    else:
+        value = cell.findtext(NS + 'v')
+        if value is None:
+            return(None)
+        if cell_type == 's':
+            value = shared_strings[int(value)]
+        elif cell_type == 'b':
+            return(value == '1')
+        elif cell_type == 'e':
+            return(None)
+        elif cell_type == 'n':
+            number = float(value)
+            if int(cell.get('s', 0)) in date_styles:
+                return(EXCEL_EPOCH + timedelta(days=number))
+            if number.is_integer():
+                return(int(number))
+            return(number)
+    if value in NA_VALUES:
+        return(None)
+    return(value)
+
+def iter_batches(fileobj, converters=None, batch_size=BATCH_SIZE):
+    """
+    Reads the first worksheet of an xlsx file in batches of rows.
+
+    The first row of the worksheet is used as the header.
+
+    Parameters
+    ----------
+    fileobj : str or file-like object
+        An xlsx file or zip archive that can be opened with open_workbook
+    converters : dict, optional
+        Functions to apply to the non-null values of the given columns, as
+        in pandas.read_excel
+    batch_size : int
+        The maximum number of rows in each batch
+
+    Yields
+    ------
+    pandas.DataFrame
+    """
+    converters = converters or {}
+    with open_workbook(fileobj) as zf:
+        rows = iter_rows(zf)
+        header = [str(col) for col in next(rows)]
+        n_cols = len(header)
+        conv = [(idx, converters[col]) for idx, col in enumerate(header)
+                if col in converters]
+        batch = []
+        n_batches = 0
+        for values in rows:
+            if not any(val is not None for val in values):
+                continue
+            if len(values) < n_cols:
+                values.extend([None] * (n_cols - len(values)))
+            for idx, func in conv:
+                if values[idx] is not None:
+                    values[idx] = func(values[idx])
+            batch.append(values[:n_cols])
+            if len(batch) == batch_size:
+                yield pd.DataFrame.from_records(batch, columns=header)
+                n_batches += 1
+                batch = []
+        if batch or n_batches == 0:
+            yield pd.DataFrame.from_records(batch, columns=header)
+
+def infer_column(series):
+    """
+    Converts an object column to a numeric or datetime column when all of its
+    values allow it, as pandas.read_excel does.
+    """
+    if series.dtype != object:
+        return(series)
+    values = series.dropna()
+    if len(values) > 0 and values.map(lambda v: isinstance(v, datetime)).all():
+        return(pd.to_datetime(series))
+    return(pd.to_numeric(series, errors='ignore'))
+
+def read_xlsx(fileobj, converters=None, batch_size=BATCH_SIZE):
+    """
+    Reads the first worksheet of an xlsx file into a DataFrame.
+
+    This is a streaming replacement for pandas.read_excel. Each column has
+    the type that pandas.read_excel would give it, except for the columns in
+    converters, which are left as returned by the converter functions.
+
+    Parameters
+    ----------
+    fileobj : str or file-like object
+        An xlsx file or zip archive that can be opened with open_workbook
+    converters : dict, optional
+        Functions to apply to the non-null values of the given columns
+    batch_size : int
+        The number of rows that are converted to a DataFrame at once
+
+    Returns
+    -------
+    pandas.DataFrame
+    """
+    converters = converters or {}
+    batches = list(iter_batches(fileobj, converters, batch_size))
+    df = pd.concat(batches, ignore_index=True)
+    for col in df.columns:
+        if col not in converters:
+            df[col] = infer_column(df[col])
+    return(df)
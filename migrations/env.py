@@ -62,19 +62,30 @@ def run_migrations_online():
     and associate a connection with the context.
 
     """
+    # a connection passed in config.attributes, e.g. by the tests, is used
+    # instead of the configured database
+    connection = config.attributes.get('connection')
+    if connection is not None:
+        run_migrations_with(connection)
+        return
+
     connectable = engine_from_config(
         config.get_section(config.config_ini_section),
         prefix='sqlalchemy.',
         poolclass=pool.NullPool)
 
     with connectable.connect() as connection:
-        context.configure(
-            connection=connection,
-            target_metadata=target_metadata
-        )
+        run_migrations_with(connection)
+
+
+def run_migrations_with(connection):
+    context.configure(
+        connection=connection,
+        target_metadata=target_metadata
+    )
 
-        with context.begin_transaction():
-            context.run_migrations()
+    with context.begin_transaction():
+        context.run_migrations()
 
 if context.is_offline_mode():
     run_migrations_offline()
@@ -0,0 +1,48 @@
+"""Add the indexes of the point-in-time snapshots of the contracts
+
+Revision ID: 0f6a2d8e3b47
+Revises: 5b0e93c4f7a1
+Create Date: 2026-10-18 19:41:08.233615
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0f6a2d8e3b47'
+down_revision = '5b0e93c4f7a1'
+branch_labels = None
+depends_on = None
+
+
+def require_flat(conn):
+    rs = conn.execute("SELECT type FROM sqlite_master WHERE name = "
+                      "'contratos_xls'")
+    row = rs.fetchone()
+    if row is not None and row[0] == 'view':
+        raise RuntimeError("The contract tables are in normalized storage "
+                           "mode, run 'compranet-cli storage flat' before "
+                           "migrating the database")
+
+
+def upgrade():
+    require_flat(op.get_bind())
+    op.create_index('ix_contratos_xls_source_updated', 'contratos_xls',
+                    ['_SOURCE', '_UPDATED'], unique=False)
+    op.create_index('ix_contratos_xls_hist_source_superseded',
+                    'contratos_xls_hist',
+                    ['_SOURCE', '_SUPERSEDED', '_UPDATED'], unique=False)
+    op.create_index('ix_contratos_xls_delta_source_superseded',
+                    'contratos_xls_delta',
+                    ['_SOURCE', '_SUPERSEDED', '_UPDATED'], unique=False)
+    op.execute('ANALYZE')
+
+
+def downgrade():
+    require_flat(op.get_bind())
+    op.drop_index('ix_contratos_xls_delta_source_superseded',
+                  table_name='contratos_xls_delta')
+    op.drop_index('ix_contratos_xls_hist_source_superseded',
+                  table_name='contratos_xls_hist')
+    op.drop_index('ix_contratos_xls_source_updated', table_name='contratos_xls')
@@ -0,0 +1,152 @@
+"""Add fingerprint column to contratos_xls
+
+Revision ID: 3f1c2b7d9a4e
+Revises: 9d9edec95234
+Create Date: 2026-10-18 09:12:41.183204
+
+"""
+import hashlib
+import logging
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3f1c2b7d9a4e'
+down_revision = '9d9edec95234'
+branch_labels = None
+depends_on = None
+
+logger = logging.getLogger('alembic')
+
+# The fingerprinted columns of contratos_xls as they are at this revision,
+# in the order of the ContratoXls model. They are defined here rather than
+# imported from compranet.database, so that later changes to the models do
+# not change the fingerprints this migration computes.
+FINGERPRINT_COLS = [
+    ('GOBIERNO', sa.String()),
+    ('SIGLAS', sa.String()),
+    ('DEPENDENCIA', sa.String()),
+    ('CLAVEUC', sa.String()),
+    ('NOMBRE_DE_LA_UC', sa.String()),
+    ('RESPONSABLE', sa.String()),
+    ('CODIGO_EXPEDIENTE', sa.Integer()),
+    ('TITULO_EXPEDIENTE', sa.String()),
+    ('PLANTILLA_EXPEDIENTE', sa.String()),
+    ('NUMERO_PROCEDIMIENTO', sa.String()),
+    ('EXP_F_FALLO', sa.String()),
+    ('PROC_F_PUBLICACION', sa.String()),
+    ('FECHA_APERTURA_PROPOSICIONES', sa.String()),
+    ('CARACTER', sa.String()),
+    ('TIPO_CONTRATACION', sa.String()),
+    ('TIPO_PROCEDIMIENTO', sa.String()),
+    ('FORMA_PROCEDIMIENTO', sa.String()),
+    ('CODIGO_CONTRATO', sa.Integer()),
+    ('TITULO_CONTRATO', sa.String()),
+    ('FECHA_INICIO', sa.String()),
+    ('FECHA_FIN', sa.String()),
+    ('IMPORTE_CONTRATO', sa.Float()),
+    ('MONEDA', sa.String()),
+    ('ESTATUS_CONTRATO', sa.String()),
+    ('ARCHIVADO', sa.String()),
+    ('CONVENIO_MODIFICATORIO', sa.Boolean()),
+    ('RAMO', sa.String()),
+    ('CLAVE_PROGRAMA', sa.String()),
+    ('APORTACION_FEDERAL', sa.Float()),
+    ('FECHA_CELEBRACION', sa.String()),
+    ('CONTRATO_MARCO', sa.Boolean()),
+    ('IDENTIFICADOR_CM', sa.String()),
+    ('COMPRA_CONSOLIDADA', sa.Boolean()),
+    ('PLURIANUAL', sa.Boolean()),
+    ('CLAVE_CARTERA_SHCP', sa.String()),
+    ('ESTRATIFICACION_MUC', sa.String()),
+    ('FOLIO_RUPC', sa.Integer()),
+    ('PROVEEDOR_CONTRATISTA', sa.String()),
+    ('ESTRATIFICACION_MPC', sa.String()),
+    ('SIGLAS_PAIS', sa.String()),
+    ('ESTATUS_EMPRESA', sa.String()),
+    ('CUENTA_ADMINISTRADA_POR', sa.String()),
+    ('C_EXTERNO', sa.Boolean()),
+    ('ORGANISMO', sa.String()),
+    ('ANUNCIO', sa.String()),
+]
+FINGERPRINT_SEP = '\x1f'
+# number of contracts read and updated at a time
+BATCH_SIZE = 5000
+
+xls = sa.table('contratos_xls',
+               *[sa.column(col, col_type) for col, col_type in FINGERPRINT_COLS] +
+               [sa.column('_SOURCE', sa.String()),
+                sa.column('_FINGERPRINT', sa.String())])
+
+
+def require_flat(conn):
+    rs = conn.execute("SELECT type FROM sqlite_master WHERE name = "
+                      "'contratos_xls'")
+    row = rs.fetchone()
+    if row is not None and row[0] == 'view':
+        raise RuntimeError("The contract tables are in normalized storage "
+                           "mode, run 'compranet-cli storage flat' before "
+                           "migrating the database")
+
+
+def normalize(col_type, value):
+    # the same strings as xlsx.fingerprint for a row read from the database
+    if value is None:
+        return('')
+    if isinstance(col_type, (sa.Integer, sa.Boolean)):
+        return(str(int(float(value))))
+    if isinstance(col_type, sa.Float):
+        return(str(float(value)))
+    return(str(value))
+
+
+def fingerprint(row):
+    joined = FINGERPRINT_SEP.join(normalize(col_type, row[col])
+                                  for col, col_type in FINGERPRINT_COLS)
+    return(hashlib.sha1(joined.encode('utf-8')).hexdigest())
+
+
+def backfill_fingerprints(conn):
+    update = (xls.update()
+              .where(sa.and_(xls.c._SOURCE == sa.bindparam('key_SOURCE'),
+                             xls.c.CODIGO_CONTRATO == sa.bindparam('key_CODIGO')))
+              .values(_FINGERPRINT=sa.bindparam('fingerprint')))
+    sources = [row[0] for row in
+               conn.execute(sa.select([xls.c._SOURCE]).distinct())]
+    for source in sorted(sources, key=str):
+        logger.info("Computing the fingerprints of source {}...".format(source))
+        # the contracts are read in batches ordered by the primary key
+        last = None
+        while True:
+            stmt = (sa.select([xls.c[col] for col, _ in FINGERPRINT_COLS])
+                    .where(xls.c._SOURCE == source)
+                    .order_by(xls.c.CODIGO_CONTRATO)
+                    .limit(BATCH_SIZE))
+            if last is not None:
+                stmt = stmt.where(xls.c.CODIGO_CONTRATO > last)
+            rows = conn.execute(stmt).fetchall()
+            if not rows:
+                break
+            conn.execute(update, [{'key_SOURCE': source,
+                                   'key_CODIGO': row['CODIGO_CONTRATO'],
+                                   'fingerprint': fingerprint(row)}
+                                  for row in rows])
+            last = rows[-1]['CODIGO_CONTRATO']
+
+
+def upgrade():
+    conn = op.get_bind()
+    require_flat(conn)
+    op.add_column('contratos_xls', sa.Column('_FINGERPRINT', sa.String(), nullable=True))
+    op.create_index('ix_contratos_xls_source_fingerprint', 'contratos_xls',
+                    ['_SOURCE', 'CODIGO_CONTRATO', '_FINGERPRINT'], unique=False)
+    backfill_fingerprints(conn)
+
+
+def downgrade():
+    require_flat(op.get_bind())
+    op.drop_index('ix_contratos_xls_source_fingerprint', table_name='contratos_xls')
+    with op.batch_alter_table('contratos_xls') as batch_op:
+        batch_op.drop_column('_FINGERPRINT')
@@ -0,0 +1,285 @@
+"""Store the contract history as deltas with periodic snapshots
+
+Revision ID: 5b0e93c4f7a1
+Revises: e7b94a2c1d58
+Create Date: 2026-10-18 18:24:37.519302
+
+"""
+from datetime import datetime
+import json
+import logging
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5b0e93c4f7a1'
+down_revision = 'e7b94a2c1d58'
+branch_labels = None
+depends_on = None
+
+logger = logging.getLogger('alembic')
+
+# The contract tables as they are at this revision. They are defined here
+# rather than imported from compranet.database, so that later changes to the
+# models do not change what this migration reads and writes.
+VERSION_COLS = [
+    ('GOBIERNO', sa.String()),
+    ('SIGLAS', sa.String()),
+    ('DEPENDENCIA', sa.String()),
+    ('CLAVEUC', sa.String()),
+    ('NOMBRE_DE_LA_UC', sa.String()),
+    ('RESPONSABLE', sa.String()),
+    ('CODIGO_EXPEDIENTE', sa.Integer()),
+    ('TITULO_EXPEDIENTE', sa.String()),
+    ('PLANTILLA_EXPEDIENTE', sa.String()),
+    ('NUMERO_PROCEDIMIENTO', sa.String()),
+    ('EXP_F_FALLO', sa.Date()),
+    ('PROC_F_PUBLICACION', sa.DateTime()),
+    ('FECHA_APERTURA_PROPOSICIONES', sa.DateTime()),
+    ('CARACTER', sa.String()),
+    ('TIPO_CONTRATACION', sa.String()),
+    ('TIPO_PROCEDIMIENTO', sa.String()),
+    ('FORMA_PROCEDIMIENTO', sa.String()),
+    ('CODIGO_CONTRATO', sa.Integer()),
+    ('TITULO_CONTRATO', sa.String()),
+    ('FECHA_INICIO', sa.Date()),
+    ('FECHA_FIN', sa.Date()),
+    ('IMPORTE_CONTRATO', sa.Float()),
+    ('MONEDA', sa.String()),
+    ('ESTATUS_CONTRATO', sa.String()),
+    ('ARCHIVADO', sa.String()),
+    ('CONVENIO_MODIFICATORIO', sa.Boolean()),
+    ('RAMO', sa.String()),
+    ('CLAVE_PROGRAMA', sa.String()),
+    ('APORTACION_FEDERAL', sa.Float()),
+    ('FECHA_CELEBRACION', sa.Date()),
+    ('CONTRATO_MARCO', sa.Boolean()),
+    ('IDENTIFICADOR_CM', sa.String()),
+    ('COMPRA_CONSOLIDADA', sa.Boolean()),
+    ('PLURIANUAL', sa.Boolean()),
+    ('CLAVE_CARTERA_SHCP', sa.String()),
+    ('ESTRATIFICACION_MUC', sa.String()),
+    ('FOLIO_RUPC', sa.Integer()),
+    ('PROVEEDOR_CONTRATISTA', sa.String()),
+    ('ESTRATIFICACION_MPC', sa.String()),
+    ('SIGLAS_PAIS', sa.String()),
+    ('ESTATUS_EMPRESA', sa.String()),
+    ('CUENTA_ADMINISTRADA_POR', sa.String()),
+    ('C_EXTERNO', sa.Boolean()),
+    ('ORGANISMO', sa.String()),
+    ('ANUNCIO', sa.String()),
+    ('_SOURCE', sa.String()),
+    ('_UPDATED', sa.DateTime()),
+]
+VERSION_KEYS = [col for col, _ in VERSION_COLS]
+COL_TYPES = dict(VERSION_COLS)
+CMP_COLS = [col for col in VERSION_KEYS if col != '_UPDATED']
+
+xls = sa.table('contratos_xls',
+               *[sa.column(col, col_type) for col, col_type in VERSION_COLS])
+hist = sa.table('contratos_xls_hist',
+                *[sa.column(col, col_type) for col, col_type in VERSION_COLS] +
+                [sa.column('_SUPERSEDED', sa.DateTime()),
+                 sa.column('_REMOVED', sa.Boolean()),
+                 sa.column('_ID', sa.Integer())])
+delta = sa.table('contratos_xls_delta',
+                 sa.column('_ID', sa.Integer()),
+                 sa.column('CODIGO_CONTRATO', sa.Integer()),
+                 sa.column('_SOURCE', sa.String()),
+                 sa.column('_UPDATED', sa.DateTime()),
+                 sa.column('_SUPERSEDED', sa.DateTime()),
+                 sa.column('_CHANGES', sa.String()))
+
+# a full copy is kept every SNAPSHOT_INTERVAL versions, as the loader does
+SNAPSHOT_INTERVAL = 10
+# formats of the date values in the changes of the deltas
+DELTA_DATE_FORMAT = '%Y-%m-%d'
+DELTA_DATETIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+# maximum number of bound parameters in an IN clause
+CHUNK_SIZE = 500
+
+
+def require_flat(conn):
+    rs = conn.execute("SELECT type FROM sqlite_master WHERE name = "
+                      "'contratos_xls'")
+    row = rs.fetchone()
+    if row is not None and row[0] == 'view':
+        raise RuntimeError("The contract tables are in normalized storage "
+                           "mode, run 'compranet-cli storage flat' before "
+                           "migrating the database")
+
+
+def chunks(seq, size=CHUNK_SIZE):
+    for idx in range(0, len(seq), size):
+        yield seq[idx:idx + size]
+
+
+def encode_value(col, value):
+    if value is None:
+        return(None)
+    if isinstance(COL_TYPES[col], sa.DateTime):
+        return(value.strftime(DELTA_DATETIME_FORMAT))
+    if isinstance(COL_TYPES[col], sa.Date):
+        return(value.strftime(DELTA_DATE_FORMAT))
+    return(value)
+
+
+def decode_value(col, value):
+    if value is None:
+        return(None)
+    if isinstance(COL_TYPES[col], sa.DateTime):
+        return(datetime.strptime(value, DELTA_DATETIME_FORMAT))
+    if isinstance(COL_TYPES[col], sa.Date):
+        return(datetime.strptime(value, DELTA_DATE_FORMAT).date())
+    return(value)
+
+
+def history_ids(conn):
+    """Returns the (source, CODIGO_CONTRATO) of the contracts with history"""
+    rs = conn.execute(sa.select([hist.c._SOURCE, hist.c.CODIGO_CONTRATO])
+                      .union(sa.select([delta.c._SOURCE,
+                                        delta.c.CODIGO_CONTRATO])))
+    ids = {}
+    for source, codigo in rs:
+        ids.setdefault(source, []).append(codigo)
+    return([(source, sorted(ids[source])) for source in sorted(ids)])
+
+
+def read_events(conn, source, ids):
+    """
+    Reads the current rows, full copies and deltas of contracts, as lists
+    of (kind, row) ordered by _UPDATED.
+    """
+    events = {}
+    rs = conn.execute(sa.select([xls.c[col] for col in VERSION_KEYS])
+                      .where(sa.and_(xls.c._SOURCE == source,
+                                     xls.c.CODIGO_CONTRATO.in_(ids))))
+    for row in rs:
+        version = dict(row, _SUPERSEDED=None, _REMOVED=False)
+        events.setdefault(version['CODIGO_CONTRATO'], []).append(
+            ('current', version))
+    rs = conn.execute(sa.select([hist])
+                      .where(sa.and_(hist.c._SOURCE == source,
+                                     hist.c.CODIGO_CONTRATO.in_(ids))))
+    for row in rs:
+        version = dict(row)
+        kind = 'removed' if version['_REMOVED'] else 'copy'
+        events.setdefault(version['CODIGO_CONTRATO'], []).append(
+            (kind, version))
+    rs = conn.execute(sa.select([delta])
+                      .where(sa.and_(delta.c._SOURCE == source,
+                                     delta.c.CODIGO_CONTRATO.in_(ids))))
+    for row in rs:
+        row = dict(row, _CHANGES=json.loads(row['_CHANGES']))
+        events.setdefault(row['CODIGO_CONTRATO'], []).append(('delta', row))
+    for contract_events in events.values():
+        contract_events.sort(key=lambda event: event[1]['_UPDATED'])
+    return(events)
+
+
+def upgrade():
+    conn = op.get_bind()
+    require_flat(conn)
+    op.create_table('contratos_xls_delta',
+        sa.Column('_ID', sa.Integer(), nullable=False),
+        sa.Column('CODIGO_CONTRATO', sa.Integer(), nullable=True),
+        sa.Column('_SOURCE', sa.String(), nullable=True),
+        sa.Column('_UPDATED', sa.DateTime(), nullable=True),
+        sa.Column('_SUPERSEDED', sa.DateTime(), nullable=True),
+        sa.Column('_CHANGES', sa.String(), nullable=True),
+        sa.PrimaryKeyConstraint('_ID')
+    )
+    op.create_index('ix_contratos_xls_delta_contrato', 'contratos_xls_delta',
+                    ['CODIGO_CONTRATO', '_SOURCE', '_UPDATED'], unique=False)
+    op.add_column('contratos_xls_hist',
+                  sa.Column('_SUPERSEDED', sa.DateTime(), nullable=True))
+
+    # The history written so far has a full copy of every previous version
+    # and no _SUPERSEDED times. The _SUPERSEDED time of every copy is set,
+    # and each copy followed by a newer version is replaced with a delta,
+    # except for the periodic snapshots that the loader would have kept.
+    update_superseded = (hist.update()
+                         .where(hist.c._ID == sa.bindparam('key_ID'))
+                         .values(_SUPERSEDED=sa.bindparam('superseded')))
+    for source, source_ids in history_ids(conn):
+        logger.info("Converting the history of source {}...".format(source))
+        cnt_deltas = 0
+        for ids_chunk in chunks(source_ids):
+            superseded = []
+            deltas = []
+            removed_ids = []
+            for events in read_events(conn, source, ids_chunk).values():
+                # number of deltas since the last full copy
+                depth = 0
+                for (kind, row), (next_kind, next_row) in zip(
+                        events, events[1:] + [(None, None)]):
+                    if kind != 'copy':
+                        continue
+                    if next_row is not None:
+                        superseded.append({'key_ID': row['_ID'],
+                                           'superseded': next_row['_UPDATED']})
+                    # copies of deleted versions are kept
+                    if next_kind not in ('current', 'copy') or \
+                            depth >= SNAPSHOT_INTERVAL:
+                        depth = 0
+                        continue
+                    changes = {col: encode_value(col, row[col])
+                               for col in CMP_COLS
+                               if row[col] != next_row[col]}
+                    deltas.append({'CODIGO_CONTRATO': row['CODIGO_CONTRATO'],
+                                   '_SOURCE': source,
+                                   '_UPDATED': row['_UPDATED'],
+                                   '_SUPERSEDED': next_row['_UPDATED'],
+                                   '_CHANGES': json.dumps(changes)})
+                    removed_ids.append(row['_ID'])
+                    depth += 1
+            if superseded:
+                conn.execute(update_superseded, superseded)
+            if deltas:
+                conn.execute(delta.insert(), deltas)
+            for id_chunk in chunks(removed_ids):
+                conn.execute(hist.delete().where(hist.c._ID.in_(id_chunk)))
+            cnt_deltas += len(deltas)
+        logger.info("{} history rows converted to deltas".format(cnt_deltas))
+
+
+def downgrade():
+    conn = op.get_bind()
+    require_flat(conn)
+    # the deltas are replaced with full copies of the versions, rebuilt from
+    # the nearest newer full copy by applying the deltas newest first
+    for source, source_ids in history_ids(conn):
+        logger.info("Expanding the history of source {}...".format(source))
+        for ids_chunk in chunks(source_ids):
+            copies = []
+            for events in read_events(conn, source, ids_chunk).values():
+                newer = None
+                for kind, row in reversed(events):
+                    if kind == 'delta':
+                        if newer is None:
+                            raise ValueError(
+                                "The delta of contract {} updated on {} has "
+                                "no newer version".format(
+                                row['CODIGO_CONTRATO'], row['_UPDATED']))
+                        version = dict(newer)
+                        version.update((col, decode_value(col, val))
+                                       for col, val in row['_CHANGES'].items())
+                        version.update(_UPDATED=row['_UPDATED'],
+                                       _SUPERSEDED=row['_SUPERSEDED'],
+                                       _REMOVED=False)
+                        copies.append(version)
+                    else:
+                        version = {key: row[key] for key in VERSION_KEYS}
+                        version.update(_SUPERSEDED=row['_SUPERSEDED'],
+                                       _REMOVED=bool(row['_REMOVED']))
+                    newer = None if version['_REMOVED'] else version
+            if copies:
+                conn.execute(hist.insert(), copies)
+
+    with op.batch_alter_table('contratos_xls_hist') as batch_op:
+        batch_op.drop_column('_SUPERSEDED')
+    op.drop_index('ix_contratos_xls_delta_contrato',
+                  table_name='contratos_xls_delta')
+    op.drop_table('contratos_xls_delta')
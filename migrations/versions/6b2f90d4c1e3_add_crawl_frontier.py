@@ -0,0 +1,40 @@
+"""Add the crawl frontier of the web scraper
+
+Revision ID: 6b2f90d4c1e3
+Revises: d3c8f15a7e62
+Create Date: 2026-10-18 22:31:54.470912
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '6b2f90d4c1e3'
+down_revision = 'd3c8f15a7e62'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('crawl_frontier',
+        sa.Column('ANUNCIO', sa.String(), nullable=False),
+        sa.Column('STATE', sa.String(), nullable=True),
+        sa.Column('RETRIES', sa.Integer(), nullable=True),
+        sa.Column('NEXT_ELIGIBLE', sa.DateTime(), nullable=True),
+        sa.Column('LEASE_ID', sa.String(), nullable=True),
+        sa.Column('LEASED_BY', sa.String(), nullable=True),
+        sa.Column('_ADDED', sa.DateTime(), nullable=True),
+        sa.Column('ERROR', sa.String(), nullable=True),
+        sa.PrimaryKeyConstraint('ANUNCIO')
+    )
+    op.create_index('ix_crawl_frontier_state', 'crawl_frontier',
+                    ['STATE', 'NEXT_ELIGIBLE'], unique=False)
+    op.create_index('ix_crawl_frontier_lease', 'crawl_frontier',
+                    ['LEASE_ID'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_crawl_frontier_lease', table_name='crawl_frontier')
+    op.drop_index('ix_crawl_frontier_state', table_name='crawl_frontier')
+    op.drop_table('crawl_frontier')
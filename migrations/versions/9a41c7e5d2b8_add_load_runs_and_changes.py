@@ -0,0 +1,55 @@
+"""Add the load runs and the contracts they changed
+
+Revision ID: 9a41c7e5d2b8
+Revises: 0f6a2d8e3b47
+Create Date: 2026-10-18 20:57:12.804476
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+from compranet import database
+
+
+# revision identifiers, used by Alembic.
+revision = '9a41c7e5d2b8'
+down_revision = '0f6a2d8e3b47'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('load_runs',
+        sa.Column('_ID', sa.Integer(), nullable=False),
+        sa.Column('_SOURCE', sa.String(), nullable=True),
+        sa.Column('_UPDATED', sa.DateTime(), nullable=True),
+        sa.Column('SHA256', sa.String(), nullable=True),
+        sa.Column('_LOADED', sa.DateTime(), nullable=True),
+        sa.Column('INSERTED', sa.Integer(), nullable=True),
+        sa.Column('MODIFIED', sa.Integer(), nullable=True),
+        sa.Column('DELETED', sa.Integer(), nullable=True),
+        sa.Column('UNCHANGED', sa.Integer(), nullable=True),
+        sa.ForeignKeyConstraint(['_SOURCE', '_UPDATED'],
+                                ['sources_xls._SOURCE', 'sources_xls._UPDATED']),
+        sa.PrimaryKeyConstraint('_ID')
+    )
+    op.create_index('ix_load_runs_source', 'load_runs',
+                    ['_SOURCE', '_UPDATED'], unique=False)
+    op.create_table('load_changes',
+        sa.Column('_ID', sa.Integer(), nullable=False),
+        sa.Column('RUN_ID', sa.Integer(), nullable=True),
+        sa.Column('CODIGO_CONTRATO', sa.Integer(), nullable=True),
+        sa.Column('CHANGE', sa.String(), nullable=True),
+        sa.Column('COLUMNS', database.JSONEncodedObject(), nullable=True),
+        sa.ForeignKeyConstraint(['RUN_ID'], ['load_runs._ID']),
+        sa.PrimaryKeyConstraint('_ID')
+    )
+    op.create_index('ix_load_changes_run', 'load_changes', ['RUN_ID'],
+                    unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_load_changes_run', table_name='load_changes')
+    op.drop_table('load_changes')
+    op.drop_index('ix_load_runs_source', table_name='load_runs')
+    op.drop_table('load_runs')
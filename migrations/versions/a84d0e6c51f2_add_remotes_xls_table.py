@@ -0,0 +1,31 @@
+"""Add remotes_xls table
+
+Revision ID: a84d0e6c51f2
+Revises: 3f1c2b7d9a4e
+Create Date: 2026-10-18 11:03:27.509618
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a84d0e6c51f2'
+down_revision = '3f1c2b7d9a4e'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('remotes_xls',
+    sa.Column('_SOURCE', sa.String(), nullable=False),
+    sa.Column('URL', sa.String(), nullable=True),
+    sa.Column('LAST_MODIFIED', sa.String(), nullable=True),
+    sa.Column('ETAG', sa.String(), nullable=True),
+    sa.Column('_CHECKED', sa.DateTime(), nullable=True),
+    sa.PrimaryKeyConstraint('_SOURCE')
+    )
+
+
+def downgrade():
+    op.drop_table('remotes_xls')
@@ -0,0 +1,50 @@
+"""Add indexes for the access paths of the loader and scraper
+
+Revision ID: c52e8f1d7b30
+Revises: a84d0e6c51f2
+Create Date: 2026-10-18 13:26:08.440571
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c52e8f1d7b30'
+down_revision = 'a84d0e6c51f2'
+branch_labels = None
+depends_on = None
+
+
+def require_flat(conn):
+    rs = conn.execute("SELECT type FROM sqlite_master WHERE name = "
+                      "'contratos_xls'")
+    row = rs.fetchone()
+    if row is not None and row[0] == 'view':
+        raise RuntimeError("The contract tables are in normalized storage "
+                           "mode, run 'compranet-cli storage flat' before "
+                           "migrating the database")
+
+
+def upgrade():
+    require_flat(op.get_bind())
+    op.create_index('ix_contratos_xls_source_anuncio', 'contratos_xls',
+                    ['_SOURCE', 'ANUNCIO'], unique=False)
+    op.create_index('ix_contratos_xls_anuncio', 'contratos_xls',
+                    ['ANUNCIO'], unique=False)
+    op.create_index('ix_contratos_xls_hist_contrato', 'contratos_xls_hist',
+                    ['CODIGO_CONTRATO', '_SOURCE', '_UPDATED'], unique=False)
+    op.create_index('ix_sources_xls_sha256', 'sources_xls',
+                    ['SHA256'], unique=False)
+    op.create_index('ix_contratos_web_hist_anuncio', 'contratos_web_hist',
+                    ['ANUNCIO', '_UPDATED'], unique=False)
+    op.execute('ANALYZE')
+
+
+def downgrade():
+    require_flat(op.get_bind())
+    op.drop_index('ix_contratos_web_hist_anuncio', table_name='contratos_web_hist')
+    op.drop_index('ix_sources_xls_sha256', table_name='sources_xls')
+    op.drop_index('ix_contratos_xls_hist_contrato', table_name='contratos_xls_hist')
+    op.drop_index('ix_contratos_xls_anuncio', table_name='contratos_xls')
+    op.drop_index('ix_contratos_xls_source_anuncio', table_name='contratos_xls')
@@ -0,0 +1,37 @@
+"""Add the index of the archive of anuncio pages
+
+Revision ID: d3c8f15a7e62
+Revises: 9a41c7e5d2b8
+Create Date: 2026-10-18 21:40:26.118305
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd3c8f15a7e62'
+down_revision = '9a41c7e5d2b8'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('anuncio_pages',
+        sa.Column('_ID', sa.Integer(), nullable=False),
+        sa.Column('ANUNCIO', sa.String(), nullable=True),
+        sa.Column('_FETCHED', sa.DateTime(), nullable=True),
+        sa.Column('SHA256', sa.String(), nullable=True),
+        sa.Column('URL', sa.String(), nullable=True),
+        sa.PrimaryKeyConstraint('_ID')
+    )
+    op.create_index('ix_anuncio_pages_anuncio', 'anuncio_pages',
+                    ['ANUNCIO', '_FETCHED'], unique=False)
+    op.create_index('ix_anuncio_pages_fetched', 'anuncio_pages',
+                    ['_FETCHED'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_anuncio_pages_fetched', table_name='anuncio_pages')
+    op.drop_index('ix_anuncio_pages_anuncio', table_name='anuncio_pages')
+    op.drop_table('anuncio_pages')
@@ -0,0 +1,225 @@
+"""Store the contract dates in Date and DateTime columns
+
+Revision ID: e7b94a2c1d58
+Revises: c52e8f1d7b30
+Create Date: 2026-10-18 16:02:51.906124
+
+"""
+import hashlib
+import logging
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e7b94a2c1d58'
+down_revision = 'c52e8f1d7b30'
+branch_labels = None
+depends_on = None
+
+logger = logging.getLogger('alembic')
+
+TABLES = ['contratos_xls', 'contratos_xls_hist']
+DATE_COLS = ['EXP_F_FALLO', 'FECHA_INICIO', 'FECHA_FIN', 'FECHA_CELEBRACION']
+DATETIME_COLS = ['PROC_F_PUBLICACION', 'FECHA_APERTURA_PROPOSICIONES']
+YMD = '[0-9][0-9][0-9][0-9]-[0-9][0-9]-[0-9][0-9]'
+HM = '[0-9][0-9]:[0-9][0-9]'
+
+# the strings are rewritten in the storage format of SQLAlchemy's SQLite
+# dialect, values that are not dates become NULL
+DATE_SQL = """CASE WHEN {col} GLOB '""" + YMD + """*'
+    THEN substr({col}, 1, 10) END"""
+DATETIME_SQL = """CASE
+    WHEN {col} GLOB '""" + YMD + ' ' + HM + """:[0-9][0-9]*'
+        THEN substr({col}, 1, 19) || '.000000'
+    WHEN {col} GLOB '""" + YMD + ' ' + HM + """*'
+        THEN substr({col}, 1, 16) || ':00.000000'
+    WHEN {col} GLOB '""" + YMD + """*'
+        THEN substr({col}, 1, 10) || ' 00:00:00.000000'
+    END"""
+# back to the formats of the Excel files
+DATE_DOWN_SQL = {
+    'EXP_F_FALLO': "{col} || ' 00:00:00 GMT'",
+    'FECHA_INICIO': "{col}",
+    'FECHA_FIN': "{col}",
+    'FECHA_CELEBRACION': "{col} || ' 00:00:00 GMT'",
+    'PROC_F_PUBLICACION': "substr({col}, 1, 16)",
+    'FECHA_APERTURA_PROPOSICIONES': "substr({col}, 1, 16)",
+}
+
+# The fingerprinted columns of contratos_xls with the types they have after
+# this revision, in the order of the ContratoXls model. They are defined here
+# rather than imported from compranet.database, so that later changes to the
+# models do not change the fingerprints this migration computes.
+FINGERPRINT_COLS = [
+    ('GOBIERNO', sa.String()),
+    ('SIGLAS', sa.String()),
+    ('DEPENDENCIA', sa.String()),
+    ('CLAVEUC', sa.String()),
+    ('NOMBRE_DE_LA_UC', sa.String()),
+    ('RESPONSABLE', sa.String()),
+    ('CODIGO_EXPEDIENTE', sa.Integer()),
+    ('TITULO_EXPEDIENTE', sa.String()),
+    ('PLANTILLA_EXPEDIENTE', sa.String()),
+    ('NUMERO_PROCEDIMIENTO', sa.String()),
+    ('EXP_F_FALLO', sa.Date()),
+    ('PROC_F_PUBLICACION', sa.DateTime()),
+    ('FECHA_APERTURA_PROPOSICIONES', sa.DateTime()),
+    ('CARACTER', sa.String()),
+    ('TIPO_CONTRATACION', sa.String()),
+    ('TIPO_PROCEDIMIENTO', sa.String()),
+    ('FORMA_PROCEDIMIENTO', sa.String()),
+    ('CODIGO_CONTRATO', sa.Integer()),
+    ('TITULO_CONTRATO', sa.String()),
+    ('FECHA_INICIO', sa.Date()),
+    ('FECHA_FIN', sa.Date()),
+    ('IMPORTE_CONTRATO', sa.Float()),
+    ('MONEDA', sa.String()),
+    ('ESTATUS_CONTRATO', sa.String()),
+    ('ARCHIVADO', sa.String()),
+    ('CONVENIO_MODIFICATORIO', sa.Boolean()),
+    ('RAMO', sa.String()),
+    ('CLAVE_PROGRAMA', sa.String()),
+    ('APORTACION_FEDERAL', sa.Float()),
+    ('FECHA_CELEBRACION', sa.Date()),
+    ('CONTRATO_MARCO', sa.Boolean()),
+    ('IDENTIFICADOR_CM', sa.String()),
+    ('COMPRA_CONSOLIDADA', sa.Boolean()),
+    ('PLURIANUAL', sa.Boolean()),
+    ('CLAVE_CARTERA_SHCP', sa.String()),
+    ('ESTRATIFICACION_MUC', sa.String()),
+    ('FOLIO_RUPC', sa.Integer()),
+    ('PROVEEDOR_CONTRATISTA', sa.String()),
+    ('ESTRATIFICACION_MPC', sa.String()),
+    ('SIGLAS_PAIS', sa.String()),
+    ('ESTATUS_EMPRESA', sa.String()),
+    ('CUENTA_ADMINISTRADA_POR', sa.String()),
+    ('C_EXTERNO', sa.Boolean()),
+    ('ORGANISMO', sa.String()),
+    ('ANUNCIO', sa.String()),
+]
+FINGERPRINT_SEP = '\x1f'
+# number of contracts read and updated at a time
+BATCH_SIZE = 5000
+
+
+def require_flat(conn):
+    rs = conn.execute("SELECT type FROM sqlite_master WHERE name = "
+                      "'contratos_xls'")
+    row = rs.fetchone()
+    if row is not None and row[0] == 'view':
+        raise RuntimeError("The contract tables are in normalized storage "
+                           "mode, run 'compranet-cli storage flat' before "
+                           "migrating the database")
+
+
+def normalize(col_type, value):
+    # the same strings as xlsx.fingerprint for a row read from the database
+    if value is None:
+        return('')
+    if isinstance(col_type, (sa.Integer, sa.Boolean)):
+        return(str(int(float(value))))
+    if isinstance(col_type, sa.Float):
+        return(str(float(value)))
+    if isinstance(col_type, sa.DateTime):
+        return(value.replace(microsecond=0).isoformat())
+    if isinstance(col_type, sa.Date):
+        return(value.isoformat())
+    return(str(value))
+
+
+def fingerprint(row, fingerprint_cols):
+    joined = FINGERPRINT_SEP.join(normalize(col_type, row[col])
+                                  for col, col_type in fingerprint_cols)
+    return(hashlib.sha1(joined.encode('utf-8')).hexdigest())
+
+
+def update_fingerprints(conn, fingerprint_cols):
+    xls = sa.table('contratos_xls',
+                   *[sa.column(col, col_type)
+                     for col, col_type in fingerprint_cols] +
+                   [sa.column('_SOURCE', sa.String()),
+                    sa.column('_FINGERPRINT', sa.String())])
+    update = (xls.update()
+              .where(sa.and_(xls.c._SOURCE == sa.bindparam('key_SOURCE'),
+                             xls.c.CODIGO_CONTRATO == sa.bindparam('key_CODIGO')))
+              .values(_FINGERPRINT=sa.bindparam('fingerprint')))
+    sources = [row[0] for row in
+               conn.execute(sa.select([xls.c._SOURCE]).distinct())]
+    for source in sorted(sources, key=str):
+        logger.info("Computing the fingerprints of source {}...".format(source))
+        # the contracts are read in batches ordered by the primary key
+        last = None
+        while True:
+            stmt = (sa.select([xls.c[col] for col, _ in fingerprint_cols])
+                    .where(xls.c._SOURCE == source)
+                    .order_by(xls.c.CODIGO_CONTRATO)
+                    .limit(BATCH_SIZE))
+            if last is not None:
+                stmt = stmt.where(xls.c.CODIGO_CONTRATO > last)
+            rows = conn.execute(stmt).fetchall()
+            if not rows:
+                break
+            conn.execute(update, [{'key_SOURCE': source,
+                                   'key_CODIGO': row['CODIGO_CONTRATO'],
+                                   'fingerprint': fingerprint(row, fingerprint_cols)}
+                                  for row in rows])
+            last = rows[-1]['CODIGO_CONTRATO']
+
+
+def convert(table, sql_formats):
+    conn = op.get_bind()
+    for col, sql in sql_formats.items():
+        n_bad = conn.execute(
+            'SELECT count(*) FROM {table} WHERE "{col}" IS NOT NULL '
+            'AND ({sql}) IS NULL'.format(table=table, col=col,
+                                        sql=sql.format(col='"'+col+'"'))
+            ).scalar()
+        if n_bad > 0:
+            logger.warning("{} values of {}.{} are not dates and will be "
+                           "set to NULL".format(n_bad, table, col))
+    assignments = ', '.join('"{col}" = {sql}'.format(
+                            col=col, sql=sql.format(col='"'+col+'"'))
+                            for col, sql in sql_formats.items())
+    conn.execute('UPDATE {} SET {}'.format(table, assignments))
+
+
+def retype(table, columns):
+    # The column types are overridden in the reflected table rather than
+    # changed with alter_column, which would CAST the values and turn the
+    # dates into numbers, since SQLite gives DATE columns NUMERIC affinity.
+    with op.batch_alter_table(table, recreate='always',
+                              reflect_args=columns):
+        pass
+
+
+def upgrade():
+    require_flat(op.get_bind())
+    sql_formats = dict([(col, DATE_SQL) for col in DATE_COLS] +
+                       [(col, DATETIME_SQL) for col in DATETIME_COLS])
+    for table in TABLES:
+        logger.info("Converting the dates of {}...".format(table))
+        convert(table, sql_formats)
+        retype(table, [sa.Column(col, sa.Date()) for col in DATE_COLS] +
+                      [sa.Column(col, sa.DateTime()) for col in DATETIME_COLS])
+    op.create_index('ix_contratos_xls_proc_f_publicacion', 'contratos_xls',
+                    ['PROC_F_PUBLICACION'], unique=False)
+    op.create_index('ix_contratos_xls_fecha_celebracion', 'contratos_xls',
+                    ['FECHA_CELEBRACION'], unique=False)
+    # the fingerprints depend on the column types, they are recomputed with
+    # the new types of the date columns
+    update_fingerprints(op.get_bind(), FINGERPRINT_COLS)
+
+
+def downgrade():
+    require_flat(op.get_bind())
+    op.drop_index('ix_contratos_xls_fecha_celebracion', table_name='contratos_xls')
+    op.drop_index('ix_contratos_xls_proc_f_publicacion', table_name='contratos_xls')
+    for table in TABLES:
+        convert(table, DATE_DOWN_SQL)
+        retype(table, [sa.Column(col, sa.String()) for col in DATE_DOWN_SQL])
+    # the fingerprints are recomputed with the date columns back to strings
+    update_fingerprints(op.get_bind(),
+                        [(col, sa.String() if col in DATE_DOWN_SQL else col_type)
+                         for col, col_type in FINGERPRINT_COLS])
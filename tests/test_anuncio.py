@@ -0,0 +1,76 @@
+# coding: utf-8
+"""
+Tests of the parser of the anuncio pages on generated pages of both layouts.
+"""
+from datetime import datetime
+import re
+
+import numpy as np
+import pytest
+
+from compranet import anuncio, benchmark
+
+
+URL = 'https://compranet.funcionpublica.gob.mx/esop/guest/go/opportunity/1'
+FETCHED = datetime(2016, 12, 3, 17, 29)
+N_PAGES = 10
+# the cells of each row of the Procedimiento table
+PROCEDIMIENTO_RE = re.compile(r'<tr><td></td><td></td><td>(PC-[0-9]+-[0-9]+)'
+                              r'</td><td>[^<]*</td><td>([^<]*)</td></tr>')
+
+
+def generate_pages(layout):
+    rs = np.random.RandomState(0)
+    return([benchmark.generate_anuncio(layout, rs, idx)
+            for idx in range(N_PAGES)])
+
+@pytest.mark.parametrize('layout', [92, 155])
+def test_parse_anuncio(layout):
+    spec = anuncio.PREFIX_92_SPEC if layout == 92 else anuncio.PREFIX_155_SPEC
+    n_multiple = 0
+    for idx, body in enumerate(generate_pages(layout)):
+        output = anuncio.parse_anuncio(body, URL, FETCHED)
+        assert output['ANUNCIO'] == URL
+        assert output['_UPDATED'] == FETCHED
+        # the generated value of each field starts with its column
+        for col, _ in (anuncio.EXPEDIENTE_SPEC + anuncio.ANUNCIO_SPEC + spec +
+                       anuncio.RESPONSABLE_SPEC):
+            assert output[col].startswith('{} {} '.format(col, idx))
+        if layout == 155:
+            assert len(output['_ANEXOS_CP']) > 0
+            for archive in output['_ANEXOS_CP']:
+                assert archive['href'].startswith('/esop/file/{}/'.format(idx))
+                assert archive['tamano'].endswith(' KB')
+        else:
+            assert '_ANEXOS_CP' not in output
+        for archive in output['_ANEXOS_OD']:
+            assert archive['href'].startswith('/esop/od/{}/'.format(idx))
+            assert archive['fecha_de_modificacion'] == '01/02/2016 10:00'
+        # each procedure has the deadline of its own row
+        rows = PROCEDIMIENTO_RE.findall(body.decode('utf-8'))
+        assert [(proc['codigo_procedimiento'],
+                 proc['fecha_limite_procedimiento'])
+                for proc in output['_PROCEDIMIENTOS']] == rows
+        if len(set(deadline for _, deadline in rows)) > 1:
+            n_multiple += 1
+    # some pages have several procedures with different deadlines
+    assert n_multiple > 0
+
+@pytest.mark.parametrize('layout, label', [
+    (92, 'Carácter del procedimiento'),
+    (155, 'Medio o forma del procedimiento'),
+    (92, 'Descripción del Expediente'),
+    (155, 'Nombre del Operador en la UC'),
+])
+def test_changed_label_raises(layout, label):
+    body = generate_pages(layout)[0].decode('utf-8')
+    assert label in body
+    body = body.replace(label, label.upper())
+    with pytest.raises(anuncio.ParseError, match='Expected label'):
+        anuncio.parse_anuncio(body.encode('utf-8'), URL, FETCHED)
+
+def test_changed_layout_raises():
+    body = generate_pages(155)[0].decode('utf-8')
+    body = body.replace('conditionalPrefixFor_155', 'conditionalPrefixFor_92')
+    with pytest.raises(anuncio.ParseError):
+        anuncio.parse_anuncio(body.encode('utf-8'), URL, FETCHED)
@@ -0,0 +1,189 @@
+"""
+Tests of the Alembic migrations on a populated database.
+
+The database is created at the head revision of the schema before the
+contract dates, fingerprints and history deltas were introduced, filled with
+contracts in the formats of the Excel files and with their history, and
+then migrated.
+"""
+from datetime import date, datetime
+import sqlite3
+
+from alembic import command
+from alembic.config import Config
+import pytest
+from sqlalchemy import create_engine, orm
+
+from compranet import history, settings, storage, xlsx
+
+
+BASELINE_REVISION = '9d9edec95234'
+SOURCE = '2016'
+# number of previous versions of each contract in the history
+N_VERSIONS = {1: 0, 2: 1, 3: 3, 4: 12}
+DELETED = 5
+
+
+def migrate(db_path, action, revision):
+    """Runs alembic upgrade or downgrade on the database at db_path"""
+    engine = create_engine('sqlite:///' + db_path)
+    with engine.connect() as conn:
+        config = Config(settings.ALEMBIC_INI_PATH)
+        config.set_main_option('script_location',
+                               settings.ALEMBIC_SCRIPT_LOCATION)
+        config.attributes['connection'] = conn
+        getattr(command, action)(config, revision)
+    engine.dispose()
+
+def updated(version):
+    return('2016-01-{:02d} 00:00:00.000000'.format(version + 1))
+
+def contract_row(codigo, version):
+    """Returns a contract row with the values of the Excel files"""
+    return({'CODIGO_CONTRATO': codigo, '_SOURCE': SOURCE,
+            '_UPDATED': updated(version),
+            'TITULO_CONTRATO': 'Contrato {} v{}'.format(codigo, version),
+            'IMPORTE_CONTRATO': 1000.0 * codigo + version,
+            'CONVENIO_MODIFICATORIO': version % 2,
+            'EXP_F_FALLO': '2012-11-10 00:00:00 GMT',
+            'PROC_F_PUBLICACION': '2012-11-14 06:{:02d}'.format(version),
+            'FECHA_APERTURA_PROPOSICIONES': '2012-11-20 10:00',
+            'FECHA_INICIO': '2013-02-01',
+            'FECHA_FIN': 'no date',
+            'FECHA_CELEBRACION': '2013-01-{:02d} 00:00:00 GMT'.format(
+                version + 1)})
+
+def insert(conn, table, row):
+    cols = sorted(row)
+    conn.execute('INSERT INTO {} ({}) VALUES ({})'.format(
+                 table, ', '.join('"{}"'.format(col) for col in cols),
+                 ', '.join('?' for col in cols)),
+                 [row[col] for col in cols])
+
+def populate(db_path):
+    conn = sqlite3.connect(db_path)
+    for codigo, n_versions in N_VERSIONS.items():
+        for version in range(n_versions):
+            insert(conn, 'contratos_xls_hist',
+                   dict(contract_row(codigo, version), _REMOVED=0))
+        insert(conn, 'contratos_xls', contract_row(codigo, n_versions))
+    insert(conn, 'contratos_xls_hist',
+           dict(contract_row(DELETED, 0), _REMOVED=0))
+    insert(conn, 'contratos_xls_hist',
+           {'CODIGO_CONTRATO': DELETED, '_SOURCE': SOURCE,
+            '_UPDATED': updated(1), '_REMOVED': 1})
+    insert(conn, 'contratos_web',
+           {'ANUNCIO': 'A1', 'PROC_F_PUBLICACION': '14/11/2012 06:02',
+            '_UPDATED': updated(0)})
+    conn.commit()
+    conn.close()
+
+@pytest.fixture
+def baseline_db(tmpdir, monkeypatch):
+    # the baseline migrations read the Excel files of RAW_DIR, if any
+    monkeypatch.setattr(settings, 'RAW_DIR', str(tmpdir))
+    db_path = str(tmpdir.join('compranet.db'))
+    migrate(db_path, 'upgrade', BASELINE_REVISION)
+    populate(db_path)
+    return(db_path)
+
+def test_upgrade_populated_baseline(baseline_db):
+    migrate(baseline_db, 'upgrade', 'head')
+
+    conn = sqlite3.connect(baseline_db)
+    rows = conn.execute(
+        'SELECT EXP_F_FALLO, PROC_F_PUBLICACION, FECHA_INICIO, FECHA_FIN '
+        'FROM contratos_xls WHERE CODIGO_CONTRATO = 1').fetchall()
+    assert rows == [('2012-11-10', '2012-11-14 06:00:00.000000', '2013-02-01',
+                     None)]
+    assert conn.execute('SELECT PROC_F_PUBLICACION FROM contratos_web'
+                        ).fetchall() == [('14/11/2012 06:02',)]
+    conn.close()
+
+    engine = create_engine('sqlite:///' + baseline_db)
+    session = orm.Session(bind=engine)
+    # the fingerprints are those the loader computes for the stored rows
+    df = xlsx.read_source_db(SOURCE, session)
+    assert df['_FINGERPRINT'].notnull().all()
+    assert (df['_FINGERPRINT'] == xlsx.fingerprint(df)).all()
+    for codigo, n_versions in N_VERSIONS.items():
+        versions = history.contract_versions(codigo, SOURCE, session)
+        assert [version['TITULO_CONTRATO'] for version in versions] == \
+            ['Contrato {} v{}'.format(codigo, idx)
+             for idx in range(n_versions + 1)]
+        assert [version['PROC_F_PUBLICACION'] for version in versions] == \
+            [datetime(2012, 11, 14, 6, idx) for idx in range(n_versions + 1)]
+        assert [version['FECHA_CELEBRACION'] for version in versions] == \
+            [date(2013, 1, idx + 1) for idx in range(n_versions + 1)]
+    versions = history.contract_versions(DELETED, SOURCE, session)
+    assert [version['_REMOVED'] for version in versions] == [False, True]
+    session.close()
+    engine.dispose()
+
+def test_downgrade_to_baseline(baseline_db):
+    conn = sqlite3.connect(baseline_db)
+    n_hist = conn.execute('SELECT count(*) FROM contratos_xls_hist'
+                          ).fetchone()[0]
+    web_rows = conn.execute('SELECT * FROM contratos_web').fetchall()
+    conn.close()
+
+    migrate(baseline_db, 'upgrade', 'head')
+    migrate(baseline_db, 'downgrade', BASELINE_REVISION)
+
+    conn = sqlite3.connect(baseline_db)
+    rows = conn.execute(
+        'SELECT EXP_F_FALLO, PROC_F_PUBLICACION, FECHA_INICIO, FECHA_FIN '
+        'FROM contratos_xls WHERE CODIGO_CONTRATO = 1').fetchall()
+    assert rows == [('2012-11-10 00:00:00 GMT', '2012-11-14 06:00',
+                     '2013-02-01', None)]
+    # every previous version is a full copy again
+    cols = [row[1] for row in conn.execute(
+            'PRAGMA table_info(contratos_xls_hist)')]
+    assert conn.execute('SELECT count(*) FROM contratos_xls_hist'
+                        ).fetchone()[0] == n_hist
+    titles = conn.execute('SELECT TITULO_CONTRATO FROM contratos_xls_hist '
+                          'WHERE CODIGO_CONTRATO = 4 ORDER BY _UPDATED'
+                          ).fetchall()
+    assert titles == [('Contrato 4 v{}'.format(idx),) for idx in range(12)]
+    assert '_SUPERSEDED' not in cols
+    assert conn.execute('SELECT * FROM contratos_web').fetchall() == web_rows
+    conn.close()
+
+def test_normalized_database_is_not_migrated(baseline_db):
+    migrate(baseline_db, 'upgrade', 'head')
+    engine = create_engine('sqlite:///' + baseline_db)
+    storage.normalize(engine, vacuum=False)
+    engine.dispose()
+
+    # the first migration of the contract tables stops the downgrade
+    with pytest.raises(RuntimeError, match='storage flat'):
+        migrate(baseline_db, 'downgrade', BASELINE_REVISION)
+    conn = sqlite3.connect(baseline_db)
+    assert conn.execute("SELECT type FROM sqlite_master "
+                        "WHERE name = 'contratos_xls'").fetchone() == ('view',)
+    assert conn.execute('SELECT count(*) FROM contratos_xls').fetchone() == \
+        (len(N_VERSIONS),)
+    conn.close()
+
+@pytest.mark.parametrize('revision', ['9d9edec95234', 'a84d0e6c51f2',
+                                      'c52e8f1d7b30', 'e7b94a2c1d58',
+                                      '5b0e93c4f7a1'])
+def test_contract_migrations_require_flat(tmpdir, monkeypatch, revision):
+    # the migration after revision alters or indexes contratos_xls, which
+    # is a view over another table as in normalized mode
+    monkeypatch.setattr(settings, 'RAW_DIR', str(tmpdir))
+    db_path = str(tmpdir.join('compranet.db'))
+    migrate(db_path, 'upgrade', revision)
+    conn = sqlite3.connect(db_path)
+    conn.execute('ALTER TABLE contratos_xls RENAME TO contratos_xls_data')
+    conn.execute('CREATE VIEW contratos_xls AS SELECT * FROM '
+                 'contratos_xls_data')
+    conn.commit()
+    conn.close()
+
+    with pytest.raises(RuntimeError, match='storage flat'):
+        migrate(db_path, 'upgrade', 'head')
+    conn = sqlite3.connect(db_path)
+    assert conn.execute('SELECT version_num FROM alembic_version'
+                        ).fetchone() == (revision,)
+    conn.close()
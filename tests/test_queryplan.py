@@ -0,0 +1,26 @@
+"""
+Tests of the query plan checks on a schema created from the models.
+"""
+from sqlalchemy import create_engine
+
+from compranet import queryplan
+from compranet.database import Base
+
+
+def test_models_have_no_full_scans():
+    results = queryplan.check_models()
+    assert len(results) > 0
+    assert [(result['name'], result['scans']) for result in results
+            if result['scans']] == []
+
+def test_missing_index_is_reported():
+    engine = create_engine('sqlite://')
+    Base.metadata.create_all(engine)
+    with engine.connect() as conn:
+        conn.execute('DROP INDEX ix_crawl_frontier_lease')
+        results = queryplan.check_query_plans(conn)
+    engine.dispose()
+    scans = {result['name']: result['scans'] for result in results}
+    assert scans['frontier.lease (leased)'] == ['crawl_frontier']
+    assert [name for name, tables in scans.items() if tables] == \
+        ['frontier.lease (leased)']
@@ -0,0 +1,184 @@
+"""
+Tests of the conditional requests and resumed downloads of compranet.remote
+against a stand-in HTTP server.
+"""
+from http.server import BaseHTTPRequestHandler, HTTPServer
+import os
+from socketserver import ThreadingMixIn
+import threading
+
+import pytest
+
+from compranet import remote
+
+
+BODY = bytes(range(256)) * 12288
+ETAG = '"v2"'
+LAST_MODIFIED = 'Tue, 18 Oct 2016 06:00:00 GMT'
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class ArchiveHandler(BaseHTTPRequestHandler):
+    """
+    Serves BODY like the CompraNet server, with the options of the server:
+
+    head_allowed
+        Whether HEAD requests are allowed, or answered with 405
+    drop_after
+        Number of bytes of the body sent before closing the connection, in
+        the response to the first GET
+    """
+
+    def log_message(self, format, *args):
+        pass
+
+    def not_modified(self):
+        etag = self.headers.get('If-None-Match')
+        since = self.headers.get('If-Modified-Since')
+        return(etag == ETAG or (etag is None and since == LAST_MODIFIED))
+
+    def send_validators(self):
+        self.send_header('ETag', ETAG)
+        self.send_header('Last-Modified', LAST_MODIFIED)
+
+    def do_HEAD(self):
+        self.server.requests.append(('HEAD', dict(self.headers)))
+        if not self.server.head_allowed:
+            self.send_response(405)
+            self.end_headers()
+            return
+        self.send_response(304 if self.not_modified() else 200)
+        self.send_validators()
+        self.send_header('Content-Length', str(len(BODY)))
+        self.end_headers()
+
+    def do_GET(self):
+        self.server.requests.append(('GET', dict(self.headers)))
+        if self.not_modified():
+            self.send_response(304)
+            self.send_validators()
+            self.end_headers()
+            return
+        offset = 0
+        byte_range = self.headers.get('Range')
+        if_range = self.headers.get('If-Range')
+        if byte_range is not None and if_range in (None, ETAG):
+            offset = int(byte_range.split('=')[1].rstrip('-'))
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes {}-{}/{}'.format(
+                             offset, len(BODY) - 1, len(BODY)))
+        else:
+            self.send_response(200)
+        self.send_validators()
+        self.send_header('Content-Length', str(len(BODY) - offset))
+        self.end_headers()
+        body = BODY[offset:]
+        if self.server.drop_after is not None:
+            body = body[:self.server.drop_after]
+            self.server.drop_after = None
+        self.wfile.write(body)
+
+
+@pytest.fixture
+def server():
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), ArchiveHandler)
+    httpd.requests = []
+    httpd.head_allowed = True
+    httpd.drop_after = None
+    thread = threading.Thread(target=httpd.serve_forever)
+    thread.daemon = True
+    thread.start()
+    httpd.url = 'http://127.0.0.1:{}/Contratos2016.zip'.format(
+                httpd.server_address[1])
+    yield httpd
+    httpd.shutdown()
+    httpd.server_close()
+
+@pytest.fixture
+def http():
+    session = remote.make_session()
+    yield session
+    session.close()
+
+@pytest.fixture
+def no_sleep(monkeypatch):
+    monkeypatch.setattr(remote.time, 'sleep', lambda seconds: None)
+
+def test_check_not_modified_etag(server, http):
+    result = remote.check_remote(http, server.url, LAST_MODIFIED, ETAG)
+    assert result == {'modified': False, 'last_modified': LAST_MODIFIED,
+                      'etag': ETAG}
+    method, headers = server.requests[0]
+    assert method == 'HEAD'
+    assert headers['If-None-Match'] == ETAG
+    assert headers['If-Modified-Since'] == LAST_MODIFIED
+
+def test_check_not_modified_since(server, http):
+    result = remote.check_remote(http, server.url, last_modified=LAST_MODIFIED)
+    assert result['modified'] is False
+    assert [method for method, _ in server.requests] == ['HEAD']
+
+def test_check_modified(server, http):
+    result = remote.check_remote(http, server.url, LAST_MODIFIED, '"v1"')
+    assert result == {'modified': True, 'last_modified': LAST_MODIFIED,
+                      'etag': ETAG}
+
+def test_check_falls_back_to_get(server, http):
+    server.head_allowed = False
+    result = remote.check_remote(http, server.url, etag=ETAG)
+    assert result['modified'] is False
+    assert [method for method, _ in server.requests] == ['HEAD', 'GET']
+    assert server.requests[1][1]['If-None-Match'] == ETAG
+
+    result = remote.check_remote(http, server.url, etag='"v1"')
+    assert result == {'modified': True, 'last_modified': LAST_MODIFIED,
+                      'etag': ETAG}
+
+def test_check_all(server, http):
+    urls = {'2015': server.url, '2016': server.url}
+    results = remote.check_all(http, urls, {'2015': (None, ETAG)})
+    assert results['2015']['modified'] is False
+    assert results['2016']['modified'] is True
+
+def test_download(server, http, tmpdir):
+    path = str(tmpdir.join('Contratos2016.zip'))
+    result = remote.download(http, server.url, path, if_range=ETAG)
+    assert result['bytes'] == len(BODY)
+    with open(path, 'rb') as infile:
+        assert infile.read() == BODY
+    assert not os.path.exists(path + '.part')
+    assert 'Range' not in server.requests[0][1]
+
+def test_download_resumes_dropped_connection(server, http, tmpdir, no_sleep):
+    # the bytes of a chunk cut short are lost, the download resumes from
+    # the end of the last complete chunk
+    server.drop_after = 2 * remote.CHUNK_SIZE + 1000
+    path = str(tmpdir.join('Contratos2016.zip'))
+    remote.download(http, server.url, path, if_range=ETAG)
+    with open(path, 'rb') as infile:
+        assert infile.read() == BODY
+    assert len(server.requests) == 2
+    headers = server.requests[1][1]
+    assert headers['Range'] == 'bytes={}-'.format(2 * remote.CHUNK_SIZE)
+    assert headers['If-Range'] == ETAG
+
+def test_download_resumes_part_file(server, http, tmpdir):
+    path = str(tmpdir.join('Contratos2016.zip'))
+    with open(path + '.part', 'wb') as outfile:
+        outfile.write(BODY[:1000])
+    result = remote.download(http, server.url, path, if_range=ETAG)
+    with open(path, 'rb') as infile:
+        assert infile.read() == BODY
+    assert result['bytes'] == len(BODY) - 1000
+    assert server.requests[0][1]['Range'] == 'bytes=1000-'
+
+def test_download_restarts_other_version(server, http, tmpdir):
+    path = str(tmpdir.join('Contratos2016.zip'))
+    with open(path + '.part', 'wb') as outfile:
+        outfile.write(b'x' * 1000)
+    remote.download(http, server.url, path, if_range='"v1"')
+    with open(path, 'rb') as infile:
+        assert infile.read() == BODY